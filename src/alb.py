@@ -3,17 +3,26 @@
 module for interacting with Application Load Balancers (ALBs)
 """
 
-import boto3
-import sys
+import threading
+import time
+
+# local imports
+import aws
+import eventloop
+import events
+import snapshot
+
+# seconds between target health checks while draining
+DRAIN_POLL_INTERVAL = 5
 
 
 class ALBGroup(object):
-    def __init__(self, arn, albs, targets):
+    def __init__(self, arn, albs, targets, client=None):
         self.arn = arn
         self.albs = albs
         self.targets = targets
 
-        self.client = boto3.client('elbv2')
+        self.client = client or aws.client('elbv2')
 
     def deregister_targets(self, instance_ids):
         """
@@ -26,11 +35,73 @@ class ALBGroup(object):
         status_code = resp.get('ResponseMetadata', {}).get('HTTPStatusCode')
         return status_code == 200
 
+    def instance_targets(self, instance_id):
+        """
+        @param instance_id: ec2 instance id
+        @return: list of target dicts (Id and Port) registered for the instance
+        """
+        resp = self.client.describe_target_health(TargetGroupArn=self.arn)
+        return [d['Target'] for d in resp['TargetHealthDescriptions']
+                if d['Target']['Id'] == instance_id]
+
+    def deregister_instance(self, instance_id):
+        """
+        deregisters every port the instance is registered with
+        @param instance_id: ec2 instance id
+        @return: list of deregistered target dicts
+        """
+        targets = self.instance_targets(instance_id)
+        if targets:
+            self.client.deregister_targets(TargetGroupArn=self.arn,
+                                           Targets=targets)
+        return targets
+
+    def wait_for_drained(self, targets, timeout, poll_interval=DRAIN_POLL_INTERVAL):
+        """
+        blocks until the targets finished draining
+        @param targets: list of target dicts as returned by deregister_instance()
+        @param timeout: seconds to wait
+        @param poll_interval: seconds between checks
+        @return: true if drained, false if timed out
+        """
+        started = time.time()
+        while targets:
+            if self.drained(targets):
+                return True
+            if time.time() - started > timeout:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    def wait_for_drained_async(self, targets, timeout, poll_interval=DRAIN_POLL_INTERVAL):
+        """
+        Coroutine version of wait_for_drained(), see eventloop
+        """
+        started = time.time()
+        while targets:
+            drained = yield eventloop.call(self.drained, targets)
+            if drained:
+                break
+            if time.time() - started > timeout:
+                raise eventloop.Return(False)
+            yield eventloop.sleep(poll_interval)
+        raise eventloop.Return(True)
+
+    def drained(self, targets):
+        """
+        @param targets: list of target dicts as returned by deregister_instance()
+        @return: true if every target finished draining
+        """
+        resp = self.client.describe_target_health(TargetGroupArn=self.arn,
+                                                  Targets=targets)
+        states = [d['TargetHealth']['State'] for d in resp['TargetHealthDescriptions']]
+        return all(state == 'unused' for state in states)
+
 
 class _ALBCache_(object):
     def __init__(self):
         self.target_groups = {}
-        client = boto3.client('elbv2')
+        client = aws.client('elbv2')
         paginator = client.get_paginator('describe_target_groups')
         for resp in paginator.paginate():
             for group in resp['TargetGroups']:
@@ -39,18 +110,28 @@ class _ALBCache_(object):
                 for details in health['TargetHealthDescriptions']:
                     targets.append(details['Target']['Id'])
 
-                self.target_groups[group['TargetGroupArn']] = ALBGroup(group['TargetGroupArn'], group['LoadBalancerArns'], targets)
+                self.target_groups[group['TargetGroupArn']] = ALBGroup(group['TargetGroupArn'], group['LoadBalancerArns'],
+                                                                       targets, client)
 
 
-ALBCache = None
+# _ALBCache_ objects by region name
+ALBCaches = {}
+ALBCachesLock = threading.Lock()
 
 
-def NewALBGroup(arn):
-    global ALBCache
-    if not ALBCache:
-        ALBCache = _ALBCache_()
+def get_alb_cache():
+    """
+    @return: the _ALBCache_ of the current region, built on first use
+    """
+    region = aws.current_region()
+    with ALBCachesLock:
+        if region not in ALBCaches:
+            ALBCaches[region] = _ALBCache_()
+        return ALBCaches[region]
 
-    return ALBCache.target_groups[arn]
+
+def NewALBGroup(arn):
+    return get_alb_cache().target_groups[arn]
 
 
 def target_group_arns_with_instance(ec2_id):
@@ -58,12 +139,8 @@ def target_group_arns_with_instance(ec2_id):
     @param ec2_id: ec2 instance id
     @return: list of alb arns with the ec2 instance attached
     """
-    global ALBCache
-    if not ALBCache:
-        ALBCache = _ALBCache_()
-
     group_arns = set()
-    for group in ALBCache.target_groups.values():
+    for group in get_alb_cache().target_groups.values():
         if ec2_id in group.targets:
             group_arns.add(group.arn)
 
@@ -74,21 +151,22 @@ def main_detach(args):
     """
     Main entry point for detach command
     """
-    global ALBCache
-    if not ALBCache:
-        ALBCache = _ALBCache_()
-
     if args.target_group_arn:
-        target_group_arns = args.target_group_arn
+        # the groups are given, no need to describe every group of the account
+        client = aws.client('elbv2')
+        target_groups = [ALBGroup(arn, [], [], client) for arn in args.target_group_arn]
     else:
         # query for load balancers with this ec2 instance
-        target_group_arns = target_group_arns_with_instance(args.ec2_id)
-
-    target_groups = [ALBCache.target_groups[arn] for arn in target_group_arns]
+        alb_cache = get_alb_cache()
+        target_groups = [alb_cache.target_groups[arn] for arn in target_group_arns_with_instance(args.ec2_id)]
 
     for target_group in target_groups:
-        # print target_group.arn, target_group.albs
-        sys.stdout.write("Detaching from target_group %s ..." % (target_group.arn))
-        sys.stdout.flush()
-        target_group.deregister_targets([args.ec2_id])
-        print "done"
+        with events.phase('alb_detach',
+                          "Detaching from target_group %s" % (target_group.arn),
+                          instance=args.ec2_id,
+                          target_group=target_group.arn) as result:
+            if not target_group.deregister_targets([args.ec2_id]):
+                result['outcome'] = 'failed'
+    # the instance may be in any cluster's snapshot
+    snapshot.invalidate()
+    return True
@@ -0,0 +1,246 @@
+"""
+module for creating instrumented boto3 clients
+"""
+
+from contextlib import contextmanager
+import threading
+import time
+
+# error codes AWS uses when a request was rate limited
+THROTTLE_CODES = set([
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+])
+
+
+class APIStats(object):
+    """
+    Process-wide counts of AWS API calls and throttles by operation
+    (ex. "ecs.DescribeServices")
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.throttles = {}
+
+    def record_call(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def record_throttle(self, operation):
+        with self.lock:
+            self.throttles[operation] = self.throttles.get(operation, 0) + 1
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def snapshot(self):
+        """
+        @return: dictionary with copies of the call and throttle counts
+        """
+        with self.lock:
+            return dict(calls=dict(self.calls), throttles=dict(self.throttles))
+
+
+STATS = APIStats()
+
+
+class CallCounter(object):
+    """
+    Counts the API calls made on behalf of something (ex. a phase), from
+    whichever threads act for it, see counting()
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def add(self):
+        with self.lock:
+            self.calls += 1
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls so that no more than `rate` are made per second
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_call = time.time()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            wait = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+# API budgets by region name
+LIMITERS = {}
+
+# region clients are created in when none is given, per thread
+_local = threading.local()
+
+# called with the operation and seconds taken after every API call, if set
+_call_observer = None
+
+
+def set_region_budget(region, rate):
+    """
+    Limits the API calls made to a region by every client in this process
+    @param region: region name
+    @param rate: maximum calls per second
+    """
+    LIMITERS[region] = RateLimiter(rate)
+
+
+def current_region():
+    """
+    @return: the region set with region_context() for this thread, or None
+             for the boto3 default
+    """
+    return getattr(_local, 'region', None)
+
+
+@contextmanager
+def region_context(region):
+    """
+    Makes clients created in this thread default to `region`
+    """
+    previous = current_region()
+    _local.region = region
+    try:
+        yield
+    finally:
+        _local.region = previous
+
+
+def current_counters():
+    """
+    @return: tuple of the CallCounters the calls made from this thread are
+             added to
+    """
+    return getattr(_local, 'counters', ())
+
+
+@contextmanager
+def counting(counters):
+    """
+    Adds the calls made from this thread to `counters` as well as to the
+    current ones
+    @param counters: iterable of CallCounters
+    """
+    previous = current_counters()
+    _local.counters = previous + tuple(c for c in counters if c not in previous)
+    try:
+        yield
+    finally:
+        _local.counters = previous
+
+
+def _boto3():
+    """
+    @return: the boto3 module, imported on first use. Loading it takes most of
+             the startup time of the commands that make a single call
+    """
+    import boto3
+    return boto3
+
+
+# boto3 session every client is created from, see _session(). Sessions load
+# parts of themselves on first use and aren't safe to use from several
+# threads, so it is only ever touched with _session_lock held
+_shared_session = None
+_session_lock = threading.Lock()
+
+
+def _session():
+    global _shared_session
+    if _shared_session is None:
+        _shared_session = _boto3().session.Session()
+    return _shared_session
+
+
+def default_region():
+    """
+    @return: the region clients are created in when none is given
+    """
+    region = current_region()
+    if region:
+        return region
+    with _session_lock:
+        return _session().region_name
+
+
+def set_call_observer(observer):
+    """
+    @param observer: function taking an operation name and the seconds the
+                     call took, called from the thread that made the call.
+                     None to stop observing
+    """
+    global _call_observer
+    _call_observer = observer
+
+
+def _operation(event_name):
+    # event names look like "after-call.ecs.DescribeServices"
+    return event_name.split('.', 1)[-1]
+
+
+def _start_call(**kwargs):
+    _local.call_started = time.time()
+
+
+def _after_call(event_name, **kwargs):
+    STATS.record_call(_operation(event_name))
+    for counter in current_counters():
+        counter.add()
+    started = getattr(_local, 'call_started', None)
+    observer = _call_observer
+    if observer and started:
+        observer(_operation(event_name), time.time() - started)
+
+
+def _needs_retry(event_name, response=None, **kwargs):
+    if response is None:
+        return None
+    parsed = response[1] or {}
+    if parsed.get('Error', {}).get('Code') in THROTTLE_CODES:
+        STATS.record_throttle(_operation(event_name))
+    # returning None leaves the retry decision to botocore
+    return None
+
+
+def _budget_handler(region):
+    # a plain function rather than a partial, botocore inspects handlers
+    # for **kwargs
+    def _before_call(**kwargs):
+        limiter = LIMITERS.get(region)
+        if limiter:
+            limiter.acquire()
+    return _before_call
+
+
+def client(service_name, region=None):
+    """
+    Creates a boto3 client that reports its calls to STATS and respects the
+    API budget of its region
+    @param service_name: boto3 service name (ex. "ecs")
+    @param region: optional region name. Defaults to current_region()
+    @return: boto3 client
+    """
+    # clients are safe to share between threads once created, creating them
+    # isn't
+    with _session_lock:
+        new_client = _session().client(service_name, region_name=region or current_region())
+    new_client.meta.events.register('before-call', _budget_handler(new_client.meta.region_name))
+    # registered after the budget so waiting on it isn't counted as the call
+    new_client.meta.events.register('before-call', _start_call)
+    new_client.meta.events.register('after-call', _after_call)
+    new_client.meta.events.register('needs-retry', _needs_retry)
+    return new_client
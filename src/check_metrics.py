@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+"""
+checks the metrics exporters against local listeners
+
+Feeds progress records through RolloverMetrics with a StatsD sink pointed
+at a local UDP socket and /metrics served on a local port, then checks what
+both received. Makes no AWS calls. Run with `make check`.
+"""
+
+import socket
+import sys
+import time
+import urllib2
+
+# local imports
+import metrics
+
+# seconds to wait for a StatsD packet
+RECEIVE_TIMEOUT = 2
+
+
+def phase_end(phase, outcome='ok', duration=1.5, **fields):
+    record = dict(event='phase_end', ts=time.time(), id=1, phase=phase,
+                  description=phase, outcome=outcome, duration=duration, api_calls=0)
+    record.update(fields)
+    return record
+
+
+def receive_all(sock):
+    """
+    @return: list of the StatsD lines received until the socket goes quiet
+    """
+    lines = []
+    while True:
+        try:
+            packet, _ = sock.recvfrom(65536)
+        except socket.timeout:
+            return lines
+        lines += packet.splitlines()
+        sock.settimeout(0.2)
+
+
+def check(failures, description, ok):
+    print "%s ...%s" % (description, "ok" if ok else "FAILED")
+    if not ok:
+        failures.append(description)
+
+
+def main():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.settimeout(RECEIVE_TIMEOUT)
+
+    registry = metrics.Registry()
+    registry.sinks.append(metrics.StatsDSink(*listener.getsockname()))
+    server = metrics.serve(0, registry, host='127.0.0.1')
+    subscriber = metrics.RolloverMetrics(registry)
+
+    subscriber(phase_end('deregister', instance='i-1', dry_run=False))
+    subscriber(phase_end('deregister', instance='i-2', dry_run=True))
+    subscriber(phase_end('service_steady_state', service='web "blue"\\green\nnext'))
+    subscriber(dict(event='drain_limit', ts=time.time(), limit=3))
+
+    failures = []
+    statsd = receive_all(listener)
+    check(failures, "StatsD counts the real drain only",
+          statsd.count('ecs_rollover.instances_drained_total:1|c') == 1)
+    check(failures, "StatsD gets the phase timings",
+          'ecs_rollover.phase_duration_seconds.deregister:1500|ms' in statsd)
+    check(failures, "StatsD gets the drain limit",
+          'ecs_rollover.drain_limit:3.000000|g' in statsd)
+
+    body = urllib2.urlopen('http://127.0.0.1:%d/metrics' % (server.server_address[1])).read()
+    server.shutdown()
+    check(failures, "/metrics counts the real drain only",
+          'ecs_rollover_instances_drained_total 1\n' in body)
+    check(failures, "/metrics escapes quotes, backslashes and newlines in labels",
+          'service="web \\"blue\\"\\\\green\\nnext"' in body)
+    check(failures, "/metrics lines all start with the prefix",
+          all(line.startswith(('#', metrics.PREFIX)) for line in body.splitlines()))
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
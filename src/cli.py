@@ -0,0 +1,485 @@
+#! /usr/bin/env python
+"""
+command line entry point
+
+Commands are registered by name only: the module implementing a command, and
+the boto3 clients it creates, are loaded once that command runs. Short
+commands like ec2-terminate or docker-stop then only pay for what they use.
+"""
+
+import argparse
+import importlib
+import sys
+
+# local imports
+import defaults
+import events
+
+
+def lazy(path):
+    """
+    @param path: "<module>.<name>" of a function or class of this tool
+    @return: function importing the module on first call and calling through
+             to it. Keeps the name, which argparse uses in its errors
+    """
+    module_name, name = path.rsplit('.', 1)
+
+    def call(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), name)(*args, **kwargs)
+    call.__name__ = name
+    return call
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log-format',
+                        choices=events.LOG_FORMATS,
+                        default='text',
+                        help="print progress as 'text' or as JSON lines ('json'). "
+                             "Defaults to 'text'")
+    parser.add_argument('--statsd',
+                        metavar='HOST:PORT',
+                        help="push progress and latency metrics to this StatsD server")
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        help="serve Prometheus metrics on http://0.0.0.0:<port>/metrics while running")
+    parser.add_argument('--profile',
+                        metavar='FILE',
+                        help="profile the command, write the profile to FILE (readable with pstats) and print "
+                             "where CPU time went and how long each module was blocked on AWS API calls")
+    subparsers = parser.add_subparsers()
+
+    #
+    # Rollover args
+    #
+    rollover_parser = subparsers.add_parser('rollover',
+                                            help="rollover ECS nodes")
+    rollover_parser.set_defaults(func=lazy('rollover.main_rollover'), scale_down=False)
+
+    rollover_parser.add_argument('-t',
+                                 '--timeout',
+                                 type=int,
+                                 default=30,
+                                 help="`docker stop` timeout (per container)")
+    rollover_parser.add_argument('-s',
+                                 '--sort',
+                                 choices=['launch_time', 'utilization'],
+                                 default="launch_time",
+                                 help="sorts instances by 'launch_time' or 'utilization'. "
+                                        "If not provided, defaults to 'launch_time'")
+    rollover_parser.add_argument('--select',
+                                 metavar='all|auto:N',
+                                 type=lazy('selection.parse_select'),
+                                 help="instead of prompting for indices, select every instance (all) or pick the N instances whose "
+                                        "tasks are cheapest to migrate (fewest tasks, least reserved "
+                                        "memory, no singleton services) while keeping AZs balanced")
+    rollover_parser.add_argument('--where',
+                                 action='append',
+                                 type=lazy('selection.parse_where'),
+                                 metavar='FIELD<OP>VALUE',
+                                 help="only select instances matching a rule (ex. 'ami!=ami-123', 'agent<1.50', "
+                                      "'type=m4.*'). Fields: ami, agent, type, az. May be repeated, all rules must "
+                                      "match. Without --select every matching instance is selected")
+    rollover_parser.add_argument('--older-than',
+                                 type=lazy('selection.parse_age'),
+                                 metavar='AGE',
+                                 help="only select instances launched more than AGE ago (ex. 30d, 12h, 2w)")
+    rollover_parser.add_argument('--no-lb-drain',
+                                 dest='lb_drain',
+                                 action="store_false",
+                                 default=True,
+                                 help="don't drain instances from their load balancers before "
+                                        "de-registering them from ECS. They are detached "
+                                        "after their services reached steady state instead")
+    rollover_parser.add_argument('--lb-drain-timeout',
+                                 type=int,
+                                 default=360,
+                                 help="seconds to wait for connections to drain from each load "
+                                        "balancer. Defaults to 360")
+    rollover_parser.add_argument('--timing-db',
+                                 default=defaults.TIMING_DB,
+                                 help="sqlite file where phase durations are recorded and used to size "
+                                        "timeouts. Pass an empty string to use the fixed defaults. "
+                                        "Defaults to %s" % (defaults.TIMING_DB))
+    rollover_parser.add_argument('--estimate-concurrency',
+                                 type=lazy('planner.parse_concurrencies'),
+                                 default=[1, 2, 4, 8],
+                                 help="comma separated numbers of instances in flight to estimate "
+                                        "the duration of a --dry-run for. Defaults to 1,2,4,8")
+    rollover_parser.add_argument('-y',
+                                 '--yes',
+                                 action="store_true",
+                                 default=False,
+                                 help="don't ask for confirmation")
+    rollover_parser.add_argument('--parallel',
+                                 type=int,
+                                 default=1,
+                                 help="number of instances removed at once. Instances only start "
+                                        "moving tasks while every service on them stays above its "
+                                        "minimum healthy percent. Defaults to 1")
+    rollover_parser.add_argument('--adaptive',
+                                 action="store_true",
+                                 default=False,
+                                 help="start with one instance in flight and add more, up to --parallel, "
+                                        "while the cluster places the displaced tasks. Fewer are drained "
+                                        "when its backlog keeps growing or it runs out of cpu or memory")
+    rollover_parser.add_argument('--dashboard',
+                                 action="store_true",
+                                 default=False,
+                                 help="show a live view of the cluster and the rollover while instances are removed")
+    rollover_parser.add_argument('--dry-run',
+                                 action="store_true",
+                                 default=False,
+                                 help="dry run. Don't actually make changes.")
+    rollover_parser.add_argument('--prepull',
+                                 action="store_true",
+                                 default=False,
+                                 help="pull the images of the services on each instance onto "
+                                        "its replacement before de-registering it")
+    rollover_parser.add_argument('--prepull-timeout',
+                                 type=int,
+                                 default=300,
+                                 help="seconds to wait for images to be pre-pulled. "
+                                        "Defaults to 300")
+    rollover_parser.add_argument('--cache-ttl',
+                                 type=int,
+                                 default=0,
+                                 help="reuse cached AWS descriptions for this many seconds. "
+                                        "Any change made to the cluster clears the cache. "
+                                        "Defaults to 0 (disabled)")
+    rollover_parser.add_argument('cluster',
+                                 help="fully qualified name of the cluster")
+    rollover_parser.add_argument('asgs',
+                                 metavar='asg',
+                                 nargs='*',
+                                 help="auto scaling groups backing the cluster. Defaults to every group "
+                                      "owning one of its container instances")
+
+    #
+    # Scaledown args
+    #
+    scaledown_parser = subparsers.add_parser('scaledown',
+                                             help="remove ECS nodes")
+    scaledown_parser.set_defaults(func=lazy('rollover.main_rollover'), scale_down=True, prepull=False)
+
+    scaledown_parser.add_argument('-t',
+                                  '--timeout',
+                                  type=int,
+                                  default=30,
+                                  help="`docker stop` timeout (per container)")
+    scaledown_parser.add_argument('-s',
+                                 '--sort',
+                                 choices=['launch_time', 'utilization'],
+                                 default="launch_time",
+                                 help="sorts instances by 'launch_time' or 'utilization'. "
+                                        "If not provided, defaults to 'launch_time'")
+    scaledown_parser.add_argument('--select',
+                                  metavar='all|auto:N',
+                                  type=lazy('selection.parse_select'),
+                                  help="instead of prompting for indices, select every instance (all) or pick the N instances whose "
+                                         "tasks are cheapest to migrate (fewest tasks, least reserved "
+                                         "memory, no singleton services) while keeping AZs balanced")
+    scaledown_parser.add_argument('--where',
+                                  action='append',
+                                  type=lazy('selection.parse_where'),
+                                  metavar='FIELD<OP>VALUE',
+                                  help="only select instances matching a rule (ex. 'ami!=ami-123', 'agent<1.50', "
+                                       "'type=m4.*'). Fields: ami, agent, type, az. May be repeated, all rules must "
+                                       "match. Without --select every matching instance is selected")
+    scaledown_parser.add_argument('--older-than',
+                                  type=lazy('selection.parse_age'),
+                                  metavar='AGE',
+                                  help="only select instances launched more than AGE ago (ex. 30d, 12h, 2w)")
+    scaledown_parser.add_argument('--no-lb-drain',
+                                  dest='lb_drain',
+                                  action="store_false",
+                                  default=True,
+                                  help="don't drain instances from their load balancers before "
+                                         "de-registering them from ECS. They are detached "
+                                         "after their services reached steady state instead")
+    scaledown_parser.add_argument('--lb-drain-timeout',
+                                  type=int,
+                                  default=360,
+                                  help="seconds to wait for connections to drain from each load "
+                                         "balancer. Defaults to 360")
+    scaledown_parser.add_argument('--timing-db',
+                                  default=defaults.TIMING_DB,
+                                  help="sqlite file where phase durations are recorded and used to size "
+                                         "timeouts. Pass an empty string to use the fixed defaults. "
+                                         "Defaults to %s" % (defaults.TIMING_DB))
+    scaledown_parser.add_argument('--estimate-concurrency',
+                                  type=lazy('planner.parse_concurrencies'),
+                                  default=[1, 2, 4, 8],
+                                  help="comma separated numbers of instances in flight to estimate "
+                                         "the duration of a --dry-run for. Defaults to 1,2,4,8")
+    scaledown_parser.add_argument('-y',
+                                  '--yes',
+                                  action="store_true",
+                                  default=False,
+                                  help="don't ask for confirmation")
+    scaledown_parser.add_argument('--parallel',
+                                  type=int,
+                                  default=1,
+                                  help="number of instances removed at once. Instances only start "
+                                         "moving tasks while every service on them stays above its "
+                                         "minimum healthy percent. Defaults to 1")
+    scaledown_parser.add_argument('--adaptive',
+                                  action="store_true",
+                                  default=False,
+                                  help="start with one instance in flight and add more, up to --parallel, "
+                                         "while the cluster places the displaced tasks. Fewer are drained "
+                                         "when its backlog keeps growing or it runs out of cpu or memory")
+    scaledown_parser.add_argument('--dashboard',
+                                  action="store_true",
+                                  default=False,
+                                  help="show a live view of the cluster and the rollover while instances are removed")
+    scaledown_parser.add_argument('--dry-run',
+                                  action="store_true",
+                                  default=False,
+                                  help="dry run. Don't actually make changes.")
+    scaledown_parser.add_argument('--cache-ttl',
+                                  type=int,
+                                  default=0,
+                                  help="reuse cached AWS descriptions for this many seconds. "
+                                         "Any change made to the cluster clears the cache. "
+                                         "Defaults to 0 (disabled)")
+    scaledown_parser.add_argument('cluster',
+                                  help="fully qualified name of the cluster")
+    scaledown_parser.add_argument('asgs',
+                                  metavar='asg',
+                                  nargs='*',
+                                  help="auto scaling groups backing the cluster. Defaults to every group "
+                                       "owning one of its container instances")
+
+    #
+    # rollover-many args
+    #
+    rollover_many_parser = subparsers.add_parser('rollover-many',
+                                                 help="rollover or scale down several clusters "
+                                                      "concurrently from a manifest")
+    rollover_many_parser.set_defaults(func=lazy('rollover.main_rollover_many'),
+                                      command_parsers=dict(rollover=rollover_parser,
+                                                           scaledown=scaledown_parser))
+
+    rollover_many_parser.add_argument('--max-clusters',
+                                      type=int,
+                                      default=4,
+                                      help="number of clusters to work on at once. Defaults to 4")
+    rollover_many_parser.add_argument('--region-rate',
+                                      type=float,
+                                      default=10.0,
+                                      help="maximum AWS API calls per second to each region, "
+                                           "shared by all clusters in it. Defaults to 10")
+    rollover_many_parser.add_argument('--dry-run',
+                                      action="store_true",
+                                      default=False,
+                                      help="dry run every cluster. Don't actually make changes.")
+    rollover_many_parser.add_argument('manifest',
+                                      help="JSON file listing the clusters, auto scaling groups "
+                                           "and selection rules")
+
+    #
+    # alb-detach args
+    #
+    alb_detach_parser = subparsers.add_parser('alb-detach',
+                                              help="Remove an EC2 instance "
+                                                   "from ALBs")
+    alb_detach_parser.set_defaults(func=lazy('alb.main_detach'))
+
+    alb_detach_parser.add_argument('ec2_id',
+                                   help="EC2 instance id")
+    alb_detach_parser.add_argument('target_group_arn',
+                                   nargs='*',
+                                   help="ALB target group ARN to detach from. "
+                                        "If not provided, all will be queried")
+
+    #
+    # elb-detach args
+    #
+    elb_detach_parser = subparsers.add_parser('elb-detach',
+                                              help="Remove an EC2 instance "
+                                                   "from ELBs")
+    elb_detach_parser.set_defaults(func=lazy('elb.main_detach'))
+
+    elb_detach_parser.add_argument('ec2_id',
+                                   help="EC2 instance id")
+    elb_detach_parser.add_argument('load_balancer_name',
+                                   nargs='*',
+                                   help="load balancer to detach from. "
+                                        "If not provided, all will be queried")
+
+    #
+    # docker-stop args
+    #
+    docker_stop_parser = subparsers.add_parser('docker-stop',
+                                               help="stop docker containers on"
+                                                    " an ec2 instance")
+    docker_stop_parser.set_defaults(func=lazy('ssm.main_docker_stop'))
+
+    docker_stop_parser.add_argument('-t',
+                                    '--timeout',
+                                    type=int,
+                                    default=30,
+                                    help="`docker stop` timeout (per container)")
+    docker_stop_parser.add_argument('ec2_id',
+                                    help="EC2 instance id")
+
+    #
+    # fast-drain args
+    #
+    fast_drain_parser = subparsers.add_parser('fast-drain',
+                                              help="take instances out of service within a deadline "
+                                                   "(ex. spot interruptions)")
+    fast_drain_parser.set_defaults(func=lazy('rollover.main_fast_drain'))
+
+    fast_drain_parser.add_argument('--budget',
+                                   type=int,
+                                   default=defaults.SPOT_NOTICE,
+                                   help="seconds every instance is taken out of service within. "
+                                        "Defaults to %d" % (defaults.SPOT_NOTICE))
+    fast_drain_parser.add_argument('-t',
+                                   '--timeout',
+                                   type=int,
+                                   default=30,
+                                   help="longest `docker stop` timeout, shortened to fit the budget. "
+                                        "Defaults to 30")
+    fast_drain_parser.add_argument('--watch',
+                                   metavar='FILE',
+                                   help="drain the instances of interruption notices appended to FILE "
+                                        "(- for stdin): ec2 ids or spot interruption CloudWatch events "
+                                        "as JSON, one per line")
+    fast_drain_parser.add_argument('--max-instances',
+                                   type=int,
+                                   default=20,
+                                   help="number of instances drained at once. Defaults to 20")
+    fast_drain_parser.add_argument('cluster',
+                                   help="fully qualified name of the cluster")
+    fast_drain_parser.add_argument('ec2_ids',
+                                   metavar='ec2_id',
+                                   nargs='*',
+                                   help="ec2 instances to drain")
+
+    #
+    # agent args
+    #
+    agent_parser = subparsers.add_parser('agent',
+                                         help="drain instances that auto scaling is terminating, "
+                                              "driven by lifecycle hook notifications")
+    agent_parser.set_defaults(func=lazy('rollover.main_agent'), scale_down=True, prepull=False, dry_run=False, parallel=1)
+
+    agent_parser.add_argument('--queue',
+                              metavar='FILE',
+                              help="read notifications appended to FILE (- for stdin), one JSON "
+                                   "document per line")
+    agent_parser.add_argument('--listen',
+                              metavar='ADDRESS',
+                              help="read notifications sent to a unix socket path or host:port, "
+                                   "one JSON document per line")
+    agent_parser.add_argument('--max-instances',
+                              type=int,
+                              default=10,
+                              help="number of instances drained at once. Defaults to 10")
+    agent_parser.add_argument('--heartbeat-interval',
+                              type=int,
+                              default=defaults.HEARTBEAT_INTERVAL,
+                              help="seconds between lifecycle action heartbeats. Defaults to %d" % (defaults.HEARTBEAT_INTERVAL))
+    agent_parser.add_argument('-t',
+                              '--timeout',
+                              type=int,
+                              default=30,
+                              help="`docker stop` timeout (per container)")
+    agent_parser.add_argument('--no-lb-drain',
+                              dest='lb_drain',
+                              action="store_false",
+                              default=True,
+                              help="don't drain instances from their load balancers before "
+                                   "de-registering them from ECS. They are detached "
+                                   "after their services reached steady state instead")
+    agent_parser.add_argument('--lb-drain-timeout',
+                              type=int,
+                              default=360,
+                              help="seconds to wait for connections to drain from each load "
+                                   "balancer. Defaults to 360")
+    agent_parser.add_argument('--timing-db',
+                              default=defaults.TIMING_DB,
+                              help="sqlite file where phase durations are recorded and used to size "
+                                   "timeouts. Pass an empty string to use the fixed defaults. "
+                                   "Defaults to %s" % (defaults.TIMING_DB))
+    agent_parser.add_argument('cluster',
+                              help="fully qualified name of the cluster")
+
+    #
+    # watch args
+    #
+    watch_parser = subparsers.add_parser('watch',
+                                         help="live view of a cluster's services and instances")
+    watch_parser.set_defaults(func=lazy('rollover.main_watch'))
+
+    watch_parser.add_argument('--interval',
+                              type=int,
+                              default=defaults.DASHBOARD_INTERVAL,
+                              help="seconds between refreshes. Defaults to %d" % (defaults.DASHBOARD_INTERVAL))
+    watch_parser.add_argument('--once',
+                              action="store_true",
+                              default=False,
+                              help="print the view once and exit")
+    watch_parser.add_argument('cluster',
+                              help="fully qualified name of the cluster")
+
+    #
+    # ec2-stop args
+    #
+    ec2_stop_parser = subparsers.add_parser('ec2-stop',
+                                            help="Stop EC2 instances")
+    ec2_stop_parser.set_defaults(func=lazy('ec2.main_stop'))
+
+    ec2_stop_parser.add_argument('ec2_id',
+                                 nargs='+',
+                                 help="EC2 instance id")
+
+    #
+    # ec2-terminate args
+    #
+    ec2_terminate_parser = subparsers.add_parser('ec2-terminate',
+                                                 help="Terminate EC2 instances")
+    ec2_terminate_parser.set_defaults(func=lazy('ec2.main_terminate'))
+
+    ec2_terminate_parser.add_argument('ec2_id',
+                                      nargs='+',
+                                      help="EC2 instance id")
+
+    #
+    # check for a task
+    #
+    check_task_parser = subparsers.add_parser('check-task',
+                                              help="return a list of ECS instances running the given task")
+    check_task_parser.set_defaults(func=lazy('rollover.main_check_for_task'))
+
+    check_task_parser.add_argument('-v',
+                                   '--invert-match',
+                                   action="store_true",
+                                   default=False,
+                                   help="Print the ECS instances NOT running the task")
+    check_task_parser.add_argument('--cache-ttl',
+                                   type=int,
+                                   default=0,
+                                   help="reuse cached AWS descriptions for this many seconds. "
+                                          "Any change made to the cluster clears the cache. "
+                                          "Defaults to 0 (disabled)")
+    check_task_parser.add_argument('cluster',
+                                   help="fully qualified name of the cluster")
+    check_task_parser.add_argument('task_name_expr',
+                                   help="task definition name (wildcards accepted)")
+
+    args = parser.parse_args()
+    events.configure(args.log_format)
+    if args.statsd or args.metrics_port:
+        lazy('metrics.configure')(args.statsd, args.metrics_port)
+    if args.profile:
+        args.func = lazy('profiling.Profiler')().wrap(args.func, args.profile)
+    if not args.func(args):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+module for a live terminal view of a cluster and of the rollover running
+against it
+
+The view is maintained incrementally: on every tick the service and
+container instance lists are fetched, but only new, unsettled and a
+rotating slice of settled services and instances are described again, so
+refreshing every few seconds stays cheap on large clusters.
+"""
+
+import collections
+import sys
+import threading
+import time
+
+# local imports
+import aws
+import defaults
+
+# seconds between redraws
+DEFAULT_INTERVAL = defaults.DASHBOARD_INTERVAL
+
+# settled services and instances are all described again once every this many ticks
+RESCAN_TICKS = 6
+
+# rows of each table shown before the rest are summarized
+MAX_SERVICE_ROWS = 20
+MAX_PHASE_ROWS = 10
+RECENT_MESSAGES = 5
+
+# moves the cursor home and clears the screen
+CLEAR_SCREEN = "\x1b[H\x1b[2J"
+
+
+def service_settled(desc):
+    return (desc['runningCount'] == desc['desiredCount'] and
+            desc.get('pendingCount', 0) == 0 and
+            len(desc.get('deployments', [])) <= 1)
+
+
+def instance_settled(desc):
+    return (desc['status'] == 'ACTIVE' and
+            desc['agentConnected'] and
+            desc.get('pendingTasksCount', 0) == 0)
+
+
+class ClusterView(object):
+    """
+    Incrementally maintained descriptions of a cluster's services and
+    container instances
+    """
+    def __init__(self, ecs_client, rescan_ticks=RESCAN_TICKS):
+        self.ecs_client = ecs_client
+        self.rescan_ticks = rescan_ticks
+        self.ticks = 0
+        self.services = {}
+        self.instances = {}
+        self.refreshed_at = None
+        self.last_api_calls = 0
+        self.lock = threading.Lock()
+
+    def _refresh(self, known, ids, describe, settled):
+        stale = [i for i in ids if i not in known or not settled(known[i])]
+        # settled entries are re-checked a slice at a time
+        settled_ids = sorted(i for i in ids if i in known and settled(known[i]))
+        stale += settled_ids[self.ticks % self.rescan_ticks::self.rescan_ticks]
+
+        view = dict((i, known[i]) for i in ids if i in known)
+        if stale:
+            view.update(describe(stale, cached=False))
+        return view
+
+    def refresh(self):
+        """
+        Brings the view up to date
+        """
+        calls = aws.CallCounter()
+        with aws.counting([calls]):
+            services = self._refresh(self.services,
+                                     self.ecs_client.list_services(cached=False),
+                                     self.ecs_client.describe_services,
+                                     service_settled)
+            instances = self._refresh(self.instances,
+                                      self.ecs_client.list_container_instances(cached=False),
+                                      self.ecs_client.describe_instances,
+                                      instance_settled)
+        with self.lock:
+            self.services = services
+            self.instances = instances
+            self.ticks += 1
+            self.refreshed_at = time.time()
+            self.last_api_calls = calls.calls
+
+    def render(self):
+        """
+        @return: list of lines describing the cluster
+        """
+        with self.lock:
+            services = list(self.services.values())
+            instances = list(self.instances.values())
+            api_calls = self.last_api_calls
+
+        active = [i for i in instances if i['status'] == 'ACTIVE']
+        disconnected = [i for i in active if not i['agentConnected']]
+        running = sum(i.get('runningTasksCount', 0) for i in instances)
+        pending = sum(i.get('pendingTasksCount', 0) for i in instances)
+
+        lines = []
+        lines.append("%s  %s  (%d API calls last refresh)" % (
+            self.ecs_client.cluster, time.strftime('%H:%M:%S'), api_calls))
+        lines.append("Instances: %d active, %d inactive, %d agent disconnected" % (
+            len(active), len(instances) - len(active), len(disconnected)))
+        lines.append("Tasks: %d running, %d pending" % (running, pending))
+        lines.append("")
+
+        # unsettled services first, then by name
+        services.sort(key=lambda s: (service_settled(s), s['serviceName']))
+        lines.append("%-40s %9s %8s %12s" % ("service", "running", "pending", "deployments"))
+        for desc in services[:MAX_SERVICE_ROWS]:
+            lines.append("%-40s %4d/%-4d %8d %12d%s" % (
+                desc['serviceName'][:40], desc['runningCount'], desc['desiredCount'],
+                desc.get('pendingCount', 0), len(desc.get('deployments', [])),
+                "" if service_settled(desc) else "  *"))
+        if len(services) > MAX_SERVICE_ROWS:
+            lines.append("... %d more services" % (len(services) - MAX_SERVICE_ROWS))
+        return lines
+
+
+class RolloverTracker(object):
+    """
+    Event bus subscriber that keeps the phases in flight and the latest
+    messages, standing in for the regular renderer while the dashboard runs
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = collections.OrderedDict()
+        self.replacements = {}
+        self.messages = collections.deque(maxlen=RECENT_MESSAGES)
+
+    def __call__(self, record):
+        with self.lock:
+            event = record['event']
+            if event == 'phase_start':
+                self.phases[record['id']] = record
+                if record['phase'] == 'replacement_join':
+                    self.replacements[record['replacement']] = record
+            elif event == 'phase_end':
+                self.phases.pop(record['id'], None)
+                if record['phase'] == 'replacement_join':
+                    self.replacements.pop(record.get('replacement'), None)
+            elif event == 'message' and record['text']:
+                self.messages.append(record)
+
+    def render(self):
+        """
+        @return: list of lines describing the rollover
+        """
+        now = time.time()
+        with self.lock:
+            phases = list(self.phases.values())
+            replacements = list(self.replacements.values())
+            messages = list(self.messages)
+
+        lines = ["", "In progress:"]
+        for record in phases[-MAX_PHASE_ROWS:]:
+            lines.append("  %-20s %6ds  %s" % (record.get('instance', ''), now - record['ts'],
+                                                record['description']))
+        if not phases:
+            lines.append("  nothing")
+        if replacements:
+            lines.append("Replacements booting: %s" % (", ".join(
+                "%s (%ds)" % (r['replacement'], now - r['ts']) for r in replacements)))
+        lines.append("")
+        lines.append("Recent messages:")
+        for record in messages:
+            lines.append("  %s" % (record['text']))
+        return lines
+
+
+class Dashboard(object):
+    """
+    Redraws the cluster view (and the rollover, if tracked) every `interval`
+    seconds from a background thread
+    """
+    def __init__(self, view, tracker=None, interval=DEFAULT_INTERVAL, stream=sys.stdout):
+        self.view = view
+        self.tracker = tracker
+        self.interval = interval
+        self.stream = stream
+        self.stopped = threading.Event()
+        self.thread = None
+        self.error = None
+
+    def draw(self, clear=True):
+        lines = self.view.render()
+        if self.error:
+            lines.append("last refresh failed: %s" % (self.error))
+        if self.tracker:
+            lines += self.tracker.render()
+        self.stream.write("%s%s\n" % (CLEAR_SCREEN if clear else "", "\n".join(lines)))
+        self.stream.flush()
+
+    def run(self):
+        """
+        Refreshes and redraws until stop() is called
+        """
+        while not self.stopped.is_set():
+            try:
+                self.view.refresh()
+                self.error = None
+            except Exception as e:
+                # a failed refresh only leaves the view a tick behind
+                self.error = str(e)
+            self.draw()
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        # the refresh thread acts on behalf of the one starting it
+        region = aws.current_region()
+
+        def run():
+            with aws.region_context(region):
+                self.run()
+
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
@@ -0,0 +1,20 @@
+"""
+Default settings shared by the command line and the modules using them
+
+Kept free of imports beyond the standard library basics so that building
+the command line doesn't load the modules behind the commands.
+"""
+
+import os
+
+# where the durations of past phases are kept, see timings
+TIMING_DB = os.path.expanduser('~/.ecs-rollover/timings.sqlite')
+
+# seconds between the interruption notice and a spot instance being taken away
+SPOT_NOTICE = 120
+
+# seconds between heartbeats keeping a lifecycle action from timing out
+HEARTBEAT_INTERVAL = 60
+
+# seconds between redraws of the watch dashboard
+DASHBOARD_INTERVAL = 5
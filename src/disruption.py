@@ -0,0 +1,335 @@
+"""
+module for limiting how many instances are drained at once
+
+Every service may lose as many tasks at once as its deployment
+configuration allows: it has to keep minimumHealthyPercent of its desired
+count running. A de-registered instance's tasks stop counting towards the
+service right away, so maximumPercent, which only caps tasks started ahead
+of the ones they replace, doesn't come into it. An instance only starts
+draining once the tasks it would displace fit in what every one of its
+services has left to give.
+
+With --adaptive, a controller also adapts how many instances drain at once
+to how quickly the cluster places the tasks they displace.
+"""
+
+from contextlib import contextmanager
+import math
+import threading
+import time
+
+# local imports
+import aws
+import events
+
+# deployment configuration ECS uses for services that don't set one
+DEFAULT_MINIMUM_HEALTHY_PERCENT = 100
+
+# seconds between samples of the cluster while adapting the drains in flight
+CONTROL_INTERVAL = 15
+
+# smallest share of the cpu and memory of the active instances left free
+# for the controller to start more drains
+MIN_HEADROOM = 0.1
+
+# samples in a row with a growing backlog before the drains are halved
+BACKOFF_SAMPLES = 3
+
+
+def displaceable_tasks(service):
+    """
+    @param service: service description
+    @return: number of the service's tasks that can be stopped at once
+             without it falling below its healthy floor
+    """
+    config = service.get('deploymentConfiguration', {})
+    desired = service['desiredCount']
+    floor = int(math.ceil(desired * config.get('minimumHealthyPercent', DEFAULT_MINIMUM_HEALTHY_PERCENT) / 100.0))
+    return max(0, desired - floor)
+
+
+def service_budgets(service_descriptions):
+    """
+    @param service_descriptions: dictionary of service ids to descriptions
+    @return: dictionary of service ids to displaceable task counts
+    """
+    return dict((service_id, displaceable_tasks(desc)) for service_id, desc in service_descriptions.items())
+
+
+def fits(budgets, in_flight, demand):
+    """
+    @param budgets: dictionary of service ids to displaceable task counts
+    @param in_flight: dictionary of service ids to tasks already displaced
+    @param demand: dictionary of service ids to tasks an instance would displace
+    @return: true if the instance can start draining. A service nothing is
+             draining from yet always takes one instance, even one with more
+             of its tasks than it can spare, so that the rollover never stalls
+    """
+    for service_id, count in demand.items():
+        taken = in_flight.get(service_id, 0)
+        if taken and taken + count > budgets.get(service_id, 0):
+            return False
+    return True
+
+
+def max_concurrent(budgets, demands):
+    """
+    Greedily packs instances, in order, into drains that can run at once
+    @param budgets: dictionary of service ids to displaceable task counts
+    @param demands: list of per instance service task counts, in removal order
+    @return: number of instances in the first batch, the most that can be
+             drained at once at the start of the rollover
+    """
+    in_flight = {}
+    concurrent = 0
+    for demand in demands:
+        if not fits(budgets, in_flight, demand):
+            break
+        for service_id, count in demand.items():
+            in_flight[service_id] = in_flight.get(service_id, 0) + count
+        concurrent += 1
+    return concurrent
+
+
+class DisruptionBudget(object):
+    """
+    Admits instances to drain while their services can spare the tasks on
+    them. Safe to use from several threads.
+    """
+    def __init__(self, budgets):
+        self.budgets = budgets
+        self.in_flight = {}
+        self.condition = threading.Condition()
+
+    def acquire(self, ec2_id, demand):
+        """
+        Blocks until the instance's tasks can be displaced
+        @param ec2_id: ec2 id of the instance
+        @param demand: dictionary of service ids to task counts on the instance
+        """
+        with self.condition:
+            if not fits(self.budgets, self.in_flight, demand):
+                events.message("Waiting for other instances to finish draining before %s" % (ec2_id),
+                               instance=ec2_id)
+            while not fits(self.budgets, self.in_flight, demand):
+                self.condition.wait()
+            for service_id, count in demand.items():
+                self.in_flight[service_id] = self.in_flight.get(service_id, 0) + count
+
+    def release(self, ec2_id, demand):
+        with self.condition:
+            for service_id, count in demand.items():
+                self.in_flight[service_id] -= count
+                if not self.in_flight[service_id]:
+                    del self.in_flight[service_id]
+            self.condition.notify_all()
+
+    def update(self, ec2_id, held, demand):
+        """
+        Swaps the tasks held for an instance for a fresh count of them,
+        blocking until that count can be displaced too
+        @param ec2_id: ec2 id of the instance
+        @param held: dictionary given by hold(), updated in place
+        @param demand: dictionary of service ids to task counts on the instance
+        """
+        if demand == held:
+            return
+        self.release(ec2_id, held)
+        held.clear()
+        self.acquire(ec2_id, demand)
+        held.update(demand)
+
+    @contextmanager
+    def hold(self, ec2_id, demand):
+        """
+        Holds the budget for an instance while the block runs
+        @param ec2_id: ec2 id of the instance
+        @param demand: dictionary of service ids to task counts on the instance
+        @return: dictionary of the tasks held, to pass to update()
+        """
+        held = dict(demand)
+        self.acquire(ec2_id, held)
+        try:
+            yield held
+        finally:
+            self.release(ec2_id, held)
+
+
+class NullBudget(object):
+    """
+    Budget of a rollover that drains one instance at a time anyway
+    """
+    def update(self, ec2_id, held, demand):
+        pass
+
+    @contextmanager
+    def hold(self, ec2_id, demand):
+        yield dict(demand)
+
+
+def _free_share(instances, name):
+    registered = remaining = 0
+    for desc in instances:
+        for resource in desc['registeredResources']:
+            if resource['name'] == name:
+                registered += resource['integerValue']
+        for resource in desc['remainingResources']:
+            if resource['name'] == name:
+                remaining += resource['integerValue']
+    return float(remaining) / registered if registered else 0.0
+
+
+def cluster_pressure(services, instances):
+    """
+    @param services: list of service descriptions
+    @param instances: list of container instance descriptions
+    @return: dictionary with the `backlog` (tasks the services are short of
+             their desired counts), the `pending` tasks being placed and the
+             `headroom` (share of cpu or memory left on the active
+             instances, whichever is scarcer)
+    """
+    active = [desc for desc in instances if desc['status'] == 'ACTIVE']
+    return dict(backlog=sum(max(0, desc['desiredCount'] - desc['runningCount']) for desc in services),
+                pending=sum(desc.get('pendingCount', 0) for desc in services),
+                headroom=min(_free_share(active, 'CPU'), _free_share(active, 'MEMORY')))
+
+
+class DrainController(object):
+    """
+    Adapts how many instances drain at once to the cluster's backlog. It
+    starts with `minimum` drains and adds one after every sample that finds
+    the backlog shrinking (or empty) while every drain is in use. It halves
+    them when the backlog keeps growing or the active instances run out of
+    room. Safe to use from several threads.
+    """
+    def __init__(self, view, maximum, minimum=1, interval=CONTROL_INTERVAL):
+        """
+        @param view: dashboard.ClusterView the samples are taken from
+        @param maximum: most instances drained at once (--parallel)
+        @param minimum: fewest instances drained at once
+        @param interval: seconds between samples
+        """
+        self.view = view
+        self.maximum = maximum
+        self.minimum = minimum
+        self.interval = interval
+        self.limit = minimum
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.previous_backlog = None
+        self.growing = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def update(self, pressure):
+        """
+        Adapts the limit to a sample of the cluster
+        @param pressure: dictionary as returned by cluster_pressure()
+        @return: the new limit
+        """
+        with self.condition:
+            backlog = pressure['backlog']
+            previous, self.previous_backlog = self.previous_backlog, backlog
+            self.growing = self.growing + 1 if previous is not None and backlog > previous else 0
+
+            limit = self.limit
+            if pressure['headroom'] < MIN_HEADROOM:
+                limit = max(self.minimum, limit // 2)
+                reason = "%d%% of the cluster's cpu or memory left" % (pressure['headroom'] * 100)
+            elif self.growing >= BACKOFF_SAMPLES:
+                limit = max(self.minimum, limit // 2)
+                reason = "backlog grew to %d tasks" % (backlog)
+                self.growing = 0
+            elif (backlog == 0 or (previous is not None and backlog < previous)) and self.in_flight >= limit:
+                # only worth raising while every drain is in use
+                limit = min(self.maximum, limit + 1)
+                reason = "backlog of %d tasks being absorbed" % (backlog)
+
+            if limit != self.limit:
+                events.message("Draining up to %d instances at once, was %d: %s" % (limit, self.limit, reason))
+                events.emit('drain_limit', limit=limit, previous=self.limit, **pressure)
+                self.limit = limit
+                self.condition.notify_all()
+            return self.limit
+
+    def sample(self):
+        """
+        Refreshes the view unless someone else (ex. the dashboard) just did,
+        and adapts the limit to it
+        """
+        if self.view.refreshed_at is None or time.time() - self.view.refreshed_at >= self.interval:
+            self.view.refresh()
+        with self.view.lock:
+            services = list(self.view.services.values())
+            instances = list(self.view.instances.values())
+        self.update(cluster_pressure(services, instances))
+
+    def run(self):
+        """
+        Samples the cluster until stop() is called
+        """
+        while not self.stopped.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                # the limit stays where it was until the next sample
+                events.message("WARNING: failed to sample the cluster: %s" % (e), level='warning')
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        # the sampling thread acts on behalf of the one starting it
+        region = aws.current_region()
+        event_context = events.current_context()
+
+        def run():
+            with aws.region_context(region), events.context(**event_context):
+                self.run()
+
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def acquire(self, ec2_id):
+        """
+        Blocks until fewer instances than the limit are draining
+        @param ec2_id: ec2 id of the instance
+        """
+        with self.condition:
+            if self.in_flight >= self.limit:
+                events.message("Waiting for the cluster to absorb the drains in flight before %s" % (ec2_id),
+                               instance=ec2_id)
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, ec2_id):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def hold(self, ec2_id):
+        """
+        Holds a drain slot for an instance while the block runs
+        @param ec2_id: ec2 id of the instance
+        """
+        self.acquire(ec2_id)
+        try:
+            yield
+        finally:
+            self.release(ec2_id)
+
+
+class NullController(object):
+    """
+    Controller of a rollover that drains as many instances as --parallel
+    allows
+    """
+    @contextmanager
+    def hold(self, ec2_id):
+        yield
@@ -0,0 +1,83 @@
+"""
+module for draining an instance from its load balancers
+"""
+
+# local imports
+import alb
+import elb
+import eventloop
+import events
+
+
+def service_load_balancers(service_ids, service_descriptions):
+    """
+    Collects the load balancers used by the given services
+    @param service_ids: list of service ids
+    @param service_descriptions: dictionary of service ids to descriptions
+    @return: tuple of (list of elb names, list of target group arns)
+    """
+    elb_names = set()
+    target_group_arns = set()
+    for service_id in service_ids:
+        for balancer in service_descriptions[service_id].get('loadBalancers', []):
+            if 'loadBalancerName' in balancer:
+                elb_names.add(balancer['loadBalancerName'])
+            elif 'targetGroupArn' in balancer:
+                target_group_arns.add(balancer['targetGroupArn'])
+    return sorted(elb_names), sorted(target_group_arns)
+
+
+def _drain_elb(ec2_id, elb_name, timeout, poll_interval):
+    with events.phase('lb_drain', "Draining from %s" % (elb_name),
+                      instance=ec2_id, load_balancer=elb_name) as result:
+        elb_client = elb.ELBClient(elb_name)
+        yield eventloop.call(elb_client.deregister_instances, [ec2_id])
+        drained = yield elb_client.wait_for_drained_async([ec2_id], timeout, poll_interval)
+        if not drained:
+            result['outcome'] = 'failed'
+    raise eventloop.Return(result['outcome'] == 'ok')
+
+
+def _drain_target_group(ec2_id, target_group_arn, timeout, poll_interval):
+    with events.phase('lb_drain', "Draining from target_group %s" % (target_group_arn),
+                      instance=ec2_id, target_group=target_group_arn) as result:
+        # the target group is used directly, the account wide ALB cache isn't needed
+        alb_group = alb.ALBGroup(target_group_arn, [], [])
+        targets = yield eventloop.call(alb_group.deregister_instance, ec2_id)
+        drained = yield alb_group.wait_for_drained_async(targets, timeout, poll_interval)
+        if not drained:
+            result['outcome'] = 'failed'
+    raise eventloop.Return(result['outcome'] == 'ok')
+
+
+def drain_instance(ec2_id, elb_names, target_group_arns, timeout,
+                   poll_interval=alb.DRAIN_POLL_INTERVAL):
+    """
+    Deregisters an instance from every load balancer in parallel and waits
+    for their connections to drain
+    @param ec2_id: ec2 instance id
+    @param elb_names: list of elb names
+    @param target_group_arns: list of alb target group arns
+    @param timeout: seconds to wait for each balancer
+    @param poll_interval: seconds between checks
+    @return: list of elb names and target group arns that did not drain in time
+    """
+    jobs = [(_drain_elb, name) for name in elb_names]
+    jobs += [(_drain_target_group, arn) for arn in target_group_arns]
+    if not jobs:
+        return []
+
+    def run(job):
+        drain, balancer = job
+        try:
+            drained = yield drain(ec2_id, balancer, timeout, poll_interval)
+        except Exception as e:
+            events.message("ERROR: failed to drain from %s: %s" % (balancer, e),
+                           level='error', instance=ec2_id)
+            drained = False
+        raise eventloop.Return(None if drained else balancer)
+
+    # every balancer is polled from this thread, only the calls themselves
+    # use call threads
+    results = eventloop.run([run(job) for job in jobs], len(jobs))
+    return [balancer for balancer in results if balancer]
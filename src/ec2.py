@@ -4,21 +4,29 @@
 module for interacting with EC2
 """
 
-import boto3
+# local imports
+import aws
+import snapshot
 
 
 class EC2Client(object):
     """
     Client for interacting with EC2
     """
-    def __init__(self):
-        self.client = boto3.client('ec2')
+    def __init__(self, cache=None):
+        self.client = aws.client('ec2')
+        self.cache = cache or snapshot.NullCache()
 
-    def describe_instances(self, ec2_ids):
+    def describe_instances(self, ec2_ids, cached=True):
         """
         @param ec2_ids: list of ec2 instance ids
+        @param cached: if false, skip the snapshot cache
         @return: dictionary of ec2 instance ids to description dicts
         """
+        return self.cache.lookup('ec2_instances', ec2_ids,
+                                 self._describe_instances, cached)
+
+    def _describe_instances(self, ec2_ids):
         instances = {}
 
         paginator = self.client.get_paginator('describe_instances')
@@ -41,6 +49,7 @@ class EC2Client(object):
         """
         @param ec2_ids: list of ec2 instance ids
         """
+        self.cache.invalidate()
         self.client.stop_instances(DryRun=False, InstanceIds=ec2_ids)
 
     def terminate_and_wait_for_instances(self, ec2_ids):
@@ -54,6 +63,7 @@ class EC2Client(object):
         """
         @param ec2_ids: list of ec2 instance ids
         """
+        self.cache.invalidate()
         self.client.terminate_instances(DryRun=False, InstanceIds=ec2_ids)
 
     def wait_for_stopped(self, ec2_ids):
@@ -71,12 +81,17 @@ class EC2Client(object):
         waiter.wait(DryRun=False, InstanceIds=ec2_ids)
 
 
+
 def main_stop(args):
     """
     Main entry point for the ec2-stop command
     """
     ec2_client = EC2Client()
-    return ec2_client.stop_and_wait_for_instances(args.ec2_id)
+    try:
+        return ec2_client.stop_and_wait_for_instances(args.ec2_id)
+    finally:
+        # the instances may be in any cluster's snapshot
+        snapshot.invalidate()
 
 
 def main_terminate(args):
@@ -84,4 +99,8 @@ def main_terminate(args):
     Main entry point for the ec2-terminate command
     """
     ec2_client = EC2Client()
-    return ec2_client.terminate_and_wait_for_instances(args.ec2_id)
+    try:
+        return ec2_client.terminate_and_wait_for_instances(args.ec2_id)
+    finally:
+        # the instances may be in any cluster's snapshot
+        snapshot.invalidate()
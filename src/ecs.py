@@ -2,12 +2,21 @@
 module for interacting with ECS
 """
 
-import boto3
 import time
 
 # local imports
+import aws
+import eventloop
+import events
+import snapshot
 import utils
 
+# ids the describe APIs accept per call
+DESCRIBE_BATCH_SIZE = 10
+
+# describe calls of one lookup in flight at once
+DESCRIBE_CONCURRENCY = 8
+
 
 class ECSError(Exception):
     """ECS API Error"""
@@ -16,73 +25,118 @@ class ECSError(Exception):
         Exception.__init__(self, err)
 
 
+def _check_failures(resp):
+    """
+    raises ECSError for the first failure of a describe call
+    """
+    for failure in resp.get('failures', []):
+        raise ECSError(failure.get('arn'), failure.get('reason'))
+
+
 class ECSClient(object):
     """
     Client for interacting with ECS
     """
-    def __init__(self, cluster):
-        self.client = boto3.client('ecs')
+    def __init__(self, cluster, cache=None):
+        self.client = aws.client('ecs')
         self.cluster = cluster
+        self.cache = cache or snapshot.NullCache()
 
-    def describe_instances(self, instance_ids):
+    def describe_instances(self, instance_ids, cached=True):
         """
         @param instance_ids: list of ecs instance ids
+        @param cached: if false, skip the snapshot cache
         @return: dictionary of ecs instance ids to description dicts
         """
-        info = {}
+        return self.cache.lookup('container_instances', instance_ids,
+                                 self._describe_instances, cached)
 
-        # API is limited to 10 at a time
-        for batch in utils.batch_list(10, instance_ids):
+    def _describe_instances(self, instance_ids):
+        return dict(self._iter_describe_instances(instance_ids))
+
+    def _iter_describe_instances(self, instance_ids):
+        def describe(batch):
             resp = self.client.describe_container_instances(cluster=self.cluster,
                                                             containerInstances=batch)
-            if resp.get('failures'):
-                raise ECSError(resp['arn'], resp['reason'])
-
-            for instance in resp['containerInstances']:
-                instance_id = utils.pull_instance_id(instance['containerInstanceArn'])
-                info[instance_id] = instance
+            _check_failures(resp)
+            return resp['containerInstances']
 
-        return info
+        for instances in utils.imap_batches(describe, DESCRIBE_BATCH_SIZE, instance_ids, DESCRIBE_CONCURRENCY):
+            for instance in instances:
+                yield utils.pull_instance_id(instance['containerInstanceArn']), instance
 
-    def describe_services(self, service_ids):
+    def describe_services(self, service_ids, cached=True):
         """
         @param service_ids: list of ecs service ids
+        @param cached: if false, skip the snapshot cache
         @return: dictionary of ecs service ids to description dicts
         """
-        info = {}
+        return self.cache.lookup('services', service_ids,
+                                 self._describe_services, cached)
+
+    def _describe_services(self, service_ids):
+        return dict(self._iter_describe_services(service_ids))
 
-        # API is limited to 10 at a time
-        for batch in utils.batch_list(10, service_ids):
+    def _iter_describe_services(self, service_ids):
+        def describe(batch):
             resp = self.client.describe_services(cluster=self.cluster,
                                                  services=batch)
-            if resp.get('failures'):
-                raise ECSError(resp['arn'], resp['reason'])
+            _check_failures(resp)
+            return resp['services']
 
-            for service in resp['services']:
-                service_id = utils.pull_service_id(service['serviceArn'])
-                info[service_id] = service
+        for services in utils.imap_batches(describe, DESCRIBE_BATCH_SIZE, service_ids, DESCRIBE_CONCURRENCY):
+            for service in services:
+                yield utils.pull_service_id(service['serviceArn']), service
 
-        return info
-
-    def describe_tasks(self, task_arns):
+    def describe_tasks(self, task_arns, cached=True):
         """
         @param task_arns: list of ecs task arns
+        @param cached: if false, skip the snapshot cache
         @return: dictionary of ecs task arns to descriptions dicts
         """
-        info = {}
+        return self.cache.lookup('tasks', task_arns,
+                                 self._describe_tasks, cached)
+
+    def iter_describe_tasks(self, task_arns, cached=True):
+        """
+        Like describe_tasks(), but yields the tasks as their batches come
+        back so that callers can start on them before the last one does
+        @param task_arns: list of ecs task arns
+        @param cached: if false, skip the snapshot cache
+        @return: generator of (task arn, description dict) pairs
+        """
+        return self.cache.stream('tasks', task_arns,
+                                 self._iter_describe_tasks, cached)
+
+    def _describe_tasks(self, task_arns):
+        return dict(self._iter_describe_tasks(task_arns))
 
-        # API is limited to 10 at a time
-        for batch in utils.batch_list(10, task_arns):
+    def _iter_describe_tasks(self, task_arns):
+        def describe(batch):
             resp = self.client.describe_tasks(cluster=self.cluster,
                                               tasks=batch)
-            if resp.get('failures'):
-                raise ECSError(resp['arn'], resp['reason'])
+            _check_failures(resp)
+            return resp['tasks']
+
+        for tasks in utils.imap_batches(describe, DESCRIBE_BATCH_SIZE, task_arns, DESCRIBE_CONCURRENCY):
+            for task in tasks:
+                yield task['taskArn'], task
+
+    def describe_task_definitions(self, task_definition_arns, cached=True):
+        """
+        @param task_definition_arns: list of ecs task definition arns
+        @param cached: if false, skip the snapshot cache
+        @return: dictionary of task definition arns to description dicts
+        """
+        return self.cache.lookup('task_definitions', task_definition_arns,
+                                 self._describe_task_definitions, cached)
 
-            for task in resp['tasks']:
-                task_arn = task['taskArn']
-                info[task_arn] = task
+    def _describe_task_definitions(self, task_definition_arns):
+        # API only describes one task definition at a time
+        def describe(batch):
+            return batch[0], self.client.describe_task_definition(taskDefinition=batch[0])['taskDefinition']
 
-        return info
+        return dict(utils.imap_batches(describe, 1, task_definition_arns, DESCRIBE_CONCURRENCY))
 
     def deregister_container_instance(self, instance_id):
         """
@@ -90,14 +144,32 @@ class ECSClient(object):
         """
         # NOTE: force=True is used so that the task become orphaned and get
         #       rescheduled across the cluster
+        self.cache.invalidate()
         self.client.deregister_container_instance(cluster=self.cluster,
                                                   containerInstance=instance_id,
                                                   force=True)
 
-    def list_container_instances(self):
+    def set_draining(self, instance_ids):
+        """
+        Has ECS move the service tasks off instances: replacements are started
+        elsewhere within the services' deployment configurations before the
+        tasks on the instances are stopped
+        @param instance_ids: list of ecs instance ids
+        """
+        self.cache.invalidate()
+        self.client.update_container_instances_state(cluster=self.cluster,
+                                                     containerInstances=instance_ids,
+                                                     status='DRAINING')
+
+    def list_container_instances(self, cached=True):
         """
+        @param cached: if false, skip the snapshot cache
         @return: list of ecs instance ids
         """
+        return self.cache.value('container_instance_list', self.cluster,
+                                self._list_container_instances, cached)
+
+    def _list_container_instances(self):
         arns = []
 
         paginator = self.client.get_paginator('list_container_instances')
@@ -109,18 +181,24 @@ class ECSClient(object):
         """
         @return: list of ec2 ids in the cluster
         """
-        ecs_ids = self.list_container_instances()
-        ecs_descriptions = self.describe_instances(ecs_ids)
+        # used for polling, so always go to ECS
+        ecs_ids = self.list_container_instances(cached=False)
+        ecs_descriptions = self.describe_instances(ecs_ids, cached=False)
         active_instances = []
         for desc in ecs_descriptions.values():
             if desc['agentConnected'] and desc['status'] == 'ACTIVE':
                 active_instances.append(desc['ec2InstanceId'])
         return active_instances
 
-    def list_services(self):
+    def list_services(self, cached=True):
         """
+        @param cached: if false, skip the snapshot cache
         @return: list of ecs service ids
         """
+        return self.cache.value('service_list', self.cluster,
+                                self._list_services, cached)
+
+    def _list_services(self):
         service_arns = []
 
         paginator = self.client.get_paginator('list_services')
@@ -128,36 +206,108 @@ class ECSClient(object):
             service_arns += resp['serviceArns']
         return [utils.pull_service_id(arn) for arn in service_arns]
 
-    def list_tasks(self):
+    def list_tasks(self, family=None, cached=True):
         """
+        @param family: optional task definition family to filter by
+        @param cached: if false, skip the snapshot cache
         @return: list of ecs task arns
         """
+        return self.cache.value('task_list', family or '',
+                                lambda: self._list_tasks(family), cached)
+
+    def _list_tasks(self, family):
         task_arns = []
+        kwargs = dict(cluster=self.cluster)
+        if family:
+            kwargs['family'] = family
 
         paginator = self.client.get_paginator('list_tasks')
-        for resp in paginator.paginate(cluster=self.cluster):
+        for resp in paginator.paginate(**kwargs):
+            task_arns += resp['taskArns']
+        return task_arns
+
+    def list_instance_tasks(self, instance_id):
+        """
+        @param instance_id: single ecs instance id
+        @return: list of arns of the tasks on the instance
+        """
+        # only used right before acting on the instance, so always go to ECS
+        task_arns = []
+        paginator = self.client.get_paginator('list_tasks')
+        for resp in paginator.paginate(cluster=self.cluster, containerInstance=instance_id):
             task_arns += resp['taskArns']
         return task_arns
 
-    def wait_for_service_steady_state(self, service_id, last_event):
+    def list_task_definition_families(self, prefix=None, cached=True):
+        """
+        @param prefix: optional family name prefix to filter by
+        @param cached: if false, skip the snapshot cache
+        @return: list of task definition family names
+        """
+        return self.cache.value('task_definition_families', prefix or '',
+                                lambda: self._list_task_definition_families(prefix),
+                                cached)
+
+    def _list_task_definition_families(self, prefix):
+        families = []
+        kwargs = {}
+        if prefix:
+            kwargs['familyPrefix'] = prefix
+
+        paginator = self.client.get_paginator('list_task_definition_families')
+        for resp in paginator.paginate(**kwargs):
+            families += resp['families']
+        return families
+
+    def wait_for_service_steady_state(self, service_id, since, cursors, timeout=600, poll_interval=10,
+                                      straggler_after=None):
         """
-        Blocks until the event stream shows a steady state message. Events
-        before last_event are filtered out. Times out after 60sec
+        Blocks until the event stream shows a steady state message newer than
+        `since`. Times out after `timeout` seconds
         @param service_id: ecs service id
-        @param last_event: the last seen event from the ecs service
+        @param since: cursor of the service before the change being waited on
+        @param cursors: eventcursors.EventCursors the events are ingested into
+        @param timeout: seconds to wait
+        @param poll_interval: seconds between checks
+        @param straggler_after: optional seconds after which a warning is
+                                printed that the service is slower than usual
+        @return: true if the service reached steady state
         """
         # ECS can be a little slow. replacing services can take several minutes
-        TIMEOUT = 600
         started = time.time()
-        last_seen = last_event
-        while time.time() - started < TIMEOUT:
-            service_desc = self.describe_services([service_id])[service_id]
-            for event in service_desc['events']:
-                if event['createdAt'] > last_seen['createdAt']:
-                    last_seen = event
-                if event['createdAt'] > last_event['createdAt']:
-                    if "has reached a steady state" in event['message']:
-                        return True, event
-            time.sleep(10)
-
-        return False, last_seen
+        warned = False
+        while time.time() - started < timeout:
+            service_desc = self.describe_services([service_id], cached=False)[service_id]
+            cursors.ingest(service_id, service_desc['events'])
+            if cursors.steady_state_since(service_id, since):
+                return True
+            if straggler_after and not warned and time.time() - started > straggler_after:
+                _warn_straggler(service_id, straggler_after)
+                warned = True
+            time.sleep(poll_interval)
+
+        return False
+
+    def wait_for_service_steady_state_async(self, service_id, since, cursors, timeout=600, poll_interval=10,
+                                            straggler_after=None):
+        """
+        Coroutine version of wait_for_service_steady_state(), see eventloop
+        """
+        started = time.time()
+        warned = False
+        while time.time() - started < timeout:
+            descriptions = yield eventloop.call(self.describe_services, [service_id], cached=False)
+            cursors.ingest(service_id, descriptions[service_id]['events'])
+            if cursors.steady_state_since(service_id, since):
+                raise eventloop.Return(True)
+            if straggler_after and not warned and time.time() - started > straggler_after:
+                _warn_straggler(service_id, straggler_after)
+                warned = True
+            yield eventloop.sleep(poll_interval)
+
+        raise eventloop.Return(False)
+
+
+def _warn_straggler(service_id, straggler_after):
+    events.message("WARNING: %s is taking longer than usual (%ds) to reach steady state" % (service_id, straggler_after),
+                   level='warning', service=service_id)
@@ -3,8 +3,16 @@
 module for interacting with Elastic Load Balancers (ELBs)
 """
 
-import boto3
-import sys
+import time
+
+# local imports
+import aws
+import eventloop
+import events
+import snapshot
+
+# seconds between instance health checks while draining
+DRAIN_POLL_INTERVAL = 5
 
 
 def load_balancers_with_instance(ec2_id):
@@ -13,7 +21,7 @@ def load_balancers_with_instance(ec2_id):
     @return: list of elb names with the ec2 instance attached
     """
     elbs = []
-    client = boto3.client('elb')
+    client = aws.client('elb')
     paginator = client.get_paginator('describe_load_balancers')
     for resp in paginator.paginate():
         for elb in resp['LoadBalancerDescriptions']:
@@ -30,7 +38,7 @@ class ELBClient(object):
     """
     def __init__(self, elb_name):
         self.elb_name = elb_name
-        self.client = boto3.client('elb')
+        self.client = aws.client('elb')
 
     def deregister_instances(self, instance_ids):
         """
@@ -42,6 +50,47 @@ class ELBClient(object):
                                                                    Instances=elb_instances)
         return [i['InstanceId'] for i in resp['Instances']]
 
+    def wait_for_drained(self, instance_ids, timeout, poll_interval=DRAIN_POLL_INTERVAL):
+        """
+        blocks until connection draining finished for the instances
+        @param instance_ids: list of deregistered ec2 instance ids
+        @param timeout: seconds to wait
+        @param poll_interval: seconds between checks
+        @return: true if drained, false if timed out
+        """
+        started = time.time()
+        while True:
+            if self.drained(instance_ids):
+                return True
+            if time.time() - started > timeout:
+                return False
+            time.sleep(poll_interval)
+
+    def wait_for_drained_async(self, instance_ids, timeout, poll_interval=DRAIN_POLL_INTERVAL):
+        """
+        Coroutine version of wait_for_drained(), see eventloop
+        """
+        started = time.time()
+        while True:
+            drained = yield eventloop.call(self.drained, instance_ids)
+            if drained:
+                raise eventloop.Return(True)
+            if time.time() - started > timeout:
+                raise eventloop.Return(False)
+            yield eventloop.sleep(poll_interval)
+
+    def drained(self, instance_ids):
+        """
+        @param instance_ids: list of deregistered ec2 instance ids
+        @return: true if none of the instances has connections left
+        """
+        # without an instance filter only registered instances are listed,
+        # draining ones stay InService until their connections are closed
+        resp = self.client.describe_instance_health(LoadBalancerName=self.elb_name)
+        draining = [s for s in resp['InstanceStates']
+                    if s['InstanceId'] in instance_ids and s['State'] != 'OutOfService']
+        return not draining
+
 
 def main_detach(args):
     """
@@ -54,8 +103,12 @@ def main_detach(args):
         load_balancers = load_balancers_with_instance(args.ec2_id)
 
     for load_balancer in load_balancers:
-        sys.stdout.write("Detaching from %s ..." % (load_balancer))
-        sys.stdout.flush()
-        elb_client = ELBClient(load_balancer)
-        elb_client.deregister_instances([args.ec2_id])
-        print "done"
+        with events.phase('elb_detach',
+                          "Detaching from %s" % (load_balancer),
+                          instance=args.ec2_id,
+                          load_balancer=load_balancer):
+            elb_client = ELBClient(load_balancer)
+            elb_client.deregister_instances([args.ec2_id])
+    # the instance may be in any cluster's snapshot
+    snapshot.invalidate()
+    return True
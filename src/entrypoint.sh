@@ -9,4 +9,4 @@ mkdir -p ~/.aws
 echo "[default]" > ~/.aws/config
 echo "region=$AWS_REGION" >> ~/.aws/config
 
-exec /usr/local/bin/python -B /opt/ecs-rollover/rollover.py $@
+exec /usr/local/bin/python -B /opt/ecs-rollover/cli.py $@
@@ -0,0 +1,103 @@
+"""
+module for following the event streams of ECS services
+
+ECS returns the latest events of a service with every description. The
+store keeps, per service, a cursor at the newest event seen and a bounded
+history, so each description only costs the events that are new since the
+last one, and "did anything happen since X" is a single comparison.
+"""
+
+import collections
+from operator import itemgetter
+import threading
+
+# events kept per service, as many as ECS returns with a description
+DEFAULT_HISTORY = 100
+
+STEADY_STATE_MESSAGE = "has reached a steady state"
+
+
+class EventCursors(object):
+    """
+    Newest event seen and recent history of each service. Safe to use from
+    several threads.
+    """
+    def __init__(self, history=DEFAULT_HISTORY):
+        self.history = history
+        self.lock = threading.Lock()
+        # service id to createdAt of the newest event seen
+        self.cursors = {}
+        # service id to ids of the events seen at the cursor, events can
+        # share a timestamp
+        self.at_cursor = {}
+        # service id to deque of events, oldest first
+        self.events = {}
+
+    def ingest(self, service_id, service_events):
+        """
+        @param service_id: ecs service id
+        @param service_events: events of a service description, in any order
+        @return: list of the events not seen before, oldest first
+        """
+        with self.lock:
+            cursor = self.cursors.get(service_id)
+            at_cursor = self.at_cursor.get(service_id, set())
+            new = [e for e in service_events
+                   if cursor is None or e['createdAt'] > cursor or
+                   (e['createdAt'] == cursor and e['id'] not in at_cursor)]
+            if not new:
+                return []
+            new.sort(key=itemgetter('createdAt'))
+
+            history = self.events.setdefault(service_id, collections.deque(maxlen=self.history))
+            history.extend(new)
+            newest = new[-1]['createdAt']
+            if newest != cursor:
+                at_cursor = set()
+            at_cursor.update(e['id'] for e in new if e['createdAt'] == newest)
+            self.cursors[service_id] = newest
+            self.at_cursor[service_id] = at_cursor
+            return new
+
+    def cursor(self, service_id):
+        """
+        @return: createdAt of the newest event seen for the service, or None
+        """
+        with self.lock:
+            return self.cursors.get(service_id)
+
+    def changed_since(self, service_id, since):
+        """
+        @param since: a cursor, as returned by cursor()
+        @return: true if any event newer than `since` was seen
+        """
+        with self.lock:
+            cursor = self.cursors.get(service_id)
+        return cursor is not None and (since is None or cursor > since)
+
+    def events_since(self, service_id, since):
+        """
+        @param since: a cursor, as returned by cursor()
+        @return: list of the events newer than `since` still in the history,
+                 oldest first
+        """
+        if not self.changed_since(service_id, since):
+            return []
+        newer = []
+        with self.lock:
+            for event in reversed(self.events.get(service_id, [])):
+                if since is not None and event['createdAt'] <= since:
+                    break
+                newer.append(event)
+        newer.reverse()
+        return newer
+
+    def steady_state_since(self, service_id, since):
+        """
+        @param since: a cursor, as returned by cursor()
+        @return: the first steady state event newer than `since`, or None
+        """
+        for event in self.events_since(service_id, since):
+            if STEADY_STATE_MESSAGE in event['message']:
+                return event
+        return None
@@ -0,0 +1,320 @@
+"""
+module for waiting on many AWS operations at once from a single thread
+
+There is no asyncio in python 2 and boto3 only makes blocking calls, so the
+loop runs coroutines written as generators. A coroutine yields what it
+waits on: a future from call() or sleep(), another coroutine, or a list of
+them, and is resumed with the result (a list of results for a list). It
+finishes with `raise Return(value)`. Client calls run on a small pool of
+call threads while the waits between polls are timers on the loop, so
+hundreds of polls can be in flight without a thread each.
+
+    def wait_for_service(ecs_client, service_id):
+        desc = yield eventloop.call(ecs_client.describe_services, [service_id], cached=False)
+        yield eventloop.sleep(10)
+        raise eventloop.Return(desc)
+
+    results = eventloop.run([wait_for_service(...), wait_for_service(...)])
+"""
+
+import collections
+import heapq
+import itertools
+from multiprocessing.pool import ThreadPool
+import Queue
+import sys
+import threading
+import time
+
+# local imports
+import aws
+import events
+
+# threads making client calls for the coroutines of a loop
+DEFAULT_CALL_WORKERS = 10
+
+# longest single wait for a call to finish
+IDLE_TIMEOUT = 60
+
+# loop running in each thread, see current_loop()
+_local = threading.local()
+
+
+class Return(BaseException):
+    """
+    Raised by a coroutine to finish with a value. Not an Exception, so that
+    `except Exception` blocks (ex. events.phase()) let it through.
+    """
+    def __init__(self, value=None):
+        BaseException.__init__(self)
+        self.value = value
+
+
+class Future(object):
+    """
+    Result of an operation that finishes later. Only completed from the
+    loop's thread.
+    """
+    def __init__(self):
+        self.finished = False
+        self.value = None
+        self.exc_info = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def result(self):
+        """
+        @return: the value, or raises the exception, of a finished operation
+        """
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def add_done_callback(self, callback):
+        if self.finished:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def _finish(self, value=None, exc_info=None):
+        self.finished = True
+        self.value = value
+        self.exc_info = exc_info
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, value):
+        self._finish(value=value)
+
+    def set_exception(self, exc_info):
+        """
+        @param exc_info: sys.exc_info() of the failure
+        """
+        self._finish(exc_info=exc_info)
+
+
+class Task(Future):
+    """
+    Runs a coroutine on a loop, in the region and event context it was
+    started from
+    """
+    def __init__(self, loop, coroutine):
+        Future.__init__(self)
+        self.loop = loop
+        self.coroutine = coroutine
+        self.region = aws.current_region()
+        self.event_context = events.current_context()
+
+    def step(self, value=None, exc_info=None):
+        with aws.region_context(self.region), events.context(**self.event_context):
+            try:
+                if exc_info:
+                    waiting_on = self.coroutine.throw(*exc_info)
+                else:
+                    waiting_on = self.coroutine.send(value)
+            except StopIteration:
+                self.set_result(None)
+                return
+            except Return as e:
+                self.set_result(e.value)
+                return
+            except Exception:
+                self.set_exception(sys.exc_info())
+                return
+
+        if isinstance(waiting_on, (list, tuple)):
+            waiting_on = self.loop.gather(waiting_on)
+        elif hasattr(waiting_on, 'send'):
+            waiting_on = self.loop.spawn(waiting_on)
+        waiting_on.add_done_callback(self._wake)
+
+    def _wake(self, future):
+        if future.exc_info:
+            self.loop.soon(self.step, None, future.exc_info)
+        else:
+            self.loop.soon(self.step, future.value)
+
+
+class Loop(object):
+    """
+    Runs coroutines until they finish. Not thread safe: coroutines are
+    started and run from a single thread.
+    """
+    def __init__(self, workers=DEFAULT_CALL_WORKERS):
+        self.workers = workers
+        self.pool = None
+        self.ready = collections.deque()
+        # heap of (due time, sequence number, future)
+        self.timers = []
+        self.sequence = itertools.count()
+        # (future, value, exc_info) of client calls finished by the pool
+        self.completed = Queue.Queue()
+        self.pending_calls = 0
+
+    def soon(self, callback, *args):
+        self.ready.append((callback, args))
+
+    def spawn(self, coroutine):
+        """
+        @param coroutine: generator to run
+        @return: Task, a future of the coroutine's value
+        """
+        task = Task(self, coroutine)
+        self.soon(task.step)
+        return task
+
+    def call(self, func, *args, **kwargs):
+        """
+        Runs a blocking function (ex. a client method) on a call thread
+        @return: future of its return value
+        """
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+        future = Future()
+        region = aws.current_region()
+        event_context = events.current_context()
+
+        def run():
+            with aws.region_context(region), events.context(**event_context):
+                try:
+                    self.completed.put((future, func(*args, **kwargs), None))
+                except Exception:
+                    self.completed.put((future, None, sys.exc_info()))
+
+        self.pending_calls += 1
+        self.pool.apply_async(run)
+        return future
+
+    def sleep(self, seconds):
+        """
+        @return: future finishing after `seconds`
+        """
+        future = Future()
+        heapq.heappush(self.timers, (time.time() + seconds, next(self.sequence), future))
+        return future
+
+    def gather(self, futures):
+        """
+        @param futures: list of futures and coroutines
+        @return: future of the list of their values. Fails with the first
+                 failure once all of them finished
+        """
+        futures = [self.spawn(f) if hasattr(f, 'send') else f for f in futures]
+        gathered = Future()
+        remaining = [len(futures)]
+
+        def finished(_):
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                failed = [f for f in futures if f.exc_info]
+                if failed:
+                    gathered.set_exception(failed[0].exc_info)
+                else:
+                    gathered.set_result([f.value for f in futures])
+
+        if not futures:
+            gathered.set_result([])
+        for future in futures:
+            future.add_done_callback(finished)
+        return gathered
+
+    def _run_once(self):
+        while self.ready:
+            callback, args = self.ready.popleft()
+            callback(*args)
+
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, future = heapq.heappop(self.timers)
+            future.set_result(None)
+        if self.ready:
+            return
+
+        # nothing to run until a call finishes or the next timer is due
+        timeout = self.timers[0][0] - now if self.timers else None
+        if not self.pending_calls:
+            if timeout is not None:
+                time.sleep(timeout)
+            return
+        try:
+            # always with a timeout, an untimed get() can't be interrupted
+            completion = self.completed.get(timeout=timeout if timeout is not None else IDLE_TIMEOUT)
+        except Queue.Empty:
+            return
+        while True:
+            future, value, exc_info = completion
+            self.pending_calls -= 1
+            if exc_info:
+                future.set_exception(exc_info)
+            else:
+                future.set_result(value)
+            try:
+                completion = self.completed.get_nowait()
+            except Queue.Empty:
+                break
+
+    def run_until_complete(self, future):
+        """
+        @param future: future or coroutine
+        @return: its value
+        """
+        if hasattr(future, 'send'):
+            future = self.spawn(future)
+        previous = getattr(_local, 'loop', None)
+        _local.loop = self
+        try:
+            while not future.done():
+                if not self.ready and not self.timers and not self.pending_calls:
+                    raise RuntimeError("nothing left to run, the future can't finish")
+                self._run_once()
+        finally:
+            _local.loop = previous
+        return future.result()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def current_loop():
+    """
+    @return: the loop running in this thread
+    """
+    loop = getattr(_local, 'loop', None)
+    if loop is None:
+        raise RuntimeError("no loop is running in this thread")
+    return loop
+
+
+def call(func, *args, **kwargs):
+    """
+    Runs a blocking function on a call thread of the current loop
+    @return: future of its return value
+    """
+    return current_loop().call(func, *args, **kwargs)
+
+
+def sleep(seconds):
+    """
+    @return: future of the current loop finishing after `seconds`
+    """
+    return current_loop().sleep(seconds)
+
+
+def run(coroutines, workers=DEFAULT_CALL_WORKERS):
+    """
+    Runs coroutines on a new loop until all of them finished
+    @param coroutines: list of generators
+    @param workers: threads making client calls
+    @return: list of their values
+    """
+    loop = Loop(workers)
+    try:
+        return loop.run_until_complete(loop.gather(coroutines))
+    finally:
+        loop.close()
@@ -0,0 +1,259 @@
+"""
+module for reporting progress as structured events
+
+Every record is a dictionary with at least a `ts` (unix time) and an `event`
+type. Records are handed to the subscribers of the bus, which either render
+them for humans or write them as JSON lines.
+"""
+
+from contextlib import contextmanager
+import itertools
+import json
+import sys
+import threading
+import time
+
+# local imports
+import aws
+
+LOG_FORMATS = ['text', 'json']
+
+# text printed by the human renderer for each phase outcome
+OUTCOME_TEXT = dict(
+    ok="done",
+    failed="FAILED",
+    skipped="skipped",
+    error="ERROR",
+)
+
+# records whose `text` the human renderer prints as a line of its own
+TEXT_EVENTS = ('message', 'check_task_host', 'check_task_summary')
+
+
+# fields added to every record emitted from a thread, see context()
+_local = threading.local()
+
+# key of current_context() carrying the API call counters of the thread, so
+# that threads acting on behalf of another count their calls for it too
+COUNTERS_KEY = '_api_counters'
+
+
+def _fields():
+    return dict(getattr(_local, 'context', {}))
+
+
+def current_context():
+    """
+    @return: dictionary of the fields set with context() in this thread, and
+             of its API call counters, to pass to context() in the threads
+             acting on its behalf
+    """
+    fields = _fields()
+    fields[COUNTERS_KEY] = aws.current_counters()
+    return fields
+
+
+@contextmanager
+def context(**fields):
+    """
+    Adds fields (ex. cluster=...) to every record emitted from this thread
+    """
+    counters = fields.pop(COUNTERS_KEY, ())
+    previous = _fields()
+    merged = dict(previous)
+    merged.update(fields)
+    _local.context = merged
+    try:
+        with aws.counting(counters):
+            yield
+    finally:
+        _local.context = previous
+
+
+class EventBus(object):
+    """
+    Fans event records out to subscribers. Safe to use from several threads.
+    """
+    def __init__(self):
+        # guards the list of subscribers only, see emit()
+        self.lock = threading.RLock()
+        self.subscribers = []
+        self.phase_ids = itertools.count(1)
+
+    def subscribe(self, subscriber):
+        """
+        @param subscriber: callable taking a record dictionary
+        """
+        with self.lock:
+            self.subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def clear(self):
+        with self.lock:
+            self.subscribers = []
+
+    def emit(self, event, **fields):
+        """
+        @param event: type of the record (ex. "phase_start")
+        @param fields: additional fields of the record
+        """
+        record = _fields()
+        record.update(fields)
+        record['ts'] = time.time()
+        record['event'] = event
+        # subscribers write to files, sockets and sqlite, so they are called
+        # without holding up the threads emitting at the same time
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber(record)
+
+    @contextmanager
+    def phase(self, phase, description, **fields):
+        """
+        Emits phase_start/phase_end records around a block. The block receives
+        a dictionary it can update with an `outcome` ("ok", "failed" or
+        "skipped") and any fields to add to the phase_end record.
+        @param phase: short name of the phase (ex. "deregister")
+        @param description: human readable description
+        """
+        phase_id = next(self.phase_ids)
+        started = time.time()
+        # calls made from other threads on behalf of this one count too, but
+        # not the calls of unrelated threads
+        calls = aws.CallCounter()
+        self.emit('phase_start', id=phase_id, phase=phase,
+                  description=description, **fields)
+
+        result = dict(outcome='ok')
+        try:
+            with aws.counting([calls]):
+                yield result
+        except Exception as e:
+            result.update(outcome='error', error=str(e))
+            raise
+        finally:
+            end_fields = dict(fields)
+            end_fields.update(result)
+            self.emit('phase_end', id=phase_id, phase=phase,
+                      description=description,
+                      duration=time.time() - started,
+                      api_calls=calls.calls,
+                      **end_fields)
+
+    def message(self, text, level='info', **fields):
+        """
+        @param text: human readable message
+        @param level: "info", "warning" or "error"
+        """
+        self.emit('message', text=text, level=level, **fields)
+
+
+class HumanRenderer(object):
+    """
+    Renders records the way the CLI has always printed progress:
+    "Doing something ...done"
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.open_phase = None
+        # records of several threads must not interleave on a line
+        self.lock = threading.Lock()
+
+    def _close_line(self):
+        if self.open_phase is not None:
+            self.stream.write("\n")
+            self.open_phase = None
+
+    def __call__(self, record):
+        with self.lock:
+            self._render(record)
+
+    def _render(self, record):
+        event = record['event']
+        # records from several clusters are told apart by a prefix
+        prefix = "[%s] " % (record['cluster']) if 'cluster' in record else ""
+        if event == 'phase_start':
+            self._close_line()
+            self.stream.write("%s%s ..." % (prefix, record['description']))
+            self.open_phase = record['id']
+        elif event == 'phase_end':
+            if self.open_phase != record['id']:
+                # another phase or message was printed in the meantime
+                self._close_line()
+                self.stream.write("%s%s ..." % (prefix, record['description']))
+            text = record.get('summary') or OUTCOME_TEXT.get(record['outcome'], record['outcome'])
+            self.stream.write("%s\n" % (text))
+            self.open_phase = None
+        elif event in TEXT_EVENTS:
+            self._close_line()
+            self.stream.write("%s%s\n" % (prefix, record['text']))
+        self.stream.flush()
+
+
+class JSONRenderer(object):
+    """
+    Writes every record as a single line of JSON
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str, sort_keys=True) + "\n"
+        with self.lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+BUS = EventBus()
+
+# subscriber of the global bus that writes progress out
+_renderer = HumanRenderer(sys.stdout)
+BUS.subscribe(_renderer)
+
+emit = BUS.emit
+phase = BUS.phase
+message = BUS.message
+
+
+def configure(log_format, stream=sys.stdout):
+    """
+    Replaces the renderer of the global bus
+    @param log_format: "text" or "json"
+    @param stream: file object to write to
+    """
+    global _renderer
+    BUS.clear()
+    if log_format == 'json':
+        _renderer = JSONRenderer(stream)
+    else:
+        _renderer = HumanRenderer(stream)
+    BUS.subscribe(_renderer)
+
+
+def set_renderer(renderer):
+    """
+    Swaps the renderer of the global bus, leaving its other subscribers
+    (ex. metrics) in place
+    @param renderer: subscriber taking over the output
+    @return: the previous renderer, to restore later
+    """
+    global _renderer
+    with BUS.lock:
+        previous = _renderer
+        BUS.unsubscribe(previous)
+        BUS.subscribe(renderer)
+        _renderer = renderer
+    return previous
+
+
+def emit_api_stats():
+    """
+    Emits the AWS API call counts collected so far
+    """
+    emit('api_stats', **aws.STATS.snapshot())
@@ -0,0 +1,154 @@
+"""
+module for getting instances out of service under a hard deadline, such as
+spot instances that received a two minute interruption notice
+"""
+
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+import dateutil.tz
+
+# local imports
+import defaults
+
+# seconds between the interruption notice and a spot instance being taken away
+SPOT_NOTICE = defaults.SPOT_NOTICE
+
+# seconds kept back at the end of the budget for the SSM round trip of the
+# docker stop
+SSM_MARGIN = 10
+
+# share of the budget load balancers get to drain connections
+LB_DRAIN_SHARE = 0.5
+
+# shortest docker stop timeout worth sending
+MIN_STOP_TIMEOUT = 2
+
+# seconds between checks while waiting under a deadline
+FAST_POLL_INTERVAL = 1
+
+
+class Deadline(object):
+    """
+    A time budget that every step of a fast drain takes its waits from
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.started = time.time()
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def remaining(self):
+        return max(0, self.seconds - self.elapsed())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def share(self, fraction):
+        """
+        @param fraction: part of the whole budget (0-1)
+        @return: seconds of the budget, bounded by what is left of it
+        """
+        return min(self.remaining(), self.seconds * fraction)
+
+
+class InstanceIndex(object):
+    """
+    Maps ec2 ids to container instance ids, only describing container
+    instances it hasn't seen before. Safe to use from several threads.
+    """
+    def __init__(self, ecs_client):
+        self.ecs_client = ecs_client
+        self.lock = threading.Lock()
+        self.ecs_ids = {}
+
+    def refresh(self):
+        known = set(self.ecs_ids.values())
+        new_ids = [i for i in self.ecs_client.list_container_instances(cached=False) if i not in known]
+        if new_ids:
+            for ecs_id, desc in self.ecs_client.describe_instances(new_ids, cached=False).items():
+                self.ecs_ids[desc['ec2InstanceId']] = ecs_id
+
+    def lookup(self, ec2_id):
+        """
+        @param ec2_id: ec2 instance id
+        @return: ecs instance id, or None if the instance isn't in the cluster
+        """
+        with self.lock:
+            if ec2_id not in self.ecs_ids:
+                self.refresh()
+            return self.ecs_ids.get(ec2_id)
+
+
+def parse_interruption(line, budget=SPOT_NOTICE):
+    """
+    @param line: an ec2 instance id, or an "EC2 Spot Instance Interruption
+                 Warning" CloudWatch event as JSON
+    @param budget: seconds given to instances without a notice time
+    @return: tuple of (ec2 id, seconds left), or None if the line isn't an
+             interruption
+    """
+    line = line.strip()
+    if not line:
+        return None
+    if not line.startswith('{'):
+        return line, budget
+
+    event = json.loads(line)
+    ec2_id = event.get('detail', {}).get('instance-id')
+    if not ec2_id:
+        return None
+    if 'time' not in event:
+        return ec2_id, budget
+
+    # only needed by the notices of --watch, and slow to import
+    from dateutil.parser import parse
+    noticed = parse(event['time'])
+    now = datetime.datetime.now(dateutil.tz.tzutc())
+    left = SPOT_NOTICE - (now - noticed).total_seconds()
+    return ec2_id, max(0, min(budget, left))
+
+
+def follow(path, poll_interval=FAST_POLL_INTERVAL):
+    """
+    Yields the lines appended to a file from now on, like `tail -f`. With "-"
+    the lines of stdin are yielded until it is closed.
+    """
+    if path == '-':
+        for line in iter(sys.stdin.readline, ''):
+            yield line
+        return
+
+    with open(path) as f:
+        f.seek(0, os.SEEK_END)
+        partial = ''
+        while True:
+            line = f.readline()
+            if not line:
+                time.sleep(poll_interval)
+                continue
+            partial += line
+            if partial.endswith('\n'):
+                yield partial
+                partial = ''
+
+
+def interruptions(path, budget=SPOT_NOTICE):
+    """
+    @param path: file (or "-" for stdin) interruption notices are written to
+    @param budget: most seconds any instance is given
+    @return: generator of (ec2 id, seconds left) tuples
+    """
+    for line in follow(path):
+        try:
+            interruption = parse_interruption(line, budget)
+        except ValueError:
+            # a garbled line shouldn't stop the watch
+            continue
+        if interruption:
+            yield interruption
@@ -0,0 +1,194 @@
+"""
+module for a column-oriented inventory of a cluster's container instances
+
+Numbers are kept in typed arrays, and strings that repeat across a cluster
+(availability zones, AMIs, agent versions, instance types) are stored once
+and referenced by small integer codes. Memory stays flat as clusters grow,
+and sorts, filters and group-bys walk plain columns rather than objects.
+Filters on coded columns evaluate their predicate once per distinct value.
+"""
+
+from array import array
+import calendar
+import datetime
+import math
+
+import dateutil.tz
+
+# columns of repeated strings, stored as codes
+CODED_COLUMNS = ['availability_zone', 'image_id', 'agent_version', 'instance_type']
+
+# numeric columns and their array type codes
+NUMERIC_COLUMNS = dict(
+    cpu_registered='l',
+    cpu_remaining='l',
+    mem_registered='l',
+    mem_remaining='l',
+    running_tasks='l',
+    pending_tasks='l',
+    launch_time='d',
+)
+
+
+def _resource(resources, name):
+    for r in resources:
+        if r['name'] == name:
+            return r['integerValue']
+    return -1
+
+
+def _timestamp(dt):
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+class Inventory(object):
+    """
+    Container instances of a cluster, one row per instance
+    """
+    def __init__(self):
+        self.ecs_ids = []
+        self.ec2_ids = []
+        self.ip_addresses = []
+        self.columns = dict((name, array(typecode)) for name, typecode in NUMERIC_COLUMNS.items())
+        for name in CODED_COLUMNS:
+            self.columns[name] = array('H')
+        # value to code and code to value of each coded column
+        self.codes = dict((name, {}) for name in CODED_COLUMNS)
+        self.values = dict((name, []) for name in CODED_COLUMNS)
+        self.rows_by_ecs_id = {}
+
+    def __len__(self):
+        return len(self.ecs_ids)
+
+    def _code(self, name, value):
+        codes = self.codes[name]
+        if value not in codes:
+            codes[value] = len(self.values[name])
+            self.values[name].append(value)
+        return codes[value]
+
+    def add(self, ecs_id, ecs_description, ec2_description):
+        """
+        @param ecs_id: ecs instance id
+        @param ecs_description: container instance description
+        @param ec2_description: ec2 instance description
+        @return: row of the instance
+        """
+        row = len(self.ecs_ids)
+        self.rows_by_ecs_id[ecs_id] = row
+        self.ecs_ids.append(ecs_id)
+        self.ec2_ids.append(ecs_description['ec2InstanceId'])
+        self.ip_addresses.append(ec2_description.get('PrivateIpAddress'))
+
+        numbers = dict(
+            cpu_registered=_resource(ecs_description['registeredResources'], 'CPU'),
+            cpu_remaining=_resource(ecs_description['remainingResources'], 'CPU'),
+            mem_registered=_resource(ecs_description['registeredResources'], 'MEMORY'),
+            mem_remaining=_resource(ecs_description['remainingResources'], 'MEMORY'),
+            running_tasks=ecs_description.get('runningTasksCount', 0),
+            pending_tasks=ecs_description.get('pendingTasksCount', 0),
+            launch_time=_timestamp(ec2_description['LaunchTime']),
+        )
+        for name, number in numbers.items():
+            self.columns[name].append(number)
+
+        strings = dict(
+            availability_zone=ec2_description['Placement']['AvailabilityZone'],
+            image_id=ec2_description['ImageId'],
+            agent_version=ecs_description.get('versionInfo', {}).get('agentVersion'),
+            instance_type=ec2_description['InstanceType'],
+        )
+        for name, value in strings.items():
+            self.columns[name].append(self._code(name, value))
+        return row
+
+    def row(self, ecs_id):
+        return self.rows_by_ecs_id[ecs_id]
+
+    def rows(self):
+        return range(len(self))
+
+    def value(self, name, row):
+        """
+        @param name: column name
+        @param row: row number
+        @return: the value of a column for one row
+        """
+        if name in self.codes:
+            return self.values[name][self.columns[name][row]]
+        return self.columns[name][row]
+
+    def launch_time(self, row):
+        return datetime.datetime.fromtimestamp(self.columns['launch_time'][row], dateutil.tz.tzutc())
+
+    def reserved(self, resource, row):
+        """
+        @param resource: "cpu" or "mem"
+        @return: units of the resource reserved by tasks
+        """
+        return (self.columns[resource + '_registered'][row] -
+                self.columns[resource + '_remaining'][row])
+
+    def utilized(self, resource, row):
+        """
+        @param resource: "cpu" or "mem"
+        @return: percent of the resource reserved, rounded up
+        """
+        registered = self.columns[resource + '_registered'][row]
+        remaining = self.columns[resource + '_remaining'][row]
+        return math.ceil(100 * (1 - float(remaining) / registered))
+
+    def utilization(self):
+        """
+        @return: column of cpu + memory percent reserved
+        """
+        return array('d', [self.utilized('cpu', row) + self.utilized('mem', row) for row in self.rows()])
+
+    def sort_rows(self, key, rows=None, reverse=False):
+        """
+        @param key: column name, or an array with a value for every row
+        @param rows: rows to sort. Defaults to every row
+        @return: sorted list of rows
+        """
+        column = self.columns[key] if isinstance(key, basestring) else key
+        if rows is None:
+            rows = self.rows()
+        return sorted(rows, key=column.__getitem__, reverse=reverse)
+
+    def filter_rows(self, name, predicate, rows=None):
+        """
+        @param name: column name
+        @param predicate: function taking a column value, returning a bool
+        @param rows: rows to filter. Defaults to every row
+        @return: list of the rows whose value matches
+        """
+        column = self.columns[name]
+        if rows is None:
+            rows = self.rows()
+        if name in self.codes:
+            # each distinct value is only tested once
+            matching = set(code for code, value in enumerate(self.values[name]) if predicate(value))
+            return [row for row in rows if column[row] in matching]
+        return [row for row in rows if predicate(column[row])]
+
+    def group_rows(self, name, rows=None):
+        """
+        @param name: column name
+        @param rows: rows to group. Defaults to every row
+        @return: dictionary of column values to lists of rows
+        """
+        column = self.columns[name]
+        if rows is None:
+            rows = self.rows()
+        groups = {}
+        for row in rows:
+            groups.setdefault(column[row], []).append(row)
+        if name in self.codes:
+            return dict((self.values[name][code], group) for code, group in groups.items())
+        return groups
+
+    def count_by(self, name, rows=None):
+        """
+        @return: dictionary of column values to row counts
+        """
+        return dict((value, len(group)) for value, group in self.group_rows(name, rows).items())
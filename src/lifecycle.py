@@ -0,0 +1,118 @@
+"""
+module for receiving auto scaling lifecycle notifications
+
+Notifications are the JSON documents auto scaling sends for lifecycle hooks,
+read one per line from a file, stdin or a socket (stand-ins for the SQS queue
+or SNS topic a hook would normally publish to).
+"""
+
+from contextlib import closing
+import json
+import os
+import socket
+import threading
+
+# local imports
+import defaults
+import fastdrain
+
+TERMINATING = 'autoscaling:EC2_INSTANCE_TERMINATING'
+
+# seconds between heartbeats keeping a lifecycle action from timing out
+DEFAULT_HEARTBEAT_INTERVAL = defaults.HEARTBEAT_INTERVAL
+
+
+def parse_notification(line):
+    """
+    @param line: a lifecycle notification as JSON
+    @return: notification dictionary, or None if the line isn't an instance
+             terminating notification (ex. the test notification sent when
+             a hook is created)
+    """
+    line = line.strip()
+    if not line:
+        return None
+    notification = json.loads(line)
+    # notifications delivered through SNS are wrapped in an envelope
+    if 'Message' in notification and 'LifecycleTransition' not in notification:
+        notification = json.loads(notification['Message'])
+    if notification.get('LifecycleTransition') != TERMINATING:
+        return None
+    for key in ('AutoScalingGroupName', 'LifecycleHookName', 'LifecycleActionToken', 'EC2InstanceId'):
+        if key not in notification:
+            return None
+    return notification
+
+
+def listen(address):
+    """
+    Yields the lines sent to a socket, one connection at a time
+    @param address: "host:port" for TCP, otherwise a unix socket path
+    """
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, int(port)))
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(address)
+    server.listen(5)
+
+    with closing(server):
+        while True:
+            conn, _ = server.accept()
+            with closing(conn), closing(conn.makefile()) as f:
+                for line in f:
+                    yield line
+
+
+def notifications(queue=None, address=None):
+    """
+    @param queue: file (or "-" for stdin) notifications are appended to
+    @param address: socket address to receive notifications on instead
+    @return: generator of notification dictionaries
+    """
+    lines = listen(address) if address else fastdrain.follow(queue)
+    for line in lines:
+        try:
+            notification = parse_notification(line)
+        except ValueError:
+            # a garbled line shouldn't stop the agent
+            continue
+        if notification:
+            yield notification
+
+
+class Heartbeat(object):
+    """
+    Records lifecycle action heartbeats from a background thread while an
+    instance is being drained
+    """
+    def __init__(self, asg, notification, interval=DEFAULT_HEARTBEAT_INTERVAL):
+        self.asg = asg
+        self.notification = notification
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.asg.record_lifecycle_heartbeat(self.notification['LifecycleHookName'],
+                                                    self.notification['LifecycleActionToken'],
+                                                    self.notification['EC2InstanceId'])
+            except Exception:
+                # the next beat may get through; the hook timeout is the backstop
+                pass
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
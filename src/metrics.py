@@ -0,0 +1,299 @@
+"""
+module for exporting rollover metrics
+
+Metrics are derived from the records on the event bus and from the AWS API
+call counts. They can be pushed to StatsD over UDP and/or served in the
+Prometheus text format on /metrics while the command runs.
+"""
+
+import atexit
+import BaseHTTPServer
+import re
+import socket
+import threading
+import time
+
+# local imports
+import aws
+import events
+
+PREFIX = 'ecs_rollover'
+
+# histogram buckets (seconds)
+BUCKETS = [1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, float('inf')]
+
+# phases taking an instance's tasks off it, counted by instances_drained_total
+DRAIN_PHASES = ('deregister', 'ecs_drain')
+
+# seconds between StatsD flushes of the API call counters
+STATSD_FLUSH_INTERVAL = 10
+
+HELP = dict(
+    instances_drained_total="ECS instances de-registered from the cluster or set to DRAINING",
+    phase_duration_seconds="Duration of each rollover phase",
+    phase_outcomes_total="Finished rollover phases by outcome",
+    replacement_boot_seconds="Time from detaching an instance until its replacement joined ECS",
+    service_steady_state_seconds="Time for a service to reach steady state after a drain",
+    docker_stop_seconds="Time to stop the containers on an instance",
+    last_event_timestamp_seconds="Unix time of the last progress event",
+    drain_limit="Instances drained at once, as adapted by --adaptive",
+    api_calls_total="AWS API calls by operation",
+    api_throttles_total="Throttled AWS API calls by operation",
+)
+
+
+def _labels_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def _escape_label(value):
+    # backslashes first, so the escapes added after aren't escaped again
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(key, extra=None):
+    pairs = list(key) + list(extra or [])
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape_label(v)) for k, v in pairs)
+
+
+def _format_bucket(bucket):
+    return '+Inf' if bucket == float('inf') else '%g' % bucket
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bucket in enumerate(BUCKETS):
+            if value <= bucket:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+    """
+    Counters, gauges and histograms keyed by name and labels. Every update is
+    also handed to the registered sinks (ex. StatsD).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.sinks = []
+
+    def inc(self, name, labels=None, value=1):
+        with self.lock:
+            key = (name, _labels_key(labels))
+            self.counters[key] = self.counters.get(key, 0) + value
+        for sink in self.sinks:
+            sink.count(name, labels, value)
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.gauges[(name, _labels_key(labels))] = value
+        for sink in self.sinks:
+            sink.gauge(name, labels, value)
+
+    def observe(self, name, value, labels=None):
+        with self.lock:
+            key = (name, _labels_key(labels))
+            self.histograms.setdefault(key, Histogram()).observe(value)
+        for sink in self.sinks:
+            sink.timing(name, labels, value)
+
+    def render(self):
+        """
+        @return: all metrics, including the API call counts, in the
+                 Prometheus text format
+        """
+        api_stats = aws.STATS.snapshot()
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = dict(self.histograms)
+        for operation, count in api_stats['calls'].items():
+            counters[('api_calls_total', (('operation', operation),))] = count
+        for operation, count in api_stats['throttles'].items():
+            counters[('api_throttles_total', (('operation', operation),))] = count
+
+        lines = []
+        for kind, values in [('counter', counters), ('gauge', gauges)]:
+            for name in sorted(set(n for n, _ in values)):
+                lines.append('# HELP %s_%s %s' % (PREFIX, name, HELP.get(name, name)))
+                lines.append('# TYPE %s_%s %s' % (PREFIX, name, kind))
+                for (n, key), value in sorted(values.items()):
+                    if n == name:
+                        lines.append('%s_%s%s %s' % (PREFIX, name, _format_labels(key), value))
+        for name in sorted(set(n for n, _ in histograms)):
+            lines.append('# HELP %s_%s %s' % (PREFIX, name, HELP.get(name, name)))
+            lines.append('# TYPE %s_%s histogram' % (PREFIX, name))
+            for (n, key), hist in sorted(histograms.items()):
+                if n != name:
+                    continue
+                for bucket, count in zip(BUCKETS, hist.counts):
+                    lines.append('%s_%s_bucket%s %d' % (PREFIX, name,
+                                                        _format_labels(key, [('le', _format_bucket(bucket))]),
+                                                        count))
+                lines.append('%s_%s_sum%s %f' % (PREFIX, name, _format_labels(key), hist.sum))
+                lines.append('%s_%s_count%s %d' % (PREFIX, name, _format_labels(key), hist.count))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsDSink(object):
+    """
+    Pushes every metric update to StatsD over UDP. Labels are folded into the
+    metric name (ex. ecs_rollover.phase_duration_seconds.docker_stop).
+    """
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.lock = threading.Lock()
+        self.sent_api_stats = dict(calls={}, throttles={})
+
+    def _name(self, name, labels):
+        parts = [PREFIX, name] + [str(v) for _, v in _labels_key(labels)]
+        return '.'.join(re.sub(r'[^A-Za-z0-9_\-]', '_', p) for p in parts)
+
+    def _send(self, line):
+        try:
+            self.sock.sendto(line, self.address)
+        except socket.error:
+            # metrics must never break a rollover
+            pass
+
+    def count(self, name, labels, value):
+        self._send('%s:%d|c' % (self._name(name, labels), value))
+
+    def gauge(self, name, labels, value):
+        self._send('%s:%f|g' % (self._name(name, labels), value))
+
+    def timing(self, name, labels, value):
+        self._send('%s:%d|ms' % (self._name(name, labels), value * 1000))
+
+    def flush_api_stats(self):
+        """
+        sends the API calls made since the last flush
+        """
+        api_stats = aws.STATS.snapshot()
+        with self.lock:
+            for kind, name in [('calls', 'api_calls_total'), ('throttles', 'api_throttles_total')]:
+                for operation, count in api_stats[kind].items():
+                    delta = count - self.sent_api_stats[kind].get(operation, 0)
+                    if delta:
+                        self.count(name, dict(operation=operation), delta)
+            self.sent_api_stats = api_stats
+
+    def run_flusher(self):
+        while True:
+            time.sleep(STATSD_FLUSH_INTERVAL)
+            self.flush_api_stats()
+
+
+class RolloverMetrics(object):
+    """
+    Event bus subscriber that turns progress records into metrics
+    """
+    def __init__(self, registry):
+        self.registry = registry
+        self.detach_started = {}
+
+    def __call__(self, record):
+        registry = self.registry
+        registry.set('last_event_timestamp_seconds', record['ts'])
+
+        if record['event'] == 'drain_limit':
+            registry.set('drain_limit', record['limit'])
+        if record['event'] == 'phase_start' and record['phase'] == 'asg_detach':
+            self.detach_started[record.get('instance')] = record['ts']
+        if record['event'] != 'phase_end':
+            return
+
+        phase = record['phase']
+        registry.observe('phase_duration_seconds', record['duration'], dict(phase=phase))
+        registry.inc('phase_outcomes_total', dict(phase=phase, outcome=record['outcome']))
+
+        # a dry run doesn't de-register anything
+        if phase in DRAIN_PHASES and record['outcome'] == 'ok' and not record.get('dry_run'):
+            registry.inc('instances_drained_total')
+        elif phase == 'replacement_join':
+            started = self.detach_started.pop(record.get('instance'), None)
+            if started is not None:
+                registry.observe('replacement_boot_seconds', record['ts'] - started)
+        elif phase == 'service_steady_state':
+            registry.observe('service_steady_state_seconds', record['duration'],
+                             dict(service=record.get('service')))
+        elif phase == 'docker_stop':
+            registry.observe('docker_stop_seconds', record['duration'])
+
+
+REGISTRY = Registry()
+
+
+def _handler_for(registry):
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # keep the access log out of the rollover output
+            pass
+    return MetricsHandler
+
+
+def serve(port, registry=REGISTRY, host=''):
+    """
+    Serves /metrics from a background thread
+    @param port: port to listen on
+    @return: the http server
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), _handler_for(registry))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def parse_address(address):
+    """
+    @param address: "host:port"
+    @return: tuple of (host, port)
+    """
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def configure(statsd=None, port=None):
+    """
+    Starts exporting metrics from the global event bus
+    @param statsd: optional "host:port" of a StatsD server to push to
+    @param port: optional port to serve /metrics on
+    """
+    if not statsd and not port:
+        return
+
+    if statsd:
+        sink = StatsDSink(*parse_address(statsd))
+        REGISTRY.sinks.append(sink)
+        flusher = threading.Thread(target=sink.run_flusher)
+        flusher.daemon = True
+        flusher.start()
+        atexit.register(sink.flush_api_stats)
+    if port:
+        serve(port)
+
+    events.BUS.subscribe(RolloverMetrics(REGISTRY))
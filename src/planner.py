@@ -0,0 +1,238 @@
+"""
+module for estimating how long a rollover will take and how many AWS API
+calls it will make
+
+The plan mirrors the steps Rollover.remove_instance() goes through. Expected
+durations come from the timing store (median of earlier runs) and fall back
+to the defaults below.
+"""
+
+import heapq
+import math
+
+# local imports
+import drain
+import events
+import timings
+
+# durations assumed for phases without any recorded history (seconds)
+DEFAULT_DURATIONS = dict(
+    asg_detach=180,
+    replacement_join=60,
+    query=5,
+    prepull=60,
+    lb_drain=300,
+    deregister=1,
+    service_steady_state=120,
+    lb_detach=1,
+    terminate=90,
+)
+SCALE_DOWN_DETACH_DURATION = 2
+
+# seconds between the polls made while waiting on each kind of phase
+POLL_INTERVALS = dict(
+    asg_detach=10,
+    replacement_join=10,
+    prepull=1,
+    lb_drain=5,
+    service_steady_state=10,
+    docker_stop=1,
+    terminate=15,
+)
+
+# items returned per page / described per call
+LIST_PAGE_SIZE = 100
+SERVICE_PAGE_SIZE = 10
+DESCRIBE_BATCH_SIZE = 10
+
+
+def _polls(phase, duration):
+    return int(math.ceil(float(duration) / POLL_INTERVALS[phase]))
+
+
+def _pages(count, size):
+    return max(1, int(math.ceil(float(count) / size)))
+
+
+class StepPlan(object):
+    """
+    a single phase of an instance removal
+    """
+    def __init__(self, phase, description, duration, api_calls):
+        self.phase = phase
+        self.description = description
+        self.duration = duration
+        self.api_calls = api_calls
+
+
+class InstancePlan(object):
+    """
+    every step planned for removing one instance
+    """
+    def __init__(self, ecs_instance, services, elb_names, target_group_arns):
+        self.ecs_instance = ecs_instance
+        self.services = services
+        self.elb_names = elb_names
+        self.target_group_arns = target_group_arns
+        self.steps = []
+
+    @property
+    def duration(self):
+        return sum(step.duration for step in self.steps)
+
+    @property
+    def api_calls(self):
+        return sum(step.api_calls for step in self.steps)
+
+    def slowest_step(self):
+        return max(self.steps, key=lambda step: step.duration)
+
+
+def plan_instance(args, timing_store, ecs_instance, asg_name, services, service_descriptions,
+                  cluster_size, task_count):
+    """
+    @param args: rollover/scaledown arguments
+    @param timing_store: timings.TimingStore or NullTimingStore
+    @param ecs_instance: ECSInstance() to remove
+    @param asg_name: auto scaling group of the instance, or None
+    @param services: list of service ids running on the instance
+    @param service_descriptions: dictionary of service ids to descriptions
+    @param cluster_size: number of container instances in the cluster
+    @param task_count: number of tasks in the cluster
+    @return: InstancePlan
+    """
+    elb_names, target_group_arns = drain.service_load_balancers(services, service_descriptions)
+    plan = InstancePlan(ecs_instance, services, elb_names, target_group_arns)
+    expected = lambda phase, key: timing_store.expected(phase, key, DEFAULT_DURATIONS[phase])
+
+    # instances outside of the groups are not detached or replaced
+    if asg_name is not None and args.scale_down:
+        plan.steps.append(StepPlan('asg_detach', "detach from %s" % (asg_name),
+                                   SCALE_DOWN_DETACH_DURATION, 1))
+    elif asg_name is not None:
+        duration = expected('asg_detach', asg_name)
+        plan.steps.append(StepPlan('asg_detach', "detach from %s and wait for a replacement" % (asg_name),
+                                   duration, 1 + _polls('asg_detach', duration)))
+        duration = expected('replacement_join', asg_name)
+        per_poll = _pages(cluster_size, LIST_PAGE_SIZE) + _pages(cluster_size, DESCRIBE_BATCH_SIZE)
+        plan.steps.append(StepPlan('replacement_join', "wait for the replacement to join ECS",
+                                   duration, per_poll * _polls('replacement_join', duration)))
+
+    # services and tasks are described once more before taking a drain
+    # slot when something happens before it, see Rollover.retire_instance()
+    service_count = len(service_descriptions)
+    prepull = getattr(args, 'prepull', False) and not args.scale_down and asg_name is not None
+    looks = 2 if args.parallel > 1 or args.lb_drain or prepull else 1
+    plan.steps.append(StepPlan('query', "describe services and tasks",
+                               looks * DEFAULT_DURATIONS['query'],
+                               looks * (2 * _pages(service_count, SERVICE_PAGE_SIZE) +
+                                        _pages(task_count, LIST_PAGE_SIZE) +
+                                        _pages(task_count, DESCRIBE_BATCH_SIZE))))
+
+    if getattr(args, 'prepull', False) and not args.scale_down and services:
+        duration = expected('prepull', timings.ANY_KEY)
+        plan.steps.append(StepPlan('prepull', "pre-pull images on the replacement",
+                                   duration, len(services) + 1 + _polls('prepull', duration)))
+
+    balancers = elb_names + target_group_arns
+    if args.lb_drain and balancers:
+        # balancers are drained in parallel
+        durations = [expected('lb_drain', b) for b in balancers]
+        api_calls = sum(2 + _polls('lb_drain', d) for d in durations)
+        plan.steps.append(StepPlan('lb_drain', "drain from %d load balancers" % (len(balancers)),
+                                   max(durations), api_calls))
+
+    plan.steps.append(StepPlan('deregister', "de-register from ECS",
+                               expected('deregister', timings.ANY_KEY), 1))
+
+    if services:
+        # services are waited on in parallel, each polled on its own
+        durations = [expected('service_steady_state', s) for s in services]
+        api_calls = sum(_polls('service_steady_state', d) for d in durations)
+        plan.steps.append(StepPlan('service_steady_state', "steady state of %d services" % (len(services)),
+                                   max(durations), api_calls))
+
+    if not args.lb_drain and balancers:
+        plan.steps.append(StepPlan('lb_detach', "detach from %d load balancers" % (len(balancers)),
+                                   DEFAULT_DURATIONS['lb_detach'] * len(balancers), len(balancers)))
+
+    duration = timing_store.expected('docker_stop', timings.ANY_KEY, args.timeout)
+    plan.steps.append(StepPlan('docker_stop', "docker stop",
+                               duration, 4 + _polls('docker_stop', duration)))
+
+    duration = expected('terminate', timings.ANY_KEY)
+    plan.steps.append(StepPlan('terminate', "stop and terminate",
+                               duration, 2 + _polls('terminate', duration)))
+    return plan
+
+
+def schedule(instance_plans, concurrency):
+    """
+    Simulates removing the instances with up to `concurrency` in flight,
+    starting each one as soon as a slot frees up
+    @param instance_plans: list of InstancePlan() in removal order
+    @param concurrency: number of instances removed at once
+    @return: tuple of (wall clock seconds, list of InstancePlan() on the
+             critical path)
+    """
+    # heap of (time the slot frees up, slot number)
+    slots = [(0, slot) for slot in range(max(1, concurrency))]
+    chains = dict((slot, []) for slot in range(len(slots)))
+    for plan in instance_plans:
+        free_at, slot = heapq.heappop(slots)
+        chains[slot].append(plan)
+        heapq.heappush(slots, (free_at + plan.duration, slot))
+
+    wall_clock, slot = max(slots)
+    return wall_clock, chains[slot]
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%dh%02dm%02ds" % (hours, minutes, seconds)
+    return "%dm%02ds" % (minutes, seconds)
+
+
+def report(instance_plans, concurrencies):
+    """
+    Prints the plan, the critical path and the estimate for each concurrency
+    @param instance_plans: list of InstancePlan() in removal order
+    @param concurrencies: list of concurrency settings to estimate
+    """
+    events.message("#"*80)
+    events.message("Execution plan:")
+    for plan in instance_plans:
+        events.message("  %s - %d services, %d load balancers - ~%s, ~%d API calls" % (
+            plan.ecs_instance.ec2_id, len(plan.services),
+            len(plan.elb_names) + len(plan.target_group_arns),
+            format_duration(plan.duration), plan.api_calls))
+        for step in plan.steps:
+            events.message("      %-22s %8s %6d calls  %s" % (step.phase, format_duration(step.duration),
+                                                               step.api_calls, step.description))
+
+    total_calls = sum(plan.api_calls for plan in instance_plans)
+    events.message("")
+    events.message("%-12s %12s %10s %12s  %s" % ("concurrency", "wall clock", "API calls", "API calls/s", "critical path"))
+    estimates = []
+    for concurrency in concurrencies:
+        wall_clock, critical_path = schedule(instance_plans, concurrency)
+        rate = float(total_calls) / wall_clock if wall_clock else 0
+        slowest = max(critical_path, key=lambda plan: plan.duration).slowest_step() if critical_path else None
+        events.message("%-12d %12s %10d %12.1f  %s%s" % (
+            concurrency, format_duration(wall_clock), total_calls, rate,
+            " -> ".join(plan.ecs_instance.ec2_id for plan in critical_path),
+            " (slowest step: %s, %s)" % (slowest.description, format_duration(slowest.duration)) if slowest else ""))
+        estimates.append(dict(concurrency=concurrency,
+                              wall_clock=wall_clock,
+                              api_calls=total_calls,
+                              critical_path=[plan.ecs_instance.ec2_id for plan in critical_path]))
+    events.emit('estimate', estimates=estimates)
+
+
+def parse_concurrencies(value):
+    """
+    argparse type for a comma separated list of concurrency settings
+    """
+    return [int(c) for c in value.split(',') if c.strip()]
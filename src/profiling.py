@@ -0,0 +1,192 @@
+"""
+module for profiling a command
+
+Every thread of the command is profiled with cProfile and the profiles are
+merged into one dump. The summary splits the time into CPU time, the
+functions that used it, and time spent blocked on AWS API calls, attributed
+to the module of this tool that made each call (ecs, scaling, alb, ...).
+"""
+
+import cProfile
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+# local imports
+import aws
+import events
+
+# directory of this tool's modules, calls are attributed to the first one
+# found up the stack
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# modules that only pass calls along
+PASS_THROUGH_MODULES = set(['aws', 'profiling', 'utils'])
+
+# functions listed in the summary
+TOP_FUNCTIONS = 20
+
+# builtins that wait rather than use CPU (sleeps, locks, sockets, pipes)
+BLOCKING_BUILTIN = re.compile(r"\b(sleep|acquire|wait|select|poll|recv|recv_into|read|readline|"
+                              r"accept|connect|do_handshake|join|communicate)\b")
+
+
+def calling_module(frame):
+    """
+    @param frame: stack frame to start from
+    @return: name of the closest of this tool's modules up the stack, or
+             "other"
+    """
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if os.path.dirname(os.path.abspath(filename)) == SOURCE_DIR:
+            module = os.path.splitext(os.path.basename(filename))[0]
+            if module not in PASS_THROUGH_MODULES:
+                return module
+        frame = frame.f_back
+    return "other"
+
+
+def _function_name(key):
+    filename, line, name = key
+    if filename == '~':
+        # builtins
+        return name
+    return "%s:%d(%s)" % (os.path.basename(filename), line, name)
+
+
+def _blocking(key):
+    return key[0] == '~' and bool(BLOCKING_BUILTIN.search(key[2]))
+
+
+class Profiler(object):
+    """
+    Profiles every thread started while it runs, and times the AWS API calls
+    made from them
+    """
+    def __init__(self, top=TOP_FUNCTIONS):
+        self.top = top
+        self.lock = threading.Lock()
+        self.profiles = []
+        # (module, operation) to [calls, seconds]
+        self.blocked = {}
+        self.started = None
+        self.stopped = None
+        self.times_started = None
+        self.times_stopped = None
+
+    def _new_profile(self):
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def _start_thread(self, frame, event, arg):
+        # the first event of a new thread swaps this hook for its own profile
+        self._new_profile()
+
+    def record_call(self, operation, seconds):
+        key = (calling_module(sys._getframe(1)), operation)
+        with self.lock:
+            entry = self.blocked.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def start(self):
+        aws.set_call_observer(self.record_call)
+        threading.setprofile(self._start_thread)
+        self.started = time.time()
+        self.times_started = os.times()
+        self._new_profile()
+
+    def stop(self):
+        self.times_stopped = os.times()
+        self.stopped = time.time()
+        self.profiles[0].disable()
+        threading.setprofile(None)
+        aws.set_call_observer(None)
+
+    def stats(self):
+        """
+        @return: pstats.Stats of every thread profiled
+        """
+        with self.lock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            try:
+                stats.add(profile)
+            except TypeError:
+                # threads that never ran any python code have nothing to add
+                pass
+        return stats
+
+    def wrap(self, func, path):
+        """
+        @param func: subcommand entry point taking the parsed arguments
+        @param path: file the merged profile is written to
+        @return: entry point that runs func under the profiler, then writes
+                 the profile and prints the summary
+        """
+        def profiled(args):
+            self.start()
+            try:
+                return func(args)
+            finally:
+                self.stop()
+                self.report(path)
+        return profiled
+
+    def report(self, path):
+        """
+        Writes the merged profile and prints where the time went
+        @param path: file the merged profile is written to
+        """
+        stats = self.stats()
+        stats.dump_stats(path)
+        wall_clock = self.stopped - self.started
+        user = self.times_stopped[0] - self.times_started[0]
+        system = self.times_stopped[1] - self.times_started[1]
+
+        events.message("#"*80)
+        events.message("Profile written to %s (%d threads)" % (path, len(self.profiles)))
+        events.message("Wall clock %.1fs, CPU %.1fs (%.1fs user, %.1fs system)" % (
+            wall_clock, user + system, user, system))
+
+        events.message("")
+        events.message("Top functions by CPU time (own time, summed over threads):")
+        events.message("  %10s %10s %10s  %s" % ("calls", "own", "cumulative", "function"))
+        working = [(key, value) for key, value in stats.stats.items() if not _blocking(key)]
+        working.sort(key=lambda item: item[1][2], reverse=True)
+        for key, (_, calls, own, cumulative, _) in working[:self.top]:
+            events.message("  %10d %9.2fs %9.2fs  %s" % (calls, own, cumulative, _function_name(key)))
+
+        with self.lock:
+            blocked = dict(self.blocked)
+        by_module = {}
+        for (module, operation), (calls, seconds) in blocked.items():
+            entry = by_module.setdefault(module, [0, 0.0, {}])
+            entry[0] += calls
+            entry[1] += seconds
+            entry[2][operation] = seconds
+
+        events.message("")
+        events.message("Time blocked on AWS API calls by module (summed over threads):")
+        events.message("  %-12s %8s %10s  %s" % ("module", "calls", "blocked", "slowest operations"))
+        for module, (calls, seconds, operations) in sorted(by_module.items(), key=lambda item: item[1][1],
+                                                           reverse=True):
+            slowest = sorted(operations.items(), key=lambda item: item[1], reverse=True)[:3]
+            events.message("  %-12s %8d %9.2fs  %s" % (module, calls, seconds, ", ".join(
+                "%s %.2fs" % (operation, op_seconds) for operation, op_seconds in slowest)))
+        if not by_module:
+            events.message("  no API calls")
+
+        waiting = sum(value[2] for key, value in stats.stats.items() if _blocking(key))
+        events.message("")
+        events.message("All waiting in sleeps, locks and sockets, API calls included (summed over threads): %.1fs" % (waiting))
+        events.emit('profile', path=path, wall_clock=wall_clock, cpu_user=user, cpu_system=system,
+                    blocked=[dict(module=module, operation=operation, calls=calls, seconds=seconds)
+                             for (module, operation), (calls, seconds) in blocked.items()])
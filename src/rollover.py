@@ -1,34 +1,54 @@
 #! /usr/bin/env python
 
-import argparse
-import datetime
 import fnmatch
 import itertools
+import json
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
-import os
 import sys
+import threading
 import time
 import traceback
-import math
 
 # local imports
 import alb
+import aws
+import dashboard
+import disruption
+import drain
 import ec2
 import elb
 import ecs
+import eventcursors
+import eventloop
+import events
+import inventory
+import planner
 import scaling
+import selection
+import snapshot
+import ssm
+import timings
 import utils
 
-import boto3
-
 SERVICE_ACTIVE = "ACTIVE"
 
-# S3 bucket for EC2 Run Command output
-EC2_RUN_OUTPUT_S3_BUCKET = 'ec2-run-command-output'
+# default seconds to wait for a service to reach steady state, for a
+# replacement instance to launch and between checks while waiting
+STEADY_STATE_TIMEOUT = 600
+INSTANCE_LAUNCH_TIMEOUT = 300
+POLL_INTERVAL = 10
+
+# characters that make a task name expression a pattern
+FNMATCH_WILDCARDS = '*?['
+
+# ec2 instances described per call when looking up a whole cluster
+EC2_DESCRIBE_BATCH_SIZE = 100
 
 
 class ECSInstance(object):
     """
+    A container instance, read from its row of an inventory.Inventory
     properties:
       - ecs_id
       - ec2_id
@@ -36,45 +56,31 @@ class ECSInstance(object):
       - ip_address
       - cpu_utilized (percent)
       - mem_utilized (percent)
+      - mem_reserved (MiB)
       - launch_time
+      - image_id
+      - instance_type
+      - agent_version
+      - running_tasks
     """
-    def __init__(self, ecs_client, ec2_client, ecs_id):
-        self.ecs_client = ecs_client
-        self.ec2_client = ec2_client
-        self.ecs_id = ecs_id
-
-        self._populate_ecs_info()
-        self._populate_ec2_info()
-
-    def _populate_ecs_info(self):
-        info = self.ecs_client.describe_instances([self.ecs_id])
-        self.ec2_id = info[self.ecs_id]['ec2InstanceId']
-
-        # look up registered and remaining resources
-        cpu_registered = -1
-        cpu_remaining = -1
-        mem_registered = -1
-        mem_remaining = -1
-        for r in info[self.ecs_id]['registeredResources']:
-            if r['name'] == 'CPU':
-                cpu_registered = r['integerValue']
-            if r['name'] == 'MEMORY':
-                mem_registered = r['integerValue']
-        for r in info[self.ecs_id]['remainingResources']:
-            if r['name'] == 'CPU':
-                cpu_remaining = r['integerValue']
-            if r['name'] == 'MEMORY':
-                mem_remaining = r['integerValue']
-
-        # compute utilization %, rounding up
-        self.cpu_utilized = math.ceil(100 * (1 - float(cpu_remaining) / cpu_registered))
-        self.mem_utilized = math.ceil(100 * (1 - float(mem_remaining) / mem_registered))
-
-    def _populate_ec2_info(self):
-        info = self.ec2_client.describe_instances([self.ec2_id])
-        self.availability_zone = info[self.ec2_id]['Placement']['AvailabilityZone']
-        self.ip_address = info[self.ec2_id]['PrivateIpAddress']
-        self.launch_time = info[self.ec2_id]['LaunchTime']
+    __slots__ = ('inventory', 'row')
+
+    def __init__(self, inventory, row):
+        self.inventory = inventory
+        self.row = row
+
+    ecs_id = property(lambda self: self.inventory.ecs_ids[self.row])
+    ec2_id = property(lambda self: self.inventory.ec2_ids[self.row])
+    ip_address = property(lambda self: self.inventory.ip_addresses[self.row])
+    availability_zone = property(lambda self: self.inventory.value('availability_zone', self.row))
+    image_id = property(lambda self: self.inventory.value('image_id', self.row))
+    instance_type = property(lambda self: self.inventory.value('instance_type', self.row))
+    agent_version = property(lambda self: self.inventory.value('agent_version', self.row))
+    running_tasks = property(lambda self: self.inventory.value('running_tasks', self.row))
+    launch_time = property(lambda self: self.inventory.launch_time(self.row))
+    cpu_utilized = property(lambda self: self.inventory.utilized('cpu', self.row))
+    mem_utilized = property(lambda self: self.inventory.utilized('mem', self.row))
+    mem_reserved = property(lambda self: self.inventory.reserved('mem', self.row))
 
     def __cmp__(self, other):
         return cmp(self.ecs_id, other.ecs_id)
@@ -83,55 +89,101 @@ class ECSInstance(object):
         return "{} ({} - {} - {}) [{:3.0f}% cpu, {:3.0f}% mem] -- {}".format(self.ecs_id, self.ec2_id, self.ip_address, self.availability_zone, self.cpu_utilized, self.mem_utilized, self.launch_time)
 
 
-def select_instances(ecs_instances, sort_by="launch_time"):
+def describe_inventory(ecs_client, ec2_client, ecs_ids):
     """
-    Prompts the user to select from a list of ecs instances
-    @param ecs_instances: list of ECSInstance() objects
+    Loads the container instances of a cluster with bulk describe calls
+    @param ecs_client: ecs client object
+    @param ec2_client: ec2 client object
+    @param ecs_ids: list of ecs instance ids
+    @return: inventory.Inventory
+    """
+    cluster = inventory.Inventory()
+    for batch in utils.batch_list(EC2_DESCRIBE_BATCH_SIZE, ecs_ids):
+        ecs_info = ecs_client.describe_instances(batch)
+        ec2_info = ec2_client.describe_instances([desc['ec2InstanceId'] for desc in ecs_info.values()])
+        for ecs_id in batch:
+            cluster.add(ecs_id, ecs_info[ecs_id], ec2_info[ecs_info[ecs_id]['ec2InstanceId']])
+    return cluster
+
+
+def inventory_instances(cluster, rows=None):
+    """
+    @param cluster: inventory.Inventory
+    @param rows: optional list of rows. Defaults to every row
+    @return: list of ECSInstance() objects
+    """
+    if rows is None:
+        rows = cluster.rows()
+    return [ECSInstance(cluster, row) for row in rows]
+
+
+def ask(question):
+    """
+    Asks the user a question on stderr, keeping stdout for the progress
+    records (see --log-format)
+    @param question: text of the prompt
+    @return: the answer
+    """
+    sys.stderr.write(question)
+    sys.stderr.flush()
+    return raw_input()
+
+
+def select_instances(cluster, sort_by="launch_time"):
+    """
+    Prompts the user to select from the instances of a cluster
+    @param cluster: inventory.Inventory
     @param sort_by: string ("launch_time" or "utilization") for how to sort printed instances
     @return: list of selected ECSInstance() objects
     """
     # allow sorting by launch_time or utilization
-    sorts = dict(
-        utilization=dict(key=lambda i: i.cpu_utilized + i.mem_utilized, reverse=True),
-        launch_time=dict(key=lambda i: i.launch_time, reverse=False),
-    )
-    sort_type = sorts[sort_by]
-    ecs_instances.sort(key=sort_type["key"], reverse=sort_type["reverse"])
+    if sort_by == "utilization":
+        rows = cluster.sort_rows(cluster.utilization(), reverse=True)
+    else:
+        rows = cluster.sort_rows('launch_time')
+    ecs_instances = inventory_instances(cluster, rows)
     for x, instance in enumerate(ecs_instances):
-        print "%d\t - %s" % (x, instance)
-    selections = raw_input('Specify the indices - comma-separated (ex. "1,2,4") or inclusive range (ex. "7-11"): ').split(',')
+        print >> sys.stderr, "%d\t - %s" % (x, instance)
+    answers = ask('Specify the indices - comma-separated (ex. "1,2,4") or inclusive range (ex. "7-11"): ').split(',')
     selected_instances = []
-    for selection in selections:
-        if '-' in selection:
-            start, end = selection.split('-')
+    for answer in answers:
+        if '-' in answer:
+            start, end = answer.split('-')
             start = int(start)
             end = int(end)
             selected_instances += ecs_instances[start:end+1]
         else:
-            index = int(selection)
+            index = int(answer)
             selected_instances.append(ecs_instances[index])
     return selected_instances
 
 
-def prompt_for_instances(ecs_instances, asg_contents, scale_down=False, sort_by="launch_time"):
+def prompt_for_instances(cluster, asg_contents, scale_down=False, sort_by="launch_time",
+                         selected_instances=None, confirm=True, instance_groups=None):
     """
     sorts the instances into an order that tries not to cause an AZ imbalance
     when removing instances. Also, prompts the user if there are issues.
-    @param ecs_instances: list of ECSInstance() objects
+    @param cluster: inventory.Inventory
     @param asg_contents: dictionary of ec2_ids to availability zones in the ASG
     @param scale_down: bool if scale down or rollover
     @param sort_by: string ("launch_time" or "utilization") for how to sort printed instances
+    @param selected_instances: optional list of ECSInstance() objects that were
+                               already chosen. If not provided the user is asked
+    @param confirm: if false, don't ask for confirmation
+    @param instance_groups: optional dictionary of ec2_ids to ASG names, when
+                            the cluster is backed by several groups
     @return: sorted list of ECSInstance() objects to remove
     """
     all_azs = set([az for az in asg_contents.values()])
 
-    # ask the user which instances to remove:
-    if scale_down:
-        print "Which instances do you want to remove?"
-    else:
-        print "Which instances do you want to rollover?"
+    if selected_instances is None:
+        # ask the user which instances to remove:
+        if scale_down:
+            print >> sys.stderr, "Which instances do you want to remove?"
+        else:
+            print >> sys.stderr, "Which instances do you want to rollover?"
 
-    selected_instances = select_instances(ecs_instances, sort_by=sort_by)
+        selected_instances = select_instances(cluster, sort_by=sort_by)
 
     # remove the selected instances to determine the remaining AZ balance
     to_remove = {}
@@ -139,27 +191,30 @@ def prompt_for_instances(ecs_instances, asg_contents, scale_down=False, sort_by=
         if ecs_instance.ec2_id in asg_contents:
             del asg_contents[ecs_instance.ec2_id]
         else:
-            print "WARNING: %s is not in the AutoScalingGroup. It will not be replaced" % (ecs_instance.ec2_id)
+            events.message("WARNING: %s is not in any of the AutoScalingGroups. It will not be replaced" % (ecs_instance.ec2_id),
+                           level='warning', instance=ecs_instance.ec2_id)
 
         to_remove.setdefault(ecs_instance.availability_zone, [])
         to_remove[ecs_instance.availability_zone].append(ecs_instance)
 
+    remaining_rows = [row for row in cluster.rows() if cluster.ec2_ids[row] in asg_contents]
     remaining_instances_by_az = {}
-    for ecs_instance in ecs_instances:
-        if ecs_instance.ec2_id in asg_contents:
-            remaining_instances_by_az.setdefault(ecs_instance.availability_zone, []).append(ecs_instance)
-    remaining_instances = [i for sublist in remaining_instances_by_az.values() for i in sublist]
+    for az, rows in cluster.group_rows('availability_zone', remaining_rows).items():
+        remaining_instances_by_az[az] = inventory_instances(cluster, rows)
+    remaining_instances = inventory_instances(cluster, remaining_rows)
 
     #
-    # check the Availability Zone balance
+    # check the Availability Zone balance of each ASG
     #
+    instance_groups = instance_groups or {}
     az_balance = {}
     for k, v in asg_contents.iteritems():
-        az_balance.setdefault(v, []).append(k)
+        az_balance.setdefault((instance_groups.get(k), v), []).append(k)
 
     max_diff = 0
     for a, b in itertools.combinations(az_balance.keys(), 2):
-        max_diff = max(max_diff, abs(len(az_balance[a]) - len(az_balance[b])))
+        if a[0] == b[0]:
+            max_diff = max(max_diff, abs(len(az_balance[a]) - len(az_balance[b])))
 
     remaining = sum([len(i) for i in to_remove.values()])
     ordered_instances = []
@@ -178,36 +233,22 @@ def prompt_for_instances(ecs_instances, asg_contents, scale_down=False, sort_by=
         if remaining == 0:
             break
 
-    print "About to remove the following instances:"
+    print >> sys.stderr, "About to remove the following instances:"
     for instance in ordered_instances:
-        print instance
+        print >> sys.stderr, instance
 
     asg_zones = set([az for az in asg_contents.values()])
     if scale_down and (max_diff > 1 or len(asg_zones) == 1):
-        print "WARNING: The instances you selected will cause the auto scaling" \
-              " group to rebalance instances across availability zones. This" \
-              " may result in a destructive operation."
+        events.message("WARNING: The instances you selected will cause the auto scaling"
+                       " group to rebalance instances across availability zones. This"
+                       " may result in a destructive operation.", level='warning')
 
-    confirm = raw_input("Do you want to continue [y/N]? ")
-    if confirm.lower() != 'y':
+    if confirm and ask("Do you want to continue [y/N]? ").lower() != 'y':
         return [], remaining_instances
 
     return ordered_instances, remaining_instances
 
 
-def map_service_events(service_descriptions):
-    """
-    Creates a mapping of service ids to their events
-    @param service_descriptions: dictionary of service ids to descriptions
-    @return: dictionary of service_ids to lists of events
-    """
-    service_events = {}
-    for service_id, desc in service_descriptions.items():
-        events = sorted(desc['events'], key=itemgetter('createdAt'))
-        service_events[service_id] = events
-    return service_events
-
-
 def map_instance_services(service_descriptions, task_descriptions):
     """
     Creates a mapping of the services that are running on each ECS instance
@@ -234,113 +275,693 @@ def map_instance_services(service_descriptions, task_descriptions):
     return instance_services
 
 
-def get_added_asg_instances(old_instances, new_instances):
+def map_service_images(ecs_client, service_ids, service_descriptions):
     """
-    diff two lists of asg instance dicts
-    @param old_instances: list of asg instance dictionaries
-    @param new_instances: list of asg instance dictionaries
-    @return: list of new instances (ec2 ids) in the asg
+    Collects the container images used by the given services
+    @param ecs_client: ecs client object
+    @param service_ids: list of service ids
+    @param service_descriptions: dictionary of service ids to descriptions
+    @return: sorted list of image names
     """
-    old_ids = [i['InstanceId'] for i in old_instances]
-    new_ids = [i['InstanceId'] for i in new_instances]
-    return [i for i in new_ids if i not in old_ids]
+    def_arns = list(set([service_descriptions[sid]['taskDefinition'] for sid in service_ids]))
+    images = set()
+    for task_def in ecs_client.describe_task_definitions(def_arns).values():
+        for container in task_def['containerDefinitions']:
+            images.add(container['image'])
+    return sorted(images)
 
 
-def wait_for_all_services(ecs_client, services_on_instance, service_events, service_descriptions):
+def wait_for_all_services(ecs_client, services_on_instance, cursors, since, service_descriptions,
+                          timing_store=None):
     """
-    Wait for all services on an instance to reach steady state
+    Wait for all services on an instance to reach steady state. The services
+    are waited on at the same time.
     @param ecs_client: ecs client object
     @param services_on_instance: list of service ids
-    @param service_events: map of services to lists of events
+    @param cursors: eventcursors.EventCursors following the services' events
+    @param since: dictionary of service ids to their cursors before the
+                  instance was de-registered
+    @param timing_store: optional timings.TimingStore used to size timeouts
     @return: list of service_ids that never completed
     """
-    failed = []
-    for service_id in services_on_instance:
-        last_event = service_events[service_id][-1]
-        if len(service_descriptions[service_id]["placementConstraints"]) == 1 and service_descriptions[service_id]["placementConstraints"][0]["type"] == "distinctInstance":
-            print "skipping distinct instance service:", service_id
-            continue
-        completed, event = ecs_client.wait_for_service_steady_state(service_id,
-                                                                    last_event)
-        # push the new event into the list for that service so
-        # that the next instance doesn't confuse this event for
-        # its own
-        service_events[service_id].append(event)
+    timing_store = timing_store or timings.NullTimingStore()
 
-        if not completed:
-            failed.append(service_id)
-    return failed
+    def wait(service_id):
+        if len(service_descriptions[service_id]["placementConstraints"]) == 1 and service_descriptions[service_id]["placementConstraints"][0]["type"] == "distinctInstance":
+            events.message("skipping distinct instance service: %s" % (service_id), service=service_id)
+            raise eventloop.Return(True)
+        with events.phase('service_steady_state',
+                          "Waiting for %s to reach steady state" % (service_id),
+                          service=service_id) as result:
+            timeout, poll_interval, straggler_after = timing_store.limits_for('service_steady_state', service_id,
+                                                                              STEADY_STATE_TIMEOUT, POLL_INTERVAL)
+            completed = yield ecs_client.wait_for_service_steady_state_async(service_id,
+                                                                             since[service_id],
+                                                                             cursors,
+                                                                             timeout,
+                                                                             poll_interval,
+                                                                             straggler_after)
+            if not completed:
+                result['outcome'] = 'failed'
+        raise eventloop.Return(completed)
+
+    completed = eventloop.run([wait(service_id) for service_id in services_on_instance])
+    return [service_id for service_id, ok in zip(services_on_instance, completed) if not ok]
+
+
+def candidate_task_families(ecs_client, match_expr):
+    """
+    Narrows down the task definition families that could match match_expr.
+    Patterns without wildcards name their family directly, otherwise the
+    families are listed using the literal prefix of the pattern.
+    @param ecs_client: ecs client object
+    @param match_expr: string to match task definitions against
+    @return: list of task definition families, or None if the pattern starts
+             with a wildcard and every task has to be looked at
+    """
+    wildcards = [match_expr.find(c) for c in FNMATCH_WILDCARDS if c in match_expr]
+    if not wildcards:
+        return [match_expr.rsplit(':', 1)[0]]
+
+    prefix = match_expr[:min(wildcards)].split(':', 1)[0]
+    if not prefix:
+        # listing every family of the account costs more than listing the
+        # cluster's tasks once
+        return None
+    if ':' in match_expr:
+        # the colon of a task definition name separates its family from its
+        # revision, so the family has to match what comes before it
+        family_expr = match_expr.rsplit(':', 1)[0]
+    else:
+        # wildcards may stretch into the revision, any listed family could match
+        family_expr = '*'
+    # this only needs to keep every family that could match, the full
+    # "family:revision" name is checked against each task afterwards
+    return [family for family in ecs_client.list_task_definition_families(prefix)
+            if fnmatch.fnmatch(family, family_expr)]
 
 
-def get_matching_tasks_by_hosts(ecs_client, ec2_client, match_expr):
+def get_matching_tasks_by_hosts(ecs_client, match_expr):
     """
-    Get all the ECS instances that are running tasks that match the match_expr
+    Get the ECS instances that are running tasks that match the match_expr.
+    Only the tasks of candidate families are described.
     @param ecs_client: ecs client object
-    @param ec2_client: ec2 client object
     @param match_expr: string to match task definitions against
-    @return: dictionary of all ecs_ids to list of matching task definitions
+    @return: dictionary of matching ecs_ids to list of matching task definitions
     """
-    task_ids = ecs_client.list_tasks()
-    task_descriptions = ecs_client.describe_tasks(task_ids)
+    families = candidate_task_families(ecs_client, match_expr)
+    if families is None:
+        task_lists = [ecs_client.list_tasks()]
+    else:
+        task_lists = (ecs_client.list_tasks(family=family) for family in families)
+
     running_map = {}
-    for task in task_descriptions.values():
-        task_def = utils.pull_task_definition_name(task['taskDefinitionArn'])
-        ecs_id = utils.pull_instance_id(task['containerInstanceArn'])
-        running_map.setdefault(ecs_id, [])
-        if fnmatch.fnmatch(task_def, match_expr):
-            running_map[ecs_id].append(task_def)
+    for task_ids in task_lists:
+        # tasks are matched as their batches come back
+        for _, task in ecs_client.iter_describe_tasks(task_ids):
+            task_def = utils.pull_task_definition_name(task['taskDefinitionArn'])
+            if fnmatch.fnmatch(task_def, match_expr):
+                ecs_id = utils.pull_instance_id(task['containerInstanceArn'])
+                running_map.setdefault(ecs_id, [])
+                if task_def not in running_map[ecs_id]:
+                    running_map[ecs_id].append(task_def)
     return running_map
 
 
+def iter_host_details(ecs_client, ec2_client, ecs_ids):
+    """
+    Describes ECS instances a batch at a time, yielding each batch as soon as
+    it has been looked up
+    @param ecs_client: ecs client object
+    @param ec2_client: ec2 client object
+    @param ecs_ids: list of ecs instance ids
+    @return: generator of (ecs_id, ec2_id, ip_address) tuples
+    """
+    for batch in utils.batch_list(10, ecs_ids):
+        ecs_info = ecs_client.describe_instances(batch)
+        ec2_ids = [desc['ec2InstanceId'] for desc in ecs_info.values()]
+        ec2_info = ec2_client.describe_instances(ec2_ids)
+        for ecs_id in batch:
+            ec2_id = ecs_info[ecs_id]['ec2InstanceId']
+            ip_address = ec2_info.get(ec2_id, {}).get('PrivateIpAddress')
+            yield ecs_id, ec2_id, ip_address
+
+
+def preselect_instances(args, ecs_client, cluster, asg_contents, instance_groups=None):
+    """
+    Picks instances according to --where, --older-than and --select without
+    prompting
+    @param args: rollover/scaledown arguments
+    @param ecs_client: ecs client object
+    @param cluster: inventory.Inventory
+    @param asg_contents: dictionary of ec2_ids to availability zones in the ASG
+    @param instance_groups: optional dictionary of ec2_ids to ASG names
+    @return: list of picked ECSInstance() objects, or None to prompt the user
+    """
+    filtered = bool(args.where or args.older_than)
+    ecs_instances = inventory_instances(cluster)
+    if filtered:
+        ecs_instances = inventory_instances(cluster, selection.filter_rows(cluster, args.where, args.older_than))
+        events.message("%d instances match %s" % (len(ecs_instances), describe_filters(args)))
+    if not args.select:
+        # filters alone select every matching instance
+        return list(ecs_instances) if filtered else None
+    mode, count = args.select
+    if mode == 'all':
+        return list(ecs_instances)
+    return auto_select_instances(ecs_client, ecs_instances, asg_contents, count, instance_groups)
+
+
+def describe_filters(args):
+    """
+    @return: human readable --where and --older-than filters
+    """
+    filters = [repr(where) for where in args.where or []]
+    if args.older_than:
+        filters.append("older than %s" % (args.older_than))
+    return ", ".join(filters)
+
+
+def auto_select_instances(ecs_client, ecs_instances, asg_contents, count, instance_groups=None):
+    """
+    Picks the instances whose tasks are cheapest to move elsewhere
+    @param ecs_client: ecs client object
+    @param ecs_instances: list of ECSInstance() objects
+    @param asg_contents: dictionary of ec2_ids to availability zones in the ASG
+    @param count: number of instances to pick
+    @param instance_groups: optional dictionary of ec2_ids to ASG names
+    @return: list of picked ECSInstance() objects
+    """
+    service_descriptions = ecs_client.describe_services(ecs_client.list_services())
+    task_descriptions = ecs_client.describe_tasks(ecs_client.list_tasks())
+    costs = selection.migration_costs(ecs_instances, service_descriptions, task_descriptions)
+    picked = selection.pick_cheapest(ecs_instances, asg_contents, costs, count, instance_groups)
+
+    events.message("Selected the %d instances that are cheapest to migrate:" % (len(picked)))
+    for ecs_instance in picked:
+        events.message("%8.1f\t - %s" % (costs[ecs_instance.ecs_id], ecs_instance),
+                       instance=ecs_instance.ec2_id, cost=costs[ecs_instance.ecs_id])
+    return picked
+
+
+def estimate_rollover(args, ecs_client, timing_store, cluster_size, selected_ecs_instances,
+                      service_descriptions, instance_groups):
+    """
+    Prints the execution plan of a rollover with its expected duration and
+    API calls for each concurrency setting
+    @param args: rollover/scaledown arguments
+    @param ecs_client: ecs client object
+    @param timing_store: timings.TimingStore or NullTimingStore
+    @param cluster_size: number of container instances in the cluster
+    @param selected_ecs_instances: list of ECSInstance() objects to remove
+    @param service_descriptions: dictionary of service ids to descriptions
+    @param instance_groups: dictionary of ec2_ids to ASG names
+    """
+    task_descriptions = ecs_client.describe_tasks(ecs_client.list_tasks())
+    instance_services = map_instance_services(service_descriptions, task_descriptions)
+    plans = []
+    for ecs_instance in selected_ecs_instances:
+        plans.append(planner.plan_instance(args, timing_store, ecs_instance,
+                                           instance_groups.get(ecs_instance.ec2_id),
+                                           instance_services.get(ecs_instance.ecs_id, []),
+                                           service_descriptions, cluster_size,
+                                           len(task_descriptions)))
+    planner.report(plans, args.estimate_concurrency)
+
+    demands = selection.map_instance_service_tasks(service_descriptions, task_descriptions)
+    concurrent = disruption.max_concurrent(disruption.service_budgets(service_descriptions),
+                                           [demands.get(i.ecs_id, {}) for i in selected_ecs_instances])
+    events.message("Deployment configurations allow %d of the selected instances to drain at once" % (concurrent))
+
+
+class Rollover(object):
+    """
+    Removes ECS instances from a cluster, tracking the services and instances
+    that had problems along the way
+    """
+    def __init__(self, args, ecs_client, ec2_client, asgs, instance_groups, timing_store=None,
+                 budget=None, controller=None):
+        self.args = args
+        self.ecs_client = ecs_client
+        self.ec2_client = ec2_client
+        self.asgs = asgs
+        self.instance_groups = instance_groups
+        self.timing_store = timing_store or timings.NullTimingStore()
+        self.budget = budget or disruption.NullBudget()
+        self.controller = controller or disruption.NullController()
+        # shared by every removal, so that an instance doesn't take the steady
+        # state of an earlier one for its own
+        self.cursors = eventcursors.EventCursors()
+
+        # guards the problems below, recorded from every removal thread
+        self.lock = threading.Lock()
+        self.skipped_shutdown = []
+        self.steady_state_errors = set()
+
+    def remove_instances(self, ecs_instances):
+        """
+        Removes instances in waves of at most one per auto scaling group. The
+        replacements of a wave are waited on in parallel, the rest of each
+        removal happens one instance at a time.
+        @param ecs_instances: ordered list of ECSInstance() objects to remove
+        """
+        if self.args.parallel > 1:
+            self.remove_instances_in_parallel(ecs_instances)
+            return
+
+        by_group = {}
+        group_order = []
+        for ecs_instance in ecs_instances:
+            group = self.instance_groups.get(ecs_instance.ec2_id)
+            if group not in by_group:
+                group_order.append(group)
+            by_group.setdefault(group, []).append(ecs_instance)
+
+        while any(by_group.values()):
+            wave = [by_group[name].pop(0) for name in group_order if by_group[name]]
+            if self.args.scale_down or len(wave) == 1:
+                for ecs_instance in wave:
+                    self.remove_instance(ecs_instance)
+                continue
+
+            for ecs_instance, new_ec2_id in zip(wave, self.replace_instances(wave)):
+                self.retire_instance(ecs_instance, new_ec2_id)
+
+    def remove_instances_in_parallel(self, ecs_instances):
+        """
+        Removes up to `--parallel` instances at once. Each removal waits for
+        the disruption budget before moving tasks, so no service drops below
+        its minimum healthy percent because of the others.
+        @param ecs_instances: ordered list of ECSInstance() objects to remove
+        """
+        # the pool threads act on behalf of this one
+        region = aws.current_region()
+        event_context = events.current_context()
+
+        def remove(ecs_instance):
+            with aws.region_context(region), events.context(**event_context):
+                self.remove_instance(ecs_instance)
+
+        pool = ThreadPool(min(self.args.parallel, len(ecs_instances)))
+        try:
+            pool.map(remove, ecs_instances, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def replace_instances(self, ecs_instances):
+        """
+        Runs replace_instance() for each instance in parallel
+        @param ecs_instances: list of ECSInstance() objects from different groups
+        @return: list of replacement ec2 ids
+        """
+        # the pool threads act on behalf of this one
+        region = aws.current_region()
+        event_context = events.current_context()
+
+        def replace(ecs_instance):
+            with aws.region_context(region), events.context(**event_context):
+                return self.replace_instance(ecs_instance)
+
+        pool = ThreadPool(len(ecs_instances))
+        try:
+            return pool.map(replace, ecs_instances)
+        finally:
+            pool.close()
+            pool.join()
+
+    def remove_instance(self, ecs_instance):
+        """
+        Runs every step of removing a single instance from the cluster
+        @param ecs_instance: ECSInstance() object to remove
+        """
+        self.retire_instance(ecs_instance, self.replace_instance(ecs_instance))
+
+    def replace_instance(self, ecs_instance):
+        """
+        Detaches an instance from its auto scaling group and, unless scaling
+        down, waits for its replacement to join the cluster
+        @param ecs_instance: ECSInstance() object to remove
+        @return: ec2 id of the replacement, or None
+        """
+        args = self.args
+        ecs_client = self.ecs_client
+        ec2_id = ecs_instance.ec2_id
+        events.message("Preparing to remove %s" % (ecs_instance), instance=ec2_id)
+
+        group = self.instance_groups.get(ec2_id)
+        asg = self.asgs.get(group)
+        if asg is None:
+            events.message("WARNING: %s is not in any of the auto scaling groups. It will not be replaced" % (ec2_id),
+                           level='warning', instance=ec2_id)
+            return None
+
+        #
+        # Remove ECS instance from scaling group
+        #
+        if args.scale_down:
+            description = "Remove EC2 instance from scaling group %s" % (group)
+        else:
+            description = "Removing EC2 instance from scaling group %s and waiting for replacement" % (group)
+        new_ec2_id = None
+        with events.phase('asg_detach', description, instance=ec2_id,
+                          asg=group, scale_down=args.scale_down) as result:
+            if not args.dry_run:
+                if args.scale_down:
+                    asg.detach_instances([ec2_id], scale_down=True)
+                else:
+                    timeout, poll_interval, _ = self.timing_store.limits_for('asg_detach', group,
+                                                                             INSTANCE_LAUNCH_TIMEOUT, POLL_INTERVAL)
+                    # the launch activity caused by this detach names the replacement
+                    new_ec2_id = asg.detach_instances_and_wait([ec2_id], timeout, poll_interval)[ec2_id]
+                    if new_ec2_id:
+                        result['replacement'] = new_ec2_id
+                    else:
+                        result['outcome'] = 'failed'
+
+        #
+        # Wait for new ec2 instance to join the ECS cluster
+        #
+        if args.scale_down or args.dry_run:
+            return None
+        if not new_ec2_id:
+            events.message("WARNING: no replacement for %s launched within the timeout, continuing without it" % (ec2_id),
+                           level='warning', instance=ec2_id)
+            return None
+        timeout, poll_interval, straggler_after = self.timing_store.limits_for('replacement_join', group,
+                                                                              INSTANCE_LAUNCH_TIMEOUT, POLL_INTERVAL)
+        joined = False
+        with events.phase('replacement_join',
+                          "Waiting for replacement EC2 instance %s to join ECS" % (new_ec2_id),
+                          instance=ec2_id, replacement=new_ec2_id, asg=group) as result:
+            started = time.time()
+            warned = False
+            while True:
+                if new_ec2_id in ecs_client.list_active_ec2_instances():
+                    joined = True
+                    break
+                if time.time() - started > timeout:
+                    result['outcome'] = 'failed'
+                    break
+                if straggler_after and not warned and time.time() - started > straggler_after:
+                    events.message("WARNING: %s is taking longer than usual (%ds) to join ECS" % (new_ec2_id, straggler_after),
+                                   level='warning', instance=ec2_id)
+                    warned = True
+                time.sleep(poll_interval)
+        if not joined:
+            # the tasks can still move to the rest of the cluster
+            events.message("WARNING: replacement %s did not join ECS within %ds, continuing without it" % (new_ec2_id, timeout),
+                           level='warning', instance=ec2_id)
+            return None
+        return new_ec2_id
+
+    def describe_services_and_tasks(self, cached=True):
+        """
+        @param cached: if false, skip the snapshot cache
+        @return: tuple of (dictionary of service ids to descriptions,
+                 dictionary of task arns to descriptions) of the cluster
+        """
+        ecs_client = self.ecs_client
+        service_ids = ecs_client.list_services(cached=cached)
+        service_descriptions = ecs_client.describe_services(service_ids, cached=cached)
+
+        task_ids = ecs_client.list_tasks(cached=cached)
+        task_descriptions = ecs_client.describe_tasks(task_ids, cached=cached)
+        return service_descriptions, task_descriptions
+
+    def retire_instance(self, ecs_instance, new_ec2_id, terminate=True):
+        """
+        Moves the tasks off an instance that is out of its auto scaling group
+        and terminates it
+        @param ecs_instance: ECSInstance() object to remove
+        @param new_ec2_id: ec2 id of its replacement, or None
+        @param terminate: if false, leave stopping the instance to someone
+                          else (ex. its auto scaling group)
+        """
+        args = self.args
+        ecs_client = self.ecs_client
+        ec2_id = ecs_instance.ec2_id
+
+        #
+        # A first look at the services on the instance is enough to warm
+        # the image cache of the replacement, to wait for a drain slot and
+        # to drain the load balancers. Everything that moves tasks is
+        # decided from a second, uncached look taken once the slot is held,
+        # see below. When none of these happen, that look is the only one.
+        #
+        service_descriptions, task_descriptions = {}, {}
+        if args.parallel > 1 or args.lb_drain or (args.prepull and new_ec2_id):
+            service_descriptions, task_descriptions = self.describe_services_and_tasks()
+        services_on_instance = map_instance_services(service_descriptions,
+                                                     task_descriptions).get(ecs_instance.ecs_id, [])
+
+        #
+        # Warm the image cache of the replacement so that the tasks
+        # rescheduled onto it don't all wait on image pulls
+        #
+        if args.prepull and new_ec2_id and services_on_instance:
+            images = map_service_images(ecs_client, services_on_instance, service_descriptions)
+            with events.phase('prepull', "Pre-pulling %d images on %s" % (len(images), new_ec2_id),
+                              instance=ec2_id, replacement=new_ec2_id, images=images) as result:
+                ret, out = ssm.docker_pull(new_ec2_id, images, args.prepull_timeout)
+                if ret != 0:
+                    # a cold cache only slows the rollover down, keep going
+                    events.message("WARNING: failed to pre-pull images: %s" % (out),
+                                   level='warning', instance=ec2_id)
+                    result['outcome'] = 'failed'
+
+        #
+        # Only start moving tasks once every service on the instance can
+        # spare them, and the cluster keeps up with the drains in flight
+        #
+        demand = selection.map_instance_service_tasks(service_descriptions, task_descriptions).get(ecs_instance.ecs_id, {})
+        with self.controller.hold(ec2_id), self.budget.hold(ec2_id, demand) as held:
+            #
+            # Take the instance out of its load balancers first so that no new
+            # traffic reaches tasks that are about to be stopped
+            #
+            drained_balancers = set()
+            if args.lb_drain and services_on_instance:
+                elb_names, target_group_arns = drain.service_load_balancers(services_on_instance,
+                                                                            service_descriptions)
+                if not args.dry_run:
+                    undrained = drain.drain_instance(ec2_id, elb_names, target_group_arns,
+                                                     args.lb_drain_timeout)
+                    if undrained:
+                        events.message("WARNING: connections did not finish draining from %s" % (", ".join(undrained)),
+                                       level='warning', instance=ec2_id)
+                else:
+                    for balancer in elb_names + target_group_arns:
+                        events.message("Would drain from %s" % (balancer), instance=ec2_id)
+                drained_balancers.update(elb_names + target_group_arns)
+
+            #
+            # Query services and tasks just before calling
+            #
+            # NOTE: If a deployment is made and scheduled to the machine being
+            # removed after the services and tasks are queried, but before
+            # deregister_container_instance() is called, then it wont be tracked
+            # and removed during the rollover. The following calls are grouped
+            # together as closely as possible to minimize this risk. They skip
+            # the snapshot cache for the same reason.
+            #
+            service_descriptions, task_descriptions = self.describe_services_and_tasks(cached=False)
+            services_on_instance = map_instance_services(service_descriptions,
+                                                         task_descriptions).get(ecs_instance.ecs_id, [])
+            # the tasks may have moved since the slot was asked for
+            demand = selection.map_instance_service_tasks(service_descriptions,
+                                                          task_descriptions).get(ecs_instance.ecs_id, {})
+            self.budget.update(ec2_id, held, demand)
+            # containers are given as long to stop as their task definitions ask for
+            stop_timeouts = container_stop_timeouts(ecs_client, ecs_instance.ecs_id, task_descriptions)
+
+            # only the services on this instance are waited on, and only the
+            # events they record from now on tell that they settled again
+            for service_id in services_on_instance:
+                self.cursors.ingest(service_id, service_descriptions[service_id]['events'])
+            since = dict((service_id, self.cursors.cursor(service_id)) for service_id in services_on_instance)
+
+            #
+            # De-register instances from ECS
+            #
+            with events.phase('deregister', "De-registering instance from ECS", instance=ec2_id,
+                              dry_run=args.dry_run):
+                if not args.dry_run:
+                    ecs_client.deregister_container_instance(ecs_instance.ecs_id)
+
+            #
+            # Wait for task migrations
+            #
+            if services_on_instance:
+                with events.phase('steady_state', "Rolling over services",
+                                  instance=ec2_id, services=services_on_instance) as result:
+                    if not args.dry_run:
+                        failed_services = wait_for_all_services(ecs_client,
+                                                                services_on_instance,
+                                                                self.cursors,
+                                                                since,
+                                                                service_descriptions,
+                                                                self.timing_store)
+                        if failed_services:
+                            service_names = [service_descriptions[sid]['serviceName'] for sid in failed_services]
+                            events.message("ERROR: Timeout while waiting for %s to reach steady state" % (service_names),
+                                           level='error', instance=ec2_id)
+                            with self.lock:
+                                self.steady_state_errors.update(service_names)
+                            result.update(outcome='failed', failed_services=service_names)
+
+                with events.phase('lb_detach', "Removing instance from any service Load Balancers",
+                                  instance=ec2_id) as result:
+                    elb_names, target_group_arns = drain.service_load_balancers(services_on_instance,
+                                                                                service_descriptions)
+                    # the balancers of services placed after the drain above
+                    elb_names = [name for name in elb_names if name not in drained_balancers]
+                    target_group_arns = [arn for arn in target_group_arns if arn not in drained_balancers]
+                    if not elb_names and not target_group_arns and drained_balancers:
+                        result['outcome'] = 'skipped'
+                    elif not args.dry_run:
+                        # remove the current instance from the Load Balancers
+                        # defined for its services
+                        for elb_name in elb_names:
+                            elb_client = elb.ELBClient(elb_name)
+                            elb_client.deregister_instances([ec2_id])
+                        for target_group_arn in target_group_arns:
+                            alb_group = alb.NewALBGroup(target_group_arn)
+                            alb_group.deregister_targets([ec2_id])
+
+        #
+        # stop all the docker containers on the machine
+        #
+        with events.phase('docker_stop', "Stopping containers on instance", instance=ec2_id) as result:
+            if not args.dry_run:
+                # TEST DOCKER IS RUNNING
+                ret, out = ssm.run_with_timeout(ec2_id,
+                                                'docker ps -a -q',
+                                                10)
+                if ret != 0:
+                    events.message("FAILED to run `docker ps`: %s" % (out), level='error', instance=ec2_id)
+                    events.message("Skipping shutdown for %s" % (ecs_instance), level='error', instance=ec2_id)
+                    with self.lock:
+                        self.skipped_shutdown.append(ecs_instance)
+                    result['outcome'] = 'skipped'
+                    return
+
+                # STOP ALL DOCKER CONTAINERS
+                ret, out, stops = ssm.docker_stop(ec2_id, args.timeout, stop_timeouts)
+                if ret != 0:
+                    events.message("WARNING: %s" % (out), level='warning', instance=ec2_id)
+                    result['outcome'] = 'failed'
+                ssm.report_container_stops(ec2_id, stops, result)
+
+        #
+        # Stop and terminate the EC2 instance
+        #
+        with events.phase('terminate', "Stopping and Terminating instance", instance=ec2_id) as result:
+            if not terminate:
+                result['outcome'] = 'skipped'
+            elif not args.dry_run:
+                self.ec2_client.stop_and_wait_for_instances([ec2_id])
+                self.ec2_client.terminate_and_wait_for_instances([ec2_id])
+        events.message("", instance=ec2_id)
+
+    def report(self):
+        """
+        Prints the services and instances that had problems
+        """
+        # Print the services that had trouble migrating
+        if self.steady_state_errors:
+            events.message("#"*80)
+            events.message("The following services timed out while waiting to reach steady state:")
+            for name in self.steady_state_errors:
+                events.message(name, level='error')
+
+        # Print the instances that need to be manually shutdown
+        if self.skipped_shutdown:
+            events.message("#"*80)
+            events.message("The following instances could not be shutdown.")
+            events.message("They likely still have tasks running on them:")
+            for instance in self.skipped_shutdown:
+                events.message(str(instance), level='error', instance=instance.ec2_id)
+
+
 def main_rollover(args):
     """
     Main entry point for rollover and scaledown commands
     """
+    return run_rollover(args)['ok']
+
+
+def run_rollover(args):
+    """
+    Removes the selected instances of a cluster
+    @param args: rollover/scaledown arguments
+    @return: summary dictionary with `ok`, `removed` (ec2 ids),
+             `steady_state_errors` (service names) and `skipped_shutdown`
+             (ec2 ids)
+    """
+    summary = dict(ok=True, removed=[], steady_state_errors=[], skipped_shutdown=[])
     if args.dry_run:
-        print "############## DRY RUN MODE ##############"
-        print
+        events.message("############## DRY RUN MODE ##############")
+        events.message("")
 
     #
     # Create AWS connections
     #
-    ecs_client = ecs.ECSClient(args.cluster)
-    ec2_client = ec2.EC2Client()
-    asg = scaling.AutoScalingGroup(args.asg)
+    cache = snapshot.open_cache(args.cluster, args.cache_ttl)
+    ecs_client = ecs.ECSClient(args.cluster, cache)
+    ec2_client = ec2.EC2Client(cache)
 
     # get all the ecs instances and their necessary metadata
-    all_ecs_instances = []
-    for instance in ecs_client.list_container_instances():
-        ecs_instance = ECSInstance(ecs_client, ec2_client, instance)
-        all_ecs_instances.append(ecs_instance)
-
-    # get all the ec2 instances in the ASG and their availability zones
-    asg_instances = asg.describe_instances()
+    cluster = describe_inventory(ecs_client, ec2_client, ecs_client.list_container_instances())
+
+    # map every instance to the auto scaling group that owns it. Without any
+    # groups given, every group backing the cluster is used
+    instance_groups = scaling.describe_instance_groups(cluster.ec2_ids, cache)
+    asg_names = args.asgs or sorted(set(instance_groups.values()))
+    if not asg_names:
+        events.message("ERROR: No auto scaling groups found for %s" % (args.cluster), level='error')
+        summary['ok'] = False
+        return summary
+    instance_groups = dict((ec2_id, name) for ec2_id, name in instance_groups.items() if name in asg_names)
+    asgs = dict((name, scaling.AutoScalingGroup(name, cache)) for name in asg_names)
+
+    # get all the ec2 instances in the ASGs and their availability zones
     asg_contents = {}
-    for asg_instance in asg_instances:
-        ec2_id = asg_instance['InstanceId']
-        asg_contents[ec2_id] = asg_instance['AvailabilityZone']
+    for name, asg in asgs.items():
+        for asg_instance in asg.describe_instances():
+            ec2_id = asg_instance['InstanceId']
+            asg_contents[ec2_id] = asg_instance['AvailabilityZone']
+            instance_groups.setdefault(ec2_id, name)
+
+    # pick instances without prompting if asked to
+    preselected = preselect_instances(args, ecs_client, cluster, asg_contents, instance_groups)
 
     # Prompt the user for the instances to adjust
-    selected_ecs_instances, remaining_instances = prompt_for_instances(all_ecs_instances,
+    selected_ecs_instances, remaining_instances = prompt_for_instances(cluster,
                                                                        asg_contents,
                                                                        args.scale_down,
-                                                                       args.sort)
+                                                                       args.sort,
+                                                                       preselected,
+                                                                       not args.yes,
+                                                                       instance_groups)
     if not selected_ecs_instances:
-        return True
+        return summary
 
     #
-    # Verify that Cluster services are healthy first
+    # Verify that Cluster services are healthy first, as they are now rather
+    # than as the snapshot cache last saw them
     #
-    service_ids = ecs_client.list_services()
-    service_descriptions = ecs_client.describe_services(service_ids)
+    service_ids = ecs_client.list_services(cached=False)
+    service_descriptions = ecs_client.describe_services(service_ids, cached=False)
     service_issues = []
     for service in service_descriptions.values():
         if service['status'] != SERVICE_ACTIVE:
-            serivce_issues.append(service['serviceName'])
+            service_issues.append(service['serviceName'])
 
     if service_issues:
-        print "ERROR: Not all services are active: %s" % ", ".join(service_issues)
-        return False
+        events.message("ERROR: Not all services are active: %s" % ", ".join(service_issues), level='error')
+        summary['ok'] = False
+        return summary
 
     #
     # Verify that Cluster size is >= largest service count
@@ -352,449 +973,492 @@ def main_rollover(args):
 
         max_count = sorted(counts_to_service.keys(), reverse=True)[0]
         if max_count > len(remaining_instances):
-            print "WARNING: New cluster size (%d) is smaller than largest services: %s (%d)" % (len(remaining_instances), ", ".join(counts_to_service[max_count]), max_count)
-            confirm = raw_input("Do you want to continue [y/N]? ")
-            if confirm.lower() != 'y':
-                return False
+            events.message("WARNING: New cluster size (%d) is smaller than largest services: %s (%d)" % (len(remaining_instances), ", ".join(counts_to_service[max_count]), max_count),
+                           level='warning')
+            if not args.yes and ask("Do you want to continue [y/N]? ").lower() != 'y':
+                summary['ok'] = False
+                return summary
+
+    # learn from the durations of real runs to size future timeouts
+    timing_store = timings.open_store(args.timing_db)
+    if args.dry_run:
+        estimate_rollover(args, ecs_client, timing_store, len(cluster),
+                          selected_ecs_instances, service_descriptions, instance_groups)
+    else:
+        timings.start_recording(timing_store)
 
     #
     # Iterate through each instance
     #
-    skipped_shutdown = []
-    steady_state_errors = set()
-    for ecs_instance in selected_ecs_instances:
-        print "Preparing to remove %s" % (ecs_instance)
-
-        #
-        # Remove ECS instance from scaling group
-        #
-        if args.scale_down:
-            sys.stdout.write("Remove EC2 instance from scaling group...")
-        else:
-            sys.stdout.write("Removing EC2 instance from scaling group and waiting for replacement...")
-        sys.stdout.flush()
-        if not args.dry_run:
-            if args.scale_down:
-                asg.detach_instances([ecs_instance.ec2_id], scale_down=True)
-            else:
-                asg.detach_instances_and_wait([ecs_instance.ec2_id])
-        print "done"
-
-        #
-        # Wait for new ec2 instance to join the ECS cluster
-        #
-        if not args.scale_down and not args.dry_run:
-            new_asg_instances = asg.describe_instances()
-            new_ec2_id = get_added_asg_instances(asg_instances,
-                                                 new_asg_instances)[0]
-            asg_instances = new_asg_instances
-            sys.stdout.write("Waiting for replacement EC2 instance %s to join ECS..." % (new_ec2_id))
-            sys.stdout.flush()
-            while new_ec2_id not in ecs_client.list_active_ec2_instances():
-                time.sleep(10)
-            print "done"
+    budget = None
+    if args.parallel > 1:
+        # every service gives up only as many tasks as its deployment
+        # configuration allows across the drains in flight
+        budget = disruption.DisruptionBudget(disruption.service_budgets(service_descriptions))
+    # the controller and the dashboard share their view of the cluster
+    view = dashboard.ClusterView(ecs_client)
+    controller = None
+    if args.adaptive and args.parallel > 1:
+        # starts with one drain and adds more while the cluster keeps up
+        controller = disruption.DrainController(view, args.parallel)
+    rollover = Rollover(args, ecs_client, ec2_client, asgs, instance_groups, timing_store, budget, controller)
+    board = None
+    if args.dashboard:
+        # the dashboard takes over the terminal until the instances are removed
+        tracker = dashboard.RolloverTracker()
+        board = dashboard.Dashboard(view, tracker)
+        previous_renderer = events.set_renderer(tracker)
+        board.start()
+    if controller:
+        controller.start()
+    try:
+        rollover.remove_instances(selected_ecs_instances)
+    finally:
+        if controller:
+            controller.stop()
+        if board:
+            board.stop()
+            events.set_renderer(previous_renderer)
+    rollover.report()
+    events.emit_api_stats()
 
-        #
-        # Query services and tasks just before calling
-        #
-        # NOTE: If a deployment is made and scheduled to the machine being
-        # removed after the services and tasks are queried, but before
-        # deregister_container_instance() is called, then it wont be tracked
-        # and removed during the rollover. The following calls are grouped
-        # together as closely as possible to minimize this risk.
-        #
-        service_ids = ecs_client.list_services()
-        service_descriptions = ecs_client.describe_services(service_ids)
-        service_events = map_service_events(service_descriptions)
+    if args.scale_down:
+        events.message("Scale down complete!")
+    else:
+        events.message("Rollover complete!")
 
-        task_ids = ecs_client.list_tasks()
-        task_descriptions = ecs_client.describe_tasks(task_ids)
-        ecs_instance_services = map_instance_services(service_descriptions,
-                                                      task_descriptions)
+    summary['removed'] = [i.ec2_id for i in selected_ecs_instances if i not in rollover.skipped_shutdown]
+    summary['steady_state_errors'] = sorted(rollover.steady_state_errors)
+    summary['skipped_shutdown'] = [i.ec2_id for i in rollover.skipped_shutdown]
+    return summary
 
-        #
-        # De-register instances from ECS
-        #
-        sys.stdout.write("De-registering instance from ECS ...")
-        sys.stdout.flush()
-        if not args.dry_run:
-            ecs_client.deregister_container_instance(ecs_instance.ecs_id)
-        print "done"
 
-        #
-        # Wait for task migrations
-        #
-        services_on_instance = ecs_instance_services.get(ecs_instance.ecs_id, [])
-        if services_on_instance:
-            sys.stdout.write("Rolling over services ...")
-            sys.stdout.flush()
-            if not args.dry_run:
-                failed_services = wait_for_all_services(ecs_client,
-                                                        services_on_instance,
-                                                        service_events,
-                                                        service_descriptions)
-                if failed_services:
-                    service_names = [service_descriptions[sid]['serviceName'] for sid in failed_services]
-                    print "ERROR: Timeout while waiting for %s to reach steady state" % (service_names)
-                    steady_state_errors = steady_state_errors.union(service_names)
-            print "done"
-
-            sys.stdout.write("Removing instance from any service Load Balancers ...")
-            sys.stdout.flush()
-            if not args.dry_run:
-                for service_id in services_on_instance:
-                    # remove the current instance from the Load Balancer if there is one
-                    # defined
-                    service = service_descriptions[service_id]
-                    for balancer in service.get('loadBalancers', []):
-                        if 'loadBalancerName' in balancer:
-                            elb_client = elb.ELBClient(balancer['loadBalancerName'])
-                            elb_client.deregister_instances([ecs_instance.ec2_id])
-                        elif 'targetGroupArn' in balancer:
-                            alb_group = alb.NewALBGroup(balancer['targetGroupArn'])
-                            alb_group.deregister_targets([ecs_instance.ec2_id])
-            print "done"
+def load_manifest(path):
+    """
+    Reads a rollover-many manifest, a JSON document of the form:
+    {
+      "defaults": ["--select", "auto:2"],
+      "region_rates": {"us-west-1": 20},
+      "clusters": [
+        {"cluster": "name", "asg": ["asg name", ...], "region": "us-west-1",
+         "command": "rollover", "args": ["--prepull"]}
+      ]
+    }
+    Only "clusters" and its "cluster" keys are required. "asg" may be a
+    single name, and without it the cluster's groups are discovered.
+    @param path: manifest file
+    @return: manifest dictionary
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    for entry in manifest.get('clusters', []):
+        if 'cluster' not in entry:
+            raise ValueError("manifest entries need a cluster: %s" % (entry))
+        if isinstance(entry.get('asg', []), basestring):
+            entry['asg'] = [entry['asg']]
+        if entry.get('command', 'rollover') not in ('rollover', 'scaledown'):
+            raise ValueError("unknown command for %s: %s" % (entry['cluster'], entry['command']))
+    return manifest
+
+
+def run_cluster(entry, command, cluster_args):
+    """
+    Runs the rollover of one manifest entry in the current thread
+    @return: summary dictionary of run_rollover() plus the entry details
+    """
+    started = time.time()
+    with aws.region_context(entry.get('region')), events.context(cluster=entry['cluster']):
+        try:
+            summary = run_rollover(cluster_args)
+        except Exception as e:
+            events.message("ERROR: %s" % (traceback.format_exc()), level='error')
+            summary = dict(ok=False, error=str(e), removed=[], steady_state_errors=[], skipped_shutdown=[])
+    summary.update(cluster=entry['cluster'],
+                   asgs=entry.get('asg', []),
+                   region=entry.get('region'),
+                   command=command,
+                   duration=time.time() - started)
+    return summary
+
+
+def main_rollover_many(args):
+    """
+    Main entry point for the rollover-many command
+    """
+    manifest = load_manifest(args.manifest)
+
+    # build each cluster's arguments up front so mistakes fail before any work
+    jobs = []
+    for entry in manifest['clusters']:
+        command = entry.get('command', 'rollover')
+        command_parser = args.command_parsers[command]
+        cluster_args = command_parser.parse_args(manifest.get('defaults', []) +
+                                                 entry.get('args', []) +
+                                                 [entry['cluster']] + entry.get('asg', []))
+        if not (cluster_args.select or cluster_args.where or cluster_args.older_than):
+            command_parser.error("%s: rollover-many needs --select, --where or --older-than in the manifest" % (entry['cluster']))
+        cluster_args.yes = True
+        # clusters share the terminal
+        cluster_args.dashboard = False
+        cluster_args.dry_run = cluster_args.dry_run or args.dry_run
+        jobs.append((entry, command, cluster_args))
+    if not jobs:
+        return True
 
-        #
-        # stop all the docker containers on the machine
-        #
-        sys.stdout.write("Stopping containers on instance ...")
-        sys.stdout.flush()
-        ip_address = ecs_instance.ip_address
-        if not args.dry_run:
-            # TEST DOCKER IS RUNNING
-            ret, out = run_with_timeout(ecs_instance.ec2_id,
-                                        'docker ps -a -q',
-                                        10)
-            if ret != 0:
-                print "FAILED to run `docker ps`: %s" % (out)
-                print "Skipping shutdown for %s" % (ecs_instance)
-                skipped_shutdown.append(ecs_instance)
-                continue
+    region_rates = manifest.get('region_rates', {})
+    for region in set([entry.get('region') or snapshot.current_region() for entry, _, _ in jobs]):
+        aws.set_region_budget(region, region_rates.get(region, args.region_rate))
 
-            # STOP ALL DOCKER CONTAINERS
-            ret, out = docker_stop(ecs_instance.ec2_id, args.timeout)
-            if ret != 0:
-                print "FAILED"
-                print "WARNING: %s" % (out)
-        print "done stopping docker containers"
+    pool = ThreadPool(min(args.max_clusters, len(jobs)))
+    try:
+        summaries = pool.map(lambda job: run_cluster(*job), jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    events.message("#"*80)
+    events.message("%-30s %-12s %-10s %-7s %8s %9s %8s %10s" % ("cluster", "region", "command", "status",
+                                                                  "removed", "timeouts", "skipped", "duration"))
+    for summary in summaries:
+        events.message("%-30s %-12s %-10s %-7s %8d %9d %8d %10s" % (summary['cluster'],
+                                                                      summary['region'] or "default",
+                                                                      summary['command'],
+                                                                      "ok" if summary['ok'] else "FAILED",
+                                                                      len(summary['removed']),
+                                                                      len(summary['steady_state_errors']),
+                                                                      len(summary['skipped_shutdown']),
+                                                                      planner.format_duration(summary['duration'])))
+    events.emit('rollover_many_report', clusters=summaries)
+    events.emit_api_stats()
+    return all(summary['ok'] for summary in summaries)
+
+
+def container_stop_timeouts(ecs_client, ecs_id, task_descriptions):
+    """
+    Collects the stopTimeout of the containers of the tasks on an instance
+    @param ecs_client: ecs client object
+    @param ecs_id: ecs instance id
+    @param task_descriptions: dictionary of task arns to descriptions
+    @return: dictionary of "<task id>/<container name>" to seconds, for the
+             containers whose task definition sets a stopTimeout
+    """
+    tasks = [task for task in task_descriptions.values()
+             if utils.pull_instance_id(task['containerInstanceArn']) == ecs_id]
+    if not tasks:
+        return {}
+    task_defs = ecs_client.describe_task_definitions(list(set([task['taskDefinitionArn'] for task in tasks])))
+    timeouts = {}
+    for task in tasks:
+        for container in task_defs[task['taskDefinitionArn']]['containerDefinitions']:
+            if 'stopTimeout' in container:
+                key = "%s/%s" % (task['taskArn'].rsplit('/', 1)[-1], container['name'])
+                timeouts[key] = container['stopTimeout']
+    return timeouts
+
+
+def fast_drain(ecs_client, index, ec2_id, deadline, stop_timeout):
+    """
+    Takes an instance out of service before a deadline. It is set to
+    DRAINING in ECS, which moves its tasks elsewhere, and de-registered from
+    its load balancers at the same time, and its containers are stopped with
+    whatever time is left. Nothing is waited on beyond the
+    deadline.
+    @param ecs_client: ecs client object
+    @param index: fastdrain.InstanceIndex of the cluster
+    @param ec2_id: ec2 instance id
+    @param deadline: fastdrain.Deadline
+    @param stop_timeout: longest docker stop timeout to use
+    @return: list of step dictionaries with `step`, `outcome`, `finished_at`
+             (seconds into the budget) and `in_time`
+    """
+    # only the fast-drain and agent commands need it, see cli.py
+    import fastdrain
+    steps = []
+    found = {}
+
+    def run_step(name, description, action):
+        with events.phase(name, description, instance=ec2_id) as result:
+            if deadline.expired():
+                result['outcome'] = 'skipped'
+            else:
+                try:
+                    action(result)
+                except Exception as e:
+                    events.message("ERROR: %s" % (e), level='error', instance=ec2_id)
+                    result.update(outcome='error', error=str(e))
+        steps.append(dict(step=name,
+                          outcome=result['outcome'],
+                          finished_at=deadline.elapsed(),
+                          in_time=not deadline.expired()))
+
+    def query(result):
+        ecs_id = index.lookup(ec2_id)
+        if not ecs_id:
+            events.message("WARNING: %s is not in the cluster" % (ec2_id), level='warning', instance=ec2_id)
+            result['outcome'] = 'skipped'
+            return
+        service_descriptions = ecs_client.describe_services(ecs_client.list_services(cached=False), cached=False)
+        task_descriptions = ecs_client.describe_tasks(ecs_client.list_instance_tasks(ecs_id), cached=False)
+        services = map_instance_services(service_descriptions, task_descriptions).get(ecs_id, [])
+        found['ecs_id'] = ecs_id
+        found['balancers'] = drain.service_load_balancers(services, service_descriptions)
+
+    def ecs_drain(result):
+        if 'ecs_id' not in found:
+            result['outcome'] = 'skipped'
+            return
+        # unlike a forced de-registration, this doesn't orphan the tasks
+        ecs_client.set_draining([found['ecs_id']])
+
+    def lb_drain(result):
+        elb_names, target_group_arns = found.get('balancers', ([], []))
+        if not elb_names and not target_group_arns:
+            result['outcome'] = 'skipped'
+            return
+        undrained = drain.drain_instance(ec2_id, elb_names, target_group_arns,
+                                         deadline.share(fastdrain.LB_DRAIN_SHARE),
+                                         fastdrain.FAST_POLL_INTERVAL)
+        if undrained:
+            result.update(outcome='failed', undrained=undrained)
+
+    def stop_containers(result):
+        timeout = int(min(stop_timeout, deadline.remaining() - fastdrain.SSM_MARGIN))
+        ret, out, stops = ssm.docker_stop(ec2_id, max(fastdrain.MIN_STOP_TIMEOUT, timeout))
+        if ret != 0:
+            events.message("WARNING: %s" % (out), level='warning', instance=ec2_id)
+            result['outcome'] = 'failed'
+        ssm.report_container_stops(ec2_id, stops, result)
+
+    run_step('query', "Looking up the services on %s" % (ec2_id), query)
+
+    # ECS and the load balancers are told at the same time
+    region = aws.current_region()
+    event_context = events.current_context()
+
+    def run(job):
+        with aws.region_context(region), events.context(**event_context):
+            run_step(*job)
+
+    pool = ThreadPool(2)
+    try:
+        pool.map(run, [('ecs_drain', "Setting %s to DRAINING in ECS" % (ec2_id), ecs_drain),
+                       ('lb_drain', "Draining %s from its load balancers" % (ec2_id), lb_drain)])
+    finally:
+        pool.close()
+        pool.join()
 
-        #
-        # Stop and terminate the EC2 instance
-        #
-        sys.stdout.write("Stopping and Terminating instance ...")
-        sys.stdout.flush()
-        if not args.dry_run:
-            ec2_client.stop_and_wait_for_instances([ecs_instance.ec2_id])
-            ec2_client.terminate_and_wait_for_instances([ecs_instance.ec2_id])
-        print "done stopping and terminating instance"
-        print
-
-    # Print the services that had trouble migrating
-    if steady_state_errors:
-        print "#"*80
-        print "The following services timed out while waiting to reach steady state:"
-        for name in steady_state_errors:
-            print name
-
-    # Print the instances that need to be manually shutdown
-    if skipped_shutdown:
-        print "#"*80
-        print "The following instances could not be shutdown."
-        print "They likely still have tasks running on them:"
-        for instance in skipped_shutdown:
-            print instance
+    run_step('docker_stop', "Stopping containers on %s" % (ec2_id), stop_containers)
 
-    if args.scale_down:
-        print "Scale down complete!"
-    else:
-        print "Rollover complete!"
-    return 0
+    events.message("Fast drain of %s (%ds budget):" % (ec2_id, deadline.seconds), instance=ec2_id)
+    for step in steps:
+        events.message("  %-12s %-8s %6.1fs  %s" % (step['step'], step['outcome'], step['finished_at'],
+                                                    "in time" if step['in_time'] else "LATE"),
+                       instance=ec2_id)
+    events.emit('fast_drain_report', instance=ec2_id, budget=deadline.seconds, steps=steps)
+    return steps
 
 
-def wait_for_invocation(ssm_client, command_id, instance_id, timeout):
+def main_fast_drain(args):
     """
-    Wait for results of a ssm command
-    @param ssm_client: ssm client
-    @param command_id: ssm command id as return by send_command()
-    @param instance_id: ec2_id
-    @return: invocation object
+    Main entry point for the fast-drain command
     """
-    started = time.time()
-    while time.time() - started < timeout:
-        paginator = ssm_client.get_paginator('list_command_invocations')
-        for resp in paginator.paginate(CommandId=command_id, InstanceId=instance_id, Details=True):
-            for invocation in resp['CommandInvocations']:
-                if invocation.get('Status') in ["Success", "Cancelled"]:
-                    return invocation
-        time.sleep(1)
-    return None
-
-
-def run_with_timeout(instance_id, command, timeout):
-    """
-    Run a shell command on an ec2 instance
-    @param instance_id str
-    @param command str
-    @param timeout int
-    @return tuple of (return code, error message/output)
-    """
-    client = boto3.client('ssm')
-    # Note: TimeoutSeconds is the timeout for AWS to begin running the command
-    try:
-        response = client.send_command(
-            InstanceIds=[instance_id],
-            DocumentName='AWS-RunShellScript',
-            TimeoutSeconds=3600,
-            Comment='',
-            Parameters={
-                'commands': ["#!/bin/bash", command]
-            },
-            OutputS3BucketName=EC2_RUN_OUTPUT_S3_BUCKET,
-            OutputS3KeyPrefix='rollover-' + datetime.datetime.now().strftime('%Y%m%d')
-        )
-    except Exception as e:
-        ex_type, ex, tb = sys.exc_info()
-        err_msg = "\n".join(traceback.format_tb(tb) + [str(e)])
-        return -1, "SSM Error: failed to send SSM command to AWS:\n%s" % (err_msg)
-
-    # Error sending response
-    if response.get('ResponseMetadata', {}).get('HTTPStatusCode') is not 200:
-        return -1, "SSM ERROR: failed to send command. %s" % (response)
-
-    command_id = response.get('Command').get('CommandId')
-    # Not sure when/if this actually happens; adding as a safeguard for now.
-    if not command_id:
-        return -1, "SSM ERROR: could not find command ID in response"
-
-    invocation = wait_for_invocation(client, command_id, instance_id, timeout)
-    if not invocation or 'CommandPlugins' not in invocation:
-        return -1, "ERROR: Timed out while waiting for `%s`" % (command)
-
-    return_code = None
-    output = ""
-    for plugin in invocation['CommandPlugins']:
-        if "ResponseCode" in plugin:
-            return_code = plugin['ResponseCode']
-            output = plugin['Output']
-
-    if return_code is None:
-        return -1, "SSM ERROR: failed to get return code"
-    return return_code, output
-
-
-def docker_stop(ec2_id, timeout):
-    """
-    Stop all docker containers
-    """
-    command = 'docker ps -q | xargs -n 1 -P 40 docker stop -t %d' % timeout
-    return run_with_timeout(ec2_id, command, timeout + 2)
-
-
-def main_docker_stop(args):
-    """
-    Main entry point for the docker-stop command
-    """
-    sys.stdout.write("Stopping all containers on %s ..." % (args.ec2_id))
-    sys.stdout.flush()
-    ret, out = docker_stop(args.ec2_id, args.timeout)
-    if ret != 0:
-        print "FAILED"
-        print out
-    else:
-        print "Done"
-    return ret == 0
-
+    if not args.watch and not args.ec2_ids:
+        events.message("ERROR: give instance ids or --watch", level='error')
+        return False
 
-def main_check_for_task(args):
-    sys.stdout.write("Querying ECS ...")
-    sys.stdout.flush()
+    import fastdrain
 
     ecs_client = ecs.ECSClient(args.cluster)
-    ec2_client = ec2.EC2Client()
-    instance_map = {}
-    for instance in ecs_client.list_container_instances():
-        ecs_instance = ECSInstance(ecs_client, ec2_client, instance)
-        instance_map[ecs_instance.ecs_id] = ecs_instance
-
-    running_map = get_matching_tasks_by_hosts(ecs_client,
-                                              ec2_client,
-                                              args.task_name_expr)
-    print "Done"
-
-    for ecs_id in sorted(running_map):
-        running_task_defs = running_map[ecs_id]
-        instance = instance_map[ecs_id]
-
-        if args.invert_match and not running_task_defs:
-            print "%s (%s, %12s) - NO MATCH" % (ecs_id,
-                                                instance.ec2_id,
-                                                instance.ip_address)
-        elif not args.invert_match and running_task_defs:
-            print "%s (%s, %12s) - RUNNING %s" % (ecs_id,
-                                                  instance.ec2_id,
-                                                  instance.ip_address,
-                                                  ", ".join(running_task_defs))
-
-    matched = sum([1 if defs else 0 for defs in running_map.values()])
-    if args.invert_match:
-        no_match = len(instance_map) - matched
-        print "%d of %d hosts do NOT match the pattern `%s`" % (no_match,
-                                                                len(instance_map),
-                                                                args.task_name_expr)
+    index = fastdrain.InstanceIndex(ecs_client)
+    if args.watch:
+        # look up the cluster now so the first notice doesn't pay for it
+        with index.lock:
+            index.refresh()
+        notices = fastdrain.interruptions(args.watch, args.budget)
     else:
-        print "%d of %d hosts have running tasks that matched the pattern `%s`" % (matched,
-                                                                                   len(instance_map),
-                                                                                   args.task_name_expr)
-
+        notices = [(ec2_id, args.budget) for ec2_id in args.ec2_ids]
 
-def main():
-    parser = argparse.ArgumentParser()
-    subparsers = parser.add_subparsers()
+    # the pool threads act on behalf of this one
+    region = aws.current_region()
+    event_context = events.current_context()
 
-    #
-    # Rollover args
-    #
-    rollover_parser = subparsers.add_parser('rollover',
-                                            help="rollover ECS nodes")
-    rollover_parser.set_defaults(func=main_rollover, scale_down=False)
-
-    rollover_parser.add_argument('-t',
-                                 '--timeout',
-                                 type=int,
-                                 default=30,
-                                 help="`docker stop` timeout (per container)")
-    rollover_parser.add_argument('-s',
-                                 '--sort',
-                                 choices=['launch_time', 'utilization'],
-                                 default="launch_time",
-                                 help="sorts instances by 'launch_time' or 'utilization'. "
-                                        "If not provided, defaults to 'launch_time'")
-    rollover_parser.add_argument('--dry-run',
-                                 action="store_true",
-                                 default=False,
-                                 help="dry run. Don't actually make changes.")
-    rollover_parser.add_argument('cluster',
-                                 help="fully qualified name of the cluster")
-    rollover_parser.add_argument('asg',
-                                 help="auto scaling group for the cluster")
-
-    #
-    # Scaledown args
-    #
-    scaledown_parser = subparsers.add_parser('scaledown',
-                                             help="remove ECS nodes")
-    scaledown_parser.set_defaults(func=main_rollover, scale_down=True)
-
-    scaledown_parser.add_argument('-t',
-                                  '--timeout',
-                                  type=int,
-                                  default=30,
-                                  help="`docker stop` timeout (per container)")
-    scaledown_parser.add_argument('-s',
-                                 '--sort',
-                                 choices=['launch_time', 'utilization'],
-                                 default="launch_time",
-                                 help="sorts instances by 'launch_time' or 'utilization'. "
-                                        "If not provided, defaults to 'launch_time'")
-    scaledown_parser.add_argument('--dry-run',
-                                  action="store_true",
-                                  default=False,
-                                  help="dry run. Don't actually make changes.")
-    scaledown_parser.add_argument('cluster',
-                                  help="fully qualified name of the cluster")
-    scaledown_parser.add_argument('asg',
-                                  help="auto scaling group for the cluster")
+    def drain_one(ec2_id, deadline):
+        with aws.region_context(region), events.context(**event_context):
+            steps = fast_drain(ecs_client, index, ec2_id, deadline, args.timeout)
+        return all(step['outcome'] in ('ok', 'skipped') and step['in_time'] for step in steps)
 
-    #
-    # alb-detach args
-    #
-    alb_detach_parser = subparsers.add_parser('alb-detach',
-                                              help="Remove an EC2 instance "
-                                                   "from ALBs")
-    alb_detach_parser.set_defaults(func=alb.main_detach)
-
-    alb_detach_parser.add_argument('ec2_id',
-                                   help="EC2 instance id")
-    alb_detach_parser.add_argument('target_group_arn',
-                                   nargs='*',
-                                   help="ALB target group ARN to detach from. "
-                                        "If not provided, all will be queried")
+    pool = ThreadPool(args.max_instances)
+    results = []
+    try:
+        for ec2_id, seconds in notices:
+            # the clock starts when the notice is read, not when a thread frees up
+            results.append(pool.apply_async(drain_one, (ec2_id, fastdrain.Deadline(seconds))))
+    finally:
+        pool.close()
+        pool.join()
+    return all(result.get() for result in results)
 
-    #
-    # elb-detach args
-    #
-    elb_detach_parser = subparsers.add_parser('elb-detach',
-                                              help="Remove an EC2 instance "
-                                                   "from ELBs")
-    elb_detach_parser.set_defaults(func=elb.main_detach)
-
-    elb_detach_parser.add_argument('ec2_id',
-                                   help="EC2 instance id")
-    elb_detach_parser.add_argument('load_balancer_name',
-                                   nargs='*',
-                                   help="load balancer to detach from. "
-                                        "If not provided, all will be queried")
 
-    #
-    # docker-stop args
-    #
-    docker_stop_parser = subparsers.add_parser('docker-stop',
-                                               help="stop docker containers on"
-                                                    " an ec2 instance")
-    docker_stop_parser.set_defaults(func=main_docker_stop)
-
-    docker_stop_parser.add_argument('-t',
-                                    '--timeout',
-                                    type=int,
-                                    default=30,
-                                    help="`docker stop` timeout (per container)")
-    docker_stop_parser.add_argument('ec2_id',
-                                    help="EC2 instance id")
+def drain_terminating_instance(args, ecs_client, ec2_client, index, timing_store, notification):
+    """
+    Runs the de-register, steady state, load balancer and docker stop steps
+    for an instance its auto scaling group is terminating, then lets the
+    group carry on
+    @param args: agent arguments
+    @param ecs_client: ecs client object
+    @param ec2_client: ec2 client object
+    @param index: fastdrain.InstanceIndex of the cluster
+    @param timing_store: timings.TimingStore or NullTimingStore
+    @param notification: lifecycle notification dictionary
+    @return: true if the instance was drained cleanly
+    """
+    import lifecycle
+    ec2_id = notification['EC2InstanceId']
+    asg = scaling.AutoScalingGroup(notification['AutoScalingGroupName'])
+    drained = True
+    with events.context(instance=ec2_id, asg=asg.scaling_group):
+        try:
+            with lifecycle.Heartbeat(asg, notification, args.heartbeat_interval):
+                ecs_id = index.lookup(ec2_id)
+                if ecs_id is None:
+                    events.message("%s is not in %s, nothing to drain" % (ec2_id, args.cluster))
+                else:
+                    cluster = describe_inventory(ecs_client, ec2_client, [ecs_id])
+                    rollover = Rollover(args, ecs_client, ec2_client, {}, {}, timing_store)
+                    # the group terminates the instance once the action completes
+                    rollover.retire_instance(ECSInstance(cluster, 0), None, terminate=False)
+                    rollover.report()
+                    drained = not rollover.steady_state_errors and not rollover.skipped_shutdown
+        except Exception:
+            events.message("ERROR: failed to drain %s: %s" % (ec2_id, traceback.format_exc()), level='error')
+            drained = False
+        finally:
+            # the instance is going away either way, don't hold the group up
+            with events.phase('lifecycle_complete', "Completing lifecycle action %s" % (notification['LifecycleHookName'])):
+                asg.complete_lifecycle_action(notification['LifecycleHookName'],
+                                              notification['LifecycleActionToken'],
+                                              ec2_id)
+    return drained
+
+
+def main_agent(args):
+    """
+    Main entry point for the agent command
+    """
+    if not args.queue and not args.listen:
+        events.message("ERROR: give --queue or --listen", level='error')
+        return False
 
-    #
-    # ec2-stop args
-    #
-    ec2_stop_parser = subparsers.add_parser('ec2-stop',
-                                            help="Stop EC2 instances")
-    ec2_stop_parser.set_defaults(func=ec2.main_stop)
+    import fastdrain
+    import lifecycle
 
-    ec2_stop_parser.add_argument('ec2_id',
-                                 nargs='+',
-                                 help="EC2 instance id")
+    ecs_client = ecs.ECSClient(args.cluster)
+    ec2_client = ec2.EC2Client()
+    index = fastdrain.InstanceIndex(ecs_client)
+    timing_store = timings.open_store(args.timing_db)
+    timings.start_recording(timing_store)
 
-    #
-    # ec2-terminate args
-    #
-    ec2_terminate_parser = subparsers.add_parser('ec2-terminate',
-                                                 help="Terminate EC2 instances")
-    ec2_terminate_parser.set_defaults(func=ec2.main_terminate)
+    # the pool threads act on behalf of this one
+    region = aws.current_region()
+    event_context = events.current_context()
 
-    ec2_terminate_parser.add_argument('ec2_id',
-                                      nargs='+',
-                                      help="EC2 instance id")
+    # the agent runs for as long as notifications come in, so only the
+    # instances that failed to drain are kept, not every result
+    failed = []
 
-    #
-    # check for a task
-    #
-    check_task_parser = subparsers.add_parser('check-task',
-                                              help="return a list of ECS instances running the given task")
-    check_task_parser.set_defaults(func=main_check_for_task)
+    def drain_one(notification):
+        ec2_id = notification['EC2InstanceId']
+        with aws.region_context(region), events.context(**event_context):
+            try:
+                drained = drain_terminating_instance(args, ecs_client, ec2_client, index,
+                                                     timing_store, notification)
+            except Exception:
+                events.message("ERROR: failed to drain %s: %s" % (ec2_id, traceback.format_exc()),
+                               level='error', instance=ec2_id)
+                drained = False
+            if not drained:
+                events.message("%s did not drain cleanly" % (ec2_id), level='error', instance=ec2_id)
+                failed.append(ec2_id)
+
+    events.message("Waiting for lifecycle notifications for %s" % (args.cluster))
+    pool = ThreadPool(args.max_instances)
+    try:
+        for notification in lifecycle.notifications(args.queue, args.listen):
+            events.message("%s is terminating (%s)" % (notification['EC2InstanceId'],
+                                                       notification['AutoScalingGroupName']))
+            pool.apply_async(drain_one, (notification,))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close()
+        pool.join()
+    if failed:
+        events.message("Instances that did not drain cleanly: %s" % (", ".join(failed)), level='error')
+    return not failed
+
+
+def main_watch(args):
+    """
+    Main entry point for the watch command
+    """
+    board = dashboard.Dashboard(dashboard.ClusterView(ecs.ECSClient(args.cluster)),
+                                interval=args.interval)
+    if args.once:
+        board.view.refresh()
+        board.draw(clear=False)
+        return True
+    try:
+        board.run()
+    except KeyboardInterrupt:
+        pass
+    return True
 
-    check_task_parser.add_argument('-v',
-                                   '--invert-match',
-                                   action="store_true",
-                                   default=False,
-                                   help="Print the ECS instances NOT running the task")
-    check_task_parser.add_argument('cluster',
-                                   help="fully qualified name of the cluster")
-    check_task_parser.add_argument('task_name_expr',
-                                   help="task definition name (wildcards accepted)")
 
-    args = parser.parse_args()
-    if not args.func(args):
-        sys.exit(1)
+def main_check_for_task(args):
+    with events.phase('query', "Querying ECS"):
+        cache = snapshot.open_cache(args.cluster, args.cache_ttl)
+        ecs_client = ecs.ECSClient(args.cluster, cache)
+        ec2_client = ec2.EC2Client(cache)
+        all_ecs_ids = sorted(ecs_client.list_container_instances())
+        running_map = get_matching_tasks_by_hosts(ecs_client,
+                                                  args.task_name_expr)
+
+    # only describe the hosts that are going to be printed
+    if args.invert_match:
+        ecs_ids = [i for i in all_ecs_ids if i not in running_map]
+    else:
+        ecs_ids = sorted(running_map)
+
+    for ecs_id, ec2_id, ip_address in iter_host_details(ecs_client, ec2_client, ecs_ids):
+        tasks = running_map.get(ecs_id, [])
+        if args.invert_match:
+            text = "%s (%s, %12s) - NO MATCH" % (ecs_id,
+                                                 ec2_id,
+                                                 ip_address)
+        else:
+            text = "%s (%s, %12s) - RUNNING %s" % (ecs_id,
+                                                   ec2_id,
+                                                   ip_address,
+                                                   ", ".join(tasks))
+        events.emit('check_task_host', text=text, ecs_id=ecs_id, ec2_id=ec2_id,
+                    ip_address=ip_address, tasks=tasks)
+
+    matched = len([i for i in all_ecs_ids if i in running_map])
+    if args.invert_match:
+        no_match = len(all_ecs_ids) - matched
+        text = "%d of %d hosts do NOT match the pattern `%s`" % (no_match,
+                                                                 len(all_ecs_ids),
+                                                                 args.task_name_expr)
+    else:
+        text = "%d of %d hosts have running tasks that matched the pattern `%s`" % (matched,
+                                                                                    len(all_ecs_ids),
+                                                                                    args.task_name_expr)
+    events.emit('check_task_summary', text=text, pattern=args.task_name_expr,
+                invert_match=args.invert_match, matched=matched, hosts=len(all_ecs_ids))
+    return True
 
 
 if __name__ == "__main__":
-    main()
+    # kept for callers of rollover.py, see cli.py
+    import cli
+    cli.main()
@@ -2,26 +2,74 @@
 module for interacting with auto scaling groups
 """
 
-import boto3
 from operator import itemgetter
+import re
+import threading
 import time
 
 # local imports
+import aws
+import snapshot
 import utils
 
+# description of the activity launching an instance
+LAUNCH_DESCRIPTION = re.compile(r'^Launching a new EC2 instance: (i-[0-9a-f]+)')
+
+# ec2 instance ids mentioned in an activity's cause
+INSTANCE_ID = re.compile(r'\bi-[0-9a-f]+\b')
+
+# what the cause of a launch replacing a detached instance says about it
+# (ex. "a user request detached EC2 instance i-... from the group")
+DETACHED_CAUSE = re.compile(r'\bdetached\b', re.IGNORECASE)
+
+# instance ids accepted by a single describe_auto_scaling_instances call
+DESCRIBE_INSTANCES_BATCH_SIZE = 50
+
+
+def describe_instance_groups(instance_ids, cache=None):
+    """
+    Looks up the auto scaling group each instance belongs to
+    @param instance_ids: list of ec2 instance ids
+    @param cache: optional snapshot cache
+    @return: dictionary of ec2 instance ids to auto scaling group names.
+             Instances outside of any group are left out
+    """
+    cache = cache or snapshot.NullCache()
+    client = aws.client('autoscaling')
+
+    def fetch(ids):
+        groups = {}
+        for batch in utils.batch_list(DESCRIBE_INSTANCES_BATCH_SIZE, ids):
+            resp = client.describe_auto_scaling_instances(InstanceIds=batch,
+                                                          MaxRecords=DESCRIBE_INSTANCES_BATCH_SIZE)
+            for instance in resp['AutoScalingInstances']:
+                groups[instance['InstanceId']] = instance['AutoScalingGroupName']
+        return groups
+
+    return cache.lookup('asg_membership', instance_ids, fetch)
+
 
 class AutoScalingGroup(object):
     """
     Client for interacting with a auto scaling group
     """
-    def __init__(self, scaling_group):
-        self.client = boto3.client('autoscaling')
+    def __init__(self, scaling_group, cache=None):
+        self.client = aws.client('autoscaling')
         self.scaling_group = scaling_group
+        self.cache = cache or snapshot.NullCache()
+        # launch activities already paired with a detached instance
+        self.claimed_activities = set()
+        self.lock = threading.Lock()
 
-    def describe_instances(self):
+    def describe_instances(self, cached=True):
         """
+        @param cached: if false, skip the snapshot cache
         @return: list of attached instance dicts
         """
+        return self.cache.value('asg_instances', self.scaling_group,
+                                self._describe_instances, cached)
+
+    def _describe_instances(self):
         info = []
         paginator = self.client.get_paginator('describe_auto_scaling_groups')
         for resp in paginator.paginate(AutoScalingGroupNames=[self.scaling_group]):
@@ -30,15 +78,28 @@ class AutoScalingGroup(object):
         # Only queried one ASG
         return info[0].get('Instances', [])
 
-    def describe_scaling_activities(self):
+    def describe_scaling_activities(self, cached=True, since=None):
         """
+        @param cached: if false, skip the snapshot cache
+        @param since: optional datetime. If given, only the pages of
+                      activities up to the first one started before it are
+                      fetched (activities come newest first), bypassing the
+                      snapshot cache
         @return: list of recent activities
         """
+        if since is not None:
+            return self._describe_scaling_activities(since)
+        return self.cache.value('scaling_activities', self.scaling_group,
+                                self._describe_scaling_activities, cached)
+
+    def _describe_scaling_activities(self, since=None):
         activities = []
 
         paginator = self.client.get_paginator('describe_scaling_activities')
         for resp in paginator.paginate(AutoScalingGroupName=self.scaling_group):
             activities += resp['Activities']
+            if since is not None and any(a['StartTime'] < since for a in resp['Activities']):
+                break
         return activities
 
     def detach_instances(self, instance_ids, scale_down=False):
@@ -47,39 +108,100 @@ class AutoScalingGroup(object):
         @param scale_down: if true will not replace the instance
         @return: list of activities from detaching
         """
+        self.cache.invalidate()
         resp = self.client.detach_instances(AutoScalingGroupName=self.scaling_group,
                                             InstanceIds=instance_ids,
                                             ShouldDecrementDesiredCapacity=scale_down)
         return resp['Activities']
 
-    def detach_instances_and_wait(self, instance_ids):
+    def record_lifecycle_heartbeat(self, hook_name, token, instance_id):
+        """
+        extends the timeout of a pending lifecycle action
+        @param hook_name: lifecycle hook name
+        @param token: lifecycle action token from the notification
+        @param instance_id: ec2 instance id
         """
-        detach instances and wait for their replacements to become ready
+        self.client.record_lifecycle_action_heartbeat(AutoScalingGroupName=self.scaling_group,
+                                                      LifecycleHookName=hook_name,
+                                                      LifecycleActionToken=token,
+                                                      InstanceId=instance_id)
+
+    def complete_lifecycle_action(self, hook_name, token, instance_id, result='CONTINUE'):
+        """
+        lets the auto scaling group carry on with a lifecycle transition
+        @param hook_name: lifecycle hook name
+        @param token: lifecycle action token from the notification
+        @param instance_id: ec2 instance id
+        @param result: "CONTINUE" or "ABANDON"
+        """
+        self.cache.invalidate()
+        self.client.complete_lifecycle_action(AutoScalingGroupName=self.scaling_group,
+                                              LifecycleHookName=hook_name,
+                                              LifecycleActionToken=token,
+                                              InstanceId=instance_id,
+                                              LifecycleActionResult=result)
+
+    def detach_instances_and_wait(self, instance_ids, timeout=300, poll_interval=10):
+        """
+        detach instances and wait for their replacements to launch
         @param instance_ids: list of ec2 instance ids to detach and replace
-        @return: most recent activity
+        @param timeout: seconds to wait for the replacements
+        @param poll_interval: seconds between checks
+        @return: dictionary of detached ec2 ids to the ids of their
+                 replacements, or None for those that timed out
         """
         activities = self.detach_instances(instance_ids)
-        activities.sort(key=itemgetter('StartTime'))
-        self.wait_for_instance_launch(activities[-1], len(instance_ids))
+        detached_at = min(a['StartTime'] for a in activities)
+
+        replacements = dict((instance_id, None) for instance_id in instance_ids)
+        started = time.time()
+        while True:
+            for instance_id, activity in self.match_replacements(instance_ids, detached_at).items():
+                replacements[instance_id] = activity_instance_id(activity)
+            if all(replacements.values()) or time.time() - started > timeout:
+                return replacements
+            time.sleep(poll_interval)
 
-    def wait_for_instance_launch(self, last_activity, count):
+    def match_replacements(self, instance_ids, detached_at):
         """
-        blocks until the activity stream shows `count` instances become ready.
-        @param last_activity: the last seen activity. All older activities will be filtered out
-        @param count: number of instances to wait for
-        @return: most recent activity
+        Pairs detached instances with the successful launch activities they
+        caused. A launch is only paired with an instance its cause says was
+        detached (ex. "a user request detached EC2 instance i-... from the
+        group"), launches for anything else (ex. scaling policies, health
+        check replacements) are left alone. Launches are only ever paired
+        once.
+        @param instance_ids: list of detached ec2 instance ids
+        @param detached_at: start time of the detach activities
+        @return: dictionary of ec2 ids to launch activities
         """
-        new_activities = []
-        TIMEOUT = 300
-        started = time.time()
-        while len(new_activities) < count:
-            if time.time() - started > TIMEOUT:
-                return last_activity
+        launches = []
+        for activity in self.describe_scaling_activities(cached=False, since=detached_at):
+            if (activity['StartTime'] >= detached_at and activity['Progress'] == 100 and
+                    activity.get('StatusCode') == 'Successful' and activity_instance_id(activity)):
+                launches.append(activity)
+        launches.sort(key=itemgetter('StartTime'))
+
+        with self.lock:
+            matched = {}
+            for activity in launches:
+                if activity['ActivityId'] in self.claimed_activities:
+                    continue
+                cause = activity.get('Cause', '')
+                if not DETACHED_CAUSE.search(cause):
+                    continue
+                named = [i for i in INSTANCE_ID.findall(cause) if i in instance_ids and i not in matched]
+                if named:
+                    matched[named[0]] = activity
 
-            time.sleep(10)
-            for activity in self.describe_scaling_activities():
-                if activity['StartTime'] > last_activity['StartTime']:
-                    if activity['Progress'] == 100:
-                        new_activities.append(activity)
+            for activity in matched.values():
+                self.claimed_activities.add(activity['ActivityId'])
+        return matched
 
-        return sorted(new_activities, key=itemgetter('StartTime'))[-1]
+
+def activity_instance_id(activity):
+    """
+    @param activity: scaling activity
+    @return: id of the instance a launch activity started, or None for other activities
+    """
+    match = LAUNCH_DESCRIPTION.match(activity.get('Description', ''))
+    return match.group(1) if match else None
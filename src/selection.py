@@ -0,0 +1,267 @@
+"""
+module for choosing which ECS instances to remove
+"""
+
+import argparse
+import datetime
+import fnmatch
+import itertools
+import operator
+import re
+import time
+
+# local imports
+import utils
+
+# weights of the migration cost of an instance
+SINGLETON_COST = 100    # per service with all of its tasks on the instance
+TASK_COST = 10          # per task on the instance
+MEMORY_COST_UNIT = 128  # MiB of reserved memory that cost 1
+
+# --where fields and the inventory columns they are read from
+WHERE_FIELDS = dict(
+    ami='image_id',
+    agent='agent_version',
+    type='instance_type',
+    az='availability_zone',
+)
+
+# fields compared as dotted versions rather than as glob patterns
+VERSION_FIELDS = ['agent']
+
+WHERE_OPERATORS = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+WHERE_PATTERN = re.compile(r'^\s*(\w+)\s*(==|!=|<=|>=|=|<|>)\s*(\S+)\s*$')
+
+# --older-than units
+AGE_UNITS = dict(
+    m=datetime.timedelta(minutes=1),
+    h=datetime.timedelta(hours=1),
+    d=datetime.timedelta(days=1),
+    w=datetime.timedelta(weeks=1),
+)
+
+
+def parse_select(value):
+    """
+    argparse type for --select
+    @param value: string of the form "auto:N" or "all"
+    @return: tuple of (mode, number of instances to pick or None)
+    """
+    if value == 'all':
+        return 'all', None
+    mode, _, count = value.partition(':')
+    if mode != 'auto' or not count.isdigit() or int(count) < 1:
+        raise argparse.ArgumentTypeError("expected auto:N or all, got %r" % (value))
+    return mode, int(count)
+
+
+def parse_version(value):
+    """
+    @param value: dotted version string (ex. "1.14.1" or "v1.14.1")
+    @return: tuple of ints, comparable with other versions
+    """
+    parts = []
+    for part in value.lstrip('v').split('.'):
+        digits = re.match(r'\d*', part).group()
+        parts.append(int(digits or 0))
+    return tuple(parts)
+
+
+class Where(object):
+    """
+    A --where predicate on a column of an inventory.Inventory
+    """
+    def __init__(self, field, op, value):
+        self.field = field
+        self.op = op
+        self.value = value
+
+    @property
+    def column(self):
+        return WHERE_FIELDS[self.field]
+
+    def test(self, actual):
+        """
+        @param actual: value of the column for an instance
+        @return: true if the value matches
+        """
+        if actual is None:
+            return False
+        compare = WHERE_OPERATORS[self.op]
+        if self.field in VERSION_FIELDS:
+            return compare(parse_version(actual), parse_version(self.value))
+        # string fields match glob patterns (ex. "type=m4.*")
+        return compare(fnmatch.fnmatchcase(actual, self.value), True)
+
+    def __repr__(self):
+        return "%s%s%s" % (self.field, self.op, self.value)
+
+
+def parse_where(value):
+    """
+    argparse type for --where
+    @param value: string of the form "<field><operator><value>" (ex. "agent<1.50")
+    @return: Where()
+    """
+    match = WHERE_PATTERN.match(value)
+    if not match:
+        raise argparse.ArgumentTypeError("expected <field><operator><value>, got %r" % (value))
+    field, op, expected = match.groups()
+    if field not in WHERE_FIELDS:
+        raise argparse.ArgumentTypeError("unknown field %r, expected one of %s" % (field, ", ".join(sorted(WHERE_FIELDS))))
+    if field not in VERSION_FIELDS and op not in ('=', '==', '!='):
+        raise argparse.ArgumentTypeError("%s can only be compared with = or !=" % (field))
+    return Where(field, op, expected)
+
+
+def parse_age(value):
+    """
+    argparse type for --older-than
+    @param value: string of the form "<number><unit>" with a unit of m, h, d or w (ex. "30d")
+    @return: datetime.timedelta
+    """
+    match = re.match(r'^(\d+)([%s])$' % ("".join(AGE_UNITS)), value.strip())
+    if not match:
+        raise argparse.ArgumentTypeError("expected <number><m|h|d|w>, got %r" % (value))
+    return int(match.group(1)) * AGE_UNITS[match.group(2)]
+
+
+def filter_rows(cluster, wheres=None, older_than=None, now=None):
+    """
+    @param cluster: inventory.Inventory
+    @param wheres: list of Where() predicates that must all match
+    @param older_than: optional datetime.timedelta instances must have been
+                       running for
+    @param now: optional unix time to measure ages against (defaults to now)
+    @return: list of matching rows
+    """
+    rows = cluster.rows()
+    for where in wheres or []:
+        rows = cluster.filter_rows(where.column, where.test, rows)
+    if older_than is not None:
+        cutoff = (now or time.time()) - older_than.total_seconds()
+        rows = cluster.filter_rows('launch_time', lambda launched: launched <= cutoff, rows)
+    return rows
+
+
+def map_instance_service_tasks(service_descriptions, task_descriptions):
+    """
+    Counts the service tasks on each ECS instance
+    @param service_descriptions: dictionary of service ids to descriptions
+    @param task_descriptions: dictionary of task arns to descriptions
+    @return: dictionary of ecs_ids to dictionaries of service ids to task counts
+    """
+    defs_to_services = {}
+    for service_id, desc in service_descriptions.items():
+        defs_to_services[desc['taskDefinition']] = service_id
+
+    instance_tasks = {}
+    for task in task_descriptions.values():
+        service_id = defs_to_services.get(task['taskDefinitionArn'])
+        if service_id is None:
+            # only look at tasks with services (ignore instance startup tasks)
+            continue
+        ecs_id = utils.pull_instance_id(task['containerInstanceArn'])
+        counts = instance_tasks.setdefault(ecs_id, {})
+        counts[service_id] = counts.get(service_id, 0) + 1
+    return instance_tasks
+
+
+def migration_costs(ecs_instances, service_descriptions, task_descriptions):
+    """
+    Scores how expensive it is to move the tasks off each instance: the
+    number of tasks, their reserved memory and the services that would lose
+    every running task at once
+    @param ecs_instances: list of ECSInstance() objects
+    @param service_descriptions: dictionary of service ids to descriptions
+    @param task_descriptions: dictionary of task arns to descriptions
+    @return: dictionary of ecs_ids to costs
+    """
+    instance_tasks = map_instance_service_tasks(service_descriptions, task_descriptions)
+    service_totals = {}
+    for counts in instance_tasks.values():
+        for service_id, count in counts.items():
+            service_totals[service_id] = service_totals.get(service_id, 0) + count
+
+    costs = {}
+    for ecs_instance in ecs_instances:
+        counts = instance_tasks.get(ecs_instance.ecs_id, {})
+        singletons = 0
+        for service_id, count in counts.items():
+            if count >= service_totals[service_id] or service_descriptions[service_id]['desiredCount'] <= 1:
+                singletons += 1
+        costs[ecs_instance.ecs_id] = (SINGLETON_COST * singletons +
+                                      TASK_COST * sum(counts.values()) +
+                                      float(ecs_instance.mem_reserved) / MEMORY_COST_UNIT)
+    return costs
+
+
+def az_max_diff(az_counts):
+    """
+    @param az_counts: dictionary of (auto scaling group, availability zone)
+                      to instance counts
+    @return: largest difference in instance count between two zones of the
+             same group. Each group is balanced on its own
+    """
+    max_diff = 0
+    for a, b in itertools.combinations(az_counts.keys(), 2):
+        if a[0] == b[0]:
+            max_diff = max(max_diff, abs(az_counts[a] - az_counts[b]))
+    return max_diff
+
+
+def pick_cheapest(ecs_instances, asg_contents, costs, count, instance_groups=None):
+    """
+    Picks the `count` instances with the lowest migration cost while keeping
+    each auto scaling group balanced across availability zones
+    @param ecs_instances: list of ECSInstance() objects
+    @param asg_contents: dictionary of ec2_ids to availability zones in the ASG
+    @param costs: dictionary of ecs_ids to migration costs
+    @param count: number of instances to pick
+    @param instance_groups: optional dictionary of ec2_ids to ASG names, when
+                            the cluster is backed by several groups
+    @return: list of picked ECSInstance() objects, cheapest first
+    """
+    instance_groups = instance_groups or {}
+    zones = dict((ec2_id, (instance_groups.get(ec2_id), az)) for ec2_id, az in asg_contents.items())
+    az_counts = {}
+    for zone in zones.values():
+        az_counts[zone] = az_counts.get(zone, 0) + 1
+    allowed_diff = max(1, az_max_diff(az_counts))
+
+    candidates = sorted(ecs_instances, key=lambda i: costs[i.ecs_id])
+    picked = []
+    while candidates and len(picked) < count:
+        choice = None
+        for ecs_instance in candidates:
+            zone = zones.get(ecs_instance.ec2_id)
+            if zone is None:
+                # not in the ASG, removing it can't unbalance the zones
+                choice = ecs_instance
+                break
+            az_counts[zone] -= 1
+            balanced = az_max_diff(az_counts) <= allowed_diff
+            az_counts[zone] += 1
+            if balanced:
+                choice = ecs_instance
+                break
+
+        if choice is None:
+            # every choice unbalances a group, take the cheapest instance
+            # from the largest zone
+            choice = max(candidates, key=lambda i: az_counts[zones[i.ec2_id]])
+
+        candidates.remove(choice)
+        picked.append(choice)
+        if choice.ec2_id in zones:
+            az_counts[zones[choice.ec2_id]] -= 1
+    return picked
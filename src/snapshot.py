@@ -0,0 +1,215 @@
+"""
+on-disk snapshot cache for read-only AWS descriptions
+"""
+
+import atexit
+import cPickle as pickle
+import errno
+import os
+import threading
+import time
+
+# local imports
+import aws
+
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.ecs-rollover/cache')
+
+
+class NullCache(object):
+    """
+    Stand-in used when caching is disabled. Every lookup goes to AWS.
+    """
+    def lookup(self, namespace, keys, fetch, cached=True):
+        return fetch(keys) if keys else {}
+
+    def stream(self, namespace, keys, fetch, cached=True):
+        return fetch(keys) if keys else iter([])
+
+    def value(self, namespace, key, fetch, cached=True):
+        return fetch()
+
+    def invalidate(self):
+        pass
+
+
+class SnapshotCache(NullCache):
+    """
+    Cache of list/describe results for a single cluster and region. Entries
+    expire after `ttl` seconds and the whole snapshot is dropped whenever a
+    mutating call is made through one of the clients sharing it.
+    """
+    def __init__(self, cluster, region, ttl, cache_dir=DEFAULT_CACHE_DIR):
+        self.path = os.path.join(cache_dir, region or 'default', '%s.pickle' % (cluster))
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.entries = self._load()
+        atexit.register(self.save)
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return {}
+
+    def _get(self, namespace, key):
+        entry = self.entries.get(namespace, {}).get(key)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            return False, None
+        return True, entry[1]
+
+    def _put(self, namespace, key, value):
+        self.entries.setdefault(namespace, {})[key] = (time.time(), value)
+        self.dirty = True
+
+    def lookup(self, namespace, keys, fetch, cached=True):
+        """
+        read-through lookup of several keys
+        @param namespace: kind of description (ex. "services")
+        @param keys: list of ids to describe
+        @param fetch: function that describes a list of ids, returning a dict
+        @param cached: if false, always fetch (the result is still stored)
+        @return: dictionary of ids to descriptions
+        """
+        found = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                hit, value = self._get(namespace, key) if cached else (False, None)
+                if hit:
+                    found[key] = value
+                else:
+                    missing.append(key)
+
+        if missing:
+            fetched = fetch(missing)
+            with self.lock:
+                for key, value in fetched.items():
+                    self._put(namespace, key, value)
+            found.update(fetched)
+        return found
+
+    def stream(self, namespace, keys, fetch, cached=True):
+        """
+        read-through lookup of several keys, yielding descriptions as they
+        are fetched
+        @param namespace: kind of description (ex. "tasks")
+        @param keys: list of ids to describe
+        @param fetch: function that describes a list of ids, returning an
+                      iterable of (id, description) pairs
+        @param cached: if false, always fetch (the results are still stored)
+        @return: generator of (id, description) pairs, cached ones first
+        """
+        missing = []
+        with self.lock:
+            found = []
+            for key in keys:
+                hit, value = self._get(namespace, key) if cached else (False, None)
+                if hit:
+                    found.append((key, value))
+                else:
+                    missing.append(key)
+        for item in found:
+            yield item
+
+        if missing:
+            for key, value in fetch(missing):
+                with self.lock:
+                    self._put(namespace, key, value)
+                yield key, value
+
+    def value(self, namespace, key, fetch, cached=True):
+        """
+        read-through lookup of a single value (ex. a listing)
+        @param namespace: kind of value (ex. "service_list")
+        @param key: key for the value within the namespace
+        @param fetch: function with no arguments returning the value
+        @param cached: if false, always fetch (the result is still stored)
+        @return: the value
+        """
+        if cached:
+            with self.lock:
+                hit, value = self._get(namespace, key)
+            if hit:
+                return value
+
+        value = fetch()
+        with self.lock:
+            self._put(namespace, key, value)
+        return value
+
+    def invalidate(self):
+        """
+        drop the whole snapshot, used after any mutating action
+        """
+        with self.lock:
+            self.entries = {}
+            self.dirty = False
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def save(self):
+        """
+        write the snapshot to disk if anything was added to it
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(self.entries, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+            self.dirty = False
+
+
+def current_region():
+    """
+    @return: the region clients are created in
+    """
+    return aws.default_region()
+
+
+def invalidate(cluster=None, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Drops on-disk snapshots of the current region, for the commands that
+    change AWS without a cache of their own
+    @param cluster: cluster whose snapshot to drop. Defaults to every
+                    cluster, for commands that act on instances without
+                    knowing their cluster
+    """
+    region_dir = os.path.join(cache_dir, current_region() or 'default')
+    if cluster:
+        names = ['%s.pickle' % (cluster)]
+    else:
+        try:
+            names = [name for name in os.listdir(region_dir) if name.endswith('.pickle')]
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            names = []
+    for name in names:
+        try:
+            os.remove(os.path.join(region_dir, name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def open_cache(cluster, ttl):
+    """
+    @param cluster: cluster name the snapshot belongs to
+    @param ttl: seconds entries stay valid. 0 disables caching
+    @return: SnapshotCache or NullCache
+    """
+    if not ttl or ttl <= 0:
+        return NullCache()
+    return SnapshotCache(cluster, current_region(), ttl)
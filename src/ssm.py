@@ -0,0 +1,253 @@
+"""
+module for running commands on EC2 instances through SSM Run Command
+"""
+
+import datetime
+from operator import itemgetter
+import pipes
+import sys
+import time
+import traceback
+
+# local imports
+import aws
+import events
+import snapshot
+
+# S3 bucket for EC2 Run Command output
+EC2_RUN_OUTPUT_S3_BUCKET = 'ec2-run-command-output'
+
+# registry hostnames of ECR look like <account>.dkr.ecr.<region>.amazonaws.com
+ECR_REGISTRY_MARKER = '.dkr.ecr.'
+
+# seconds the SSM wait for `docker stop` allows on top of the longest
+# container timeout
+DOCKER_STOP_MARGIN = 2
+
+# labels the ECS agent puts on the containers of a task
+ECS_TASK_LABEL = 'com.amazonaws.ecs.task-arn'
+ECS_CONTAINER_LABEL = 'com.amazonaws.ecs.container-name'
+
+# stops every container at once, each with the timeout of its task's
+# container definition, and prints one line per container:
+# "STOPPED <container id> <timeout> <milliseconds> <exit status> <name>"
+DOCKER_STOP_SCRIPT = """\
+stop_container() {
+  started=$(date +%%s%%N)
+  docker stop -t "$2" "$1" > /dev/null 2>&1
+  status=$?
+  echo "STOPPED $1 $2 $(( ($(date +%%s%%N) - started) / 1000000 )) $status ${3#*/}"
+}
+for id in $(docker ps -q); do
+  key=$(docker inspect --format '{{index .Config.Labels "%(task_label)s"}} {{index .Config.Labels "%(container_label)s"}}' "$id" | sed 's#^.*/\\([^/ ]*\\) #\\1/#')
+  case "$key" in
+%(cases)s    *) timeout=%(timeout)d ;;
+  esac
+  stop_container "$id" "$timeout" "$key" &
+done
+wait
+"""
+
+
+def find_invocation(ssm_client, command_id, instance_id):
+    """
+    @return: the invocation of a ssm command once it finished, otherwise None
+    """
+    paginator = ssm_client.get_paginator('list_command_invocations')
+    for resp in paginator.paginate(CommandId=command_id, InstanceId=instance_id, Details=True):
+        for invocation in resp['CommandInvocations']:
+            if invocation.get('Status') in ["Success", "Cancelled"]:
+                return invocation
+    return None
+
+
+def wait_for_invocation(ssm_client, command_id, instance_id, timeout):
+    """
+    Wait for results of a ssm command
+    @param ssm_client: ssm client
+    @param command_id: ssm command id as return by send_command()
+    @param instance_id: ec2_id
+    @return: invocation object
+    """
+    started = time.time()
+    while time.time() - started < timeout:
+        invocation = find_invocation(ssm_client, command_id, instance_id)
+        if invocation:
+            return invocation
+        time.sleep(1)
+    return None
+
+
+def send_command(ssm_client, instance_id, command):
+    """
+    Starts a shell command on an ec2 instance
+    @return: tuple of (command id, None) or (None, error message)
+    """
+    # Note: TimeoutSeconds is the timeout for AWS to begin running the command
+    try:
+        response = ssm_client.send_command(
+            InstanceIds=[instance_id],
+            DocumentName='AWS-RunShellScript',
+            TimeoutSeconds=3600,
+            Comment='',
+            Parameters={
+                'commands': ["#!/bin/bash", command]
+            },
+            OutputS3BucketName=EC2_RUN_OUTPUT_S3_BUCKET,
+            OutputS3KeyPrefix='rollover-' + datetime.datetime.now().strftime('%Y%m%d')
+        )
+    except Exception as e:
+        ex_type, ex, tb = sys.exc_info()
+        err_msg = "\n".join(traceback.format_tb(tb) + [str(e)])
+        return None, "SSM Error: failed to send SSM command to AWS:\n%s" % (err_msg)
+
+    # Error sending response
+    if response.get('ResponseMetadata', {}).get('HTTPStatusCode') is not 200:
+        return None, "SSM ERROR: failed to send command. %s" % (response)
+
+    command_id = response.get('Command').get('CommandId')
+    # Not sure when/if this actually happens; adding as a safeguard for now.
+    if not command_id:
+        return None, "SSM ERROR: could not find command ID in response"
+    return command_id, None
+
+
+def invocation_result(invocation, command):
+    """
+    @param invocation: finished invocation, or None if it timed out
+    @param command: the command that was run
+    @return: tuple of (return code, error message/output)
+    """
+    if not invocation or 'CommandPlugins' not in invocation:
+        return -1, "ERROR: Timed out while waiting for `%s`" % (command)
+
+    return_code = None
+    output = ""
+    for plugin in invocation['CommandPlugins']:
+        if "ResponseCode" in plugin:
+            return_code = plugin['ResponseCode']
+            output = plugin['Output']
+
+    if return_code is None:
+        return -1, "SSM ERROR: failed to get return code"
+    return return_code, output
+
+
+def run_with_timeout(instance_id, command, timeout):
+    """
+    Run a shell command on an ec2 instance
+    @param instance_id str
+    @param command str
+    @param timeout int
+    @return tuple of (return code, error message/output)
+    """
+    client = aws.client('ssm')
+    command_id, error = send_command(client, instance_id, command)
+    if error:
+        return -1, error
+    return invocation_result(wait_for_invocation(client, command_id, instance_id, timeout), command)
+
+
+def parse_container_stops(output):
+    """
+    @param output: output of DOCKER_STOP_SCRIPT
+    @return: list of dictionaries with the `container` id, container `name`
+             (empty outside of ECS), `timeout`, `seconds` it took to stop,
+             `status` of `docker stop` and whether it was `killed` at the
+             end of its timeout
+    """
+    stops = []
+    for line in output.splitlines():
+        fields = line.split(None, 5)
+        if len(fields) < 5 or fields[0] != 'STOPPED':
+            # SSM truncates long output, the last line may be cut short
+            continue
+        try:
+            timeout, milliseconds, status = int(fields[2]), int(fields[3]), int(fields[4])
+        except ValueError:
+            continue
+        stops.append(dict(container=fields[1],
+                          name=fields[5] if len(fields) > 5 else '',
+                          timeout=timeout,
+                          seconds=milliseconds / 1000.0,
+                          status=status,
+                          killed=milliseconds >= timeout * 1000))
+    return stops
+
+
+def docker_stop(ec2_id, timeout, stop_timeouts=None):
+    """
+    Stop all docker containers in parallel, each with its own timeout
+    @param ec2_id: ec2 instance id
+    @param timeout: `docker stop` timeout of containers without a stopTimeout
+    @param stop_timeouts: optional dictionary of "<task id>/<container name>"
+                          to seconds, see container_stop_timeouts()
+    @return: tuple of (return code, error message/output, list of container
+             stops, see parse_container_stops())
+    """
+    stop_timeouts = stop_timeouts or {}
+    cases = "".join("    %s) timeout=%d ;;\n" % (pipes.quote(key), seconds)
+                    for key, seconds in sorted(stop_timeouts.items()))
+    command = DOCKER_STOP_SCRIPT % dict(task_label=ECS_TASK_LABEL,
+                                        container_label=ECS_CONTAINER_LABEL,
+                                        cases=cases,
+                                        timeout=timeout)
+    longest = max([timeout] + stop_timeouts.values())
+    ret, out = run_with_timeout(ec2_id, command, longest + DOCKER_STOP_MARGIN)
+    return ret, out, parse_container_stops(out) if ret == 0 else []
+
+
+def report_container_stops(ec2_id, stops, result):
+    """
+    Warns about the containers that failed to stop or had to be killed, and
+    adds the stops to a phase result
+    @param ec2_id: ec2 instance id
+    @param stops: list of container stops, see parse_container_stops()
+    @param result: result dictionary of the docker_stop phase
+    """
+    for stop in stops:
+        if stop['status'] != 0:
+            events.message("WARNING: `docker stop` of %s (%s) exited with %d" % (
+                stop['container'], stop['name'], stop['status']), level='warning', instance=ec2_id)
+        elif stop['killed']:
+            events.message("WARNING: %s (%s) didn't stop within %ds and was killed" % (
+                stop['container'], stop['name'], stop['timeout']), level='warning', instance=ec2_id)
+    result['containers'] = stops
+    if stops:
+        slowest = max(stops, key=itemgetter('seconds'))
+        result['summary'] = "done (%d containers, slowest %s %.1fs)" % (
+            len(stops), slowest['name'] or slowest['container'], slowest['seconds'])
+
+
+def docker_pull(ec2_id, images, timeout):
+    """
+    Pull docker images in parallel. ECR registries are logged into first
+    (best effort, it needs the aws cli on the instance).
+    """
+    commands = []
+    registries = sorted(set([i.split('/', 1)[0] for i in images if ECR_REGISTRY_MARKER in i.split('/', 1)[0]]))
+    for registry in registries:
+        region = registry.split('.')[3]
+        commands.append('aws ecr get-login-password --region %s | docker login --username AWS --password-stdin %s > /dev/null 2>&1 || true'
+                        % (pipes.quote(region), pipes.quote(registry)))
+    commands.append("printf '%%s\\n' %s | xargs -n 1 -P 8 docker pull > /dev/null"
+                    % (" ".join([pipes.quote(i) for i in images])))
+    return run_with_timeout(ec2_id, " && ".join(commands), timeout)
+
+
+def main_docker_stop(args):
+    """
+    Main entry point for the docker-stop command
+    """
+    with events.phase('docker_stop',
+                      "Stopping all containers on %s" % (args.ec2_id),
+                      instance=args.ec2_id) as result:
+        ret, out, stops = docker_stop(args.ec2_id, args.timeout)
+        # the stopped tasks may be in any cluster's snapshot
+        snapshot.invalidate()
+        if ret != 0:
+            result.update(outcome='failed', output=out)
+        report_container_stops(args.ec2_id, stops, result)
+    if ret != 0:
+        events.message(out, level='error', instance=args.ec2_id)
+    return ret == 0
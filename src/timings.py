@@ -0,0 +1,232 @@
+"""
+module for recording how long rollover phases take across runs
+
+Durations are kept in a local SQLite database, keyed by phase and by what
+the phase acted on (a service id for steady state waits, an auto scaling
+group for replacements). Historical percentiles are used to size timeouts
+and poll intervals and to flag stragglers.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+# local imports
+import defaults
+import events
+
+DEFAULT_TIMING_DB = defaults.TIMING_DB
+
+# number of recent samples percentiles are computed from
+HISTORY_SIZE = 100
+
+# samples needed before history overrides the default timeouts
+MIN_SAMPLES = 5
+
+# timeout = percentile * TIMEOUT_FACTOR, bounded by the limits below
+TIMEOUT_PERCENTILE = 99
+TIMEOUT_FACTOR = 1.5
+MIN_TIMEOUT = 60
+MAX_TIMEOUT = 3600
+
+# poll every 1/POLL_FRACTION of the median duration, bounded by the limits below
+POLL_FRACTION = 10
+MIN_POLL_INTERVAL = 2
+MAX_POLL_INTERVAL = 10
+
+# key of phases that are timed across the whole cluster
+ANY_KEY = '*'
+
+# phases whose durations don't depend on what they act on
+UNKEYED_PHASES = ['prepull', 'deregister', 'docker_stop', 'terminate']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS durations (
+    phase TEXT NOT NULL,
+    key TEXT NOT NULL,
+    duration REAL NOT NULL,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS durations_phase_key ON durations (phase, key, recorded_at);
+"""
+
+
+def percentile(values, pct):
+    """
+    nearest-rank percentile
+    @param values: list of numbers
+    @param pct: percentile (0-100)
+    @return: the percentile, or None if values is empty
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+class TimingStore(object):
+    """
+    SQLite backed store of phase durations. Safe to use from several threads.
+    """
+    def __init__(self, path=DEFAULT_TIMING_DB):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+
+    def record(self, phase, key, duration):
+        """
+        @param phase: phase name (ex. "service_steady_state")
+        @param key: what the phase acted on (ex. a service id)
+        @param duration: seconds the phase took
+        """
+        with self.lock:
+            self.conn.execute("INSERT INTO durations (phase, key, duration, recorded_at) VALUES (?, ?, ?, ?)",
+                              (phase, key, duration, time.time()))
+            self.conn.commit()
+
+    def durations(self, phase, key):
+        """
+        @return: list of the most recent durations, newest first
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT duration FROM durations WHERE phase = ? AND key = ? "
+                                     "ORDER BY recorded_at DESC LIMIT ?",
+                                     (phase, key, HISTORY_SIZE)).fetchall()
+        return [row[0] for row in rows]
+
+    def expected(self, phase, key, default):
+        """
+        @param default: duration assumed until there is any history
+        @return: median duration of the phase
+        """
+        samples = self.durations(phase, key)
+        if not samples:
+            return default
+        return percentile(samples, 50)
+
+    def timeout_for(self, phase, key, default):
+        """
+        @param default: timeout used until there is enough history
+        @return: seconds to wait before giving up on the phase
+        """
+        samples = self.durations(phase, key)
+        if len(samples) < MIN_SAMPLES:
+            return default
+        timeout = percentile(samples, TIMEOUT_PERCENTILE) * TIMEOUT_FACTOR
+        return int(min(MAX_TIMEOUT, max(MIN_TIMEOUT, timeout)))
+
+    def poll_interval_for(self, phase, key, default):
+        """
+        @param default: interval used until there is enough history
+        @return: seconds between polls while waiting on the phase
+        """
+        samples = self.durations(phase, key)
+        if len(samples) < MIN_SAMPLES:
+            return default
+        interval = percentile(samples, 50) / POLL_FRACTION
+        return min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, interval))
+
+    def straggler_after(self, phase, key):
+        """
+        @return: seconds after which the phase is slower than it has ever
+                 usually been, or None without enough history
+        """
+        samples = self.durations(phase, key)
+        if len(samples) < MIN_SAMPLES:
+            return None
+        return percentile(samples, TIMEOUT_PERCENTILE)
+
+    def limits_for(self, phase, key, default_timeout, default_poll_interval):
+        """
+        @return: tuple of (timeout, poll interval, straggler threshold)
+        """
+        return (self.timeout_for(phase, key, default_timeout),
+                self.poll_interval_for(phase, key, default_poll_interval),
+                self.straggler_after(phase, key))
+
+
+class NullTimingStore(object):
+    """
+    Stand-in used when timings are disabled. Always uses the defaults.
+    """
+    def record(self, phase, key, duration):
+        pass
+
+    def durations(self, phase, key):
+        return []
+
+    def expected(self, phase, key, default):
+        return default
+
+    def limits_for(self, phase, key, default_timeout, default_poll_interval):
+        return default_timeout, default_poll_interval, None
+
+
+class TimingRecorder(object):
+    """
+    Event bus subscriber that stores the durations of successful phases
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __call__(self, record):
+        if record['event'] != 'phase_end' or record['outcome'] != 'ok':
+            return
+        key = timing_key(record)
+        if key is not None:
+            self.store.record(record['phase'], key, record['duration'])
+
+
+def timing_key(record):
+    """
+    @param record: phase record from the event bus
+    @return: what the durations of the phase are keyed by, or None if the
+             phase isn't tracked
+    """
+    phase = record['phase']
+    if phase == 'service_steady_state':
+        return record.get('service')
+    if phase in ('asg_detach', 'replacement_join'):
+        return None if record.get('scale_down') else record.get('asg')
+    if phase == 'lb_drain':
+        return record.get('load_balancer') or record.get('target_group')
+    if phase in UNKEYED_PHASES:
+        return ANY_KEY
+    return None
+
+
+# stores by path, shared by every rollover in the process
+_stores = {}
+_recording = set()
+_stores_lock = threading.Lock()
+
+
+def open_store(path):
+    """
+    @param path: sqlite file, or None to disable timings
+    @return: TimingStore or NullTimingStore
+    """
+    if not path:
+        return NullTimingStore()
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = TimingStore(path)
+        return _stores[path]
+
+
+def start_recording(store):
+    """
+    Records the phases on the global event bus into `store`, once per store
+    """
+    if isinstance(store, NullTimingStore):
+        return
+    with _stores_lock:
+        if id(store) in _recording:
+            return
+        _recording.add(id(store))
+    events.BUS.subscribe(TimingRecorder(store))
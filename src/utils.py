@@ -2,6 +2,26 @@
 Generic helper utils
 """
 import itertools
+from multiprocessing.pool import ThreadPool
+
+# local imports
+import aws
+import events
+
+
+def iter_batches(size, items):
+    """
+    chops an iterable into batches of `size`, lazily
+    @param size: max size of each batch
+    @param items: iterable of things to batch
+    @return: generator of batched lists
+    """
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
 
 
 def batch_list(size, items):
@@ -11,11 +31,43 @@ def batch_list(size, items):
     @param items: list of things to batch
     @return: list of batched lists
     """
-    batches = []
-    args = [iter(items)] * size
-    for t in itertools.izip_longest(*args):
-        batches.append([e for e in t if e is not None])
-    return batches
+    return list(iter_batches(size, items))
+
+
+def imap_batches(func, size, items, concurrency):
+    """
+    Calls func on batches of items, up to `concurrency` at once
+    @param func: function taking a batch (list)
+    @param size: max size of each batch
+    @param items: iterable of things to batch
+    @param concurrency: most calls in flight
+    @return: generator of the results of func, in the order the calls finish
+    """
+    batches = iter_batches(size, items)
+    first = next(batches, None)
+    if first is None:
+        return
+    second = next(batches, None)
+    if second is None:
+        # a single batch isn't worth a pool
+        yield func(first)
+        return
+
+    region = aws.current_region()
+    event_context = events.current_context()
+
+    def call(batch):
+        with aws.region_context(region), events.context(**event_context):
+            return func(batch)
+
+    pool = ThreadPool(concurrency)
+    try:
+        for result in pool.imap_unordered(call, itertools.chain([first, second], batches)):
+            yield result
+    finally:
+        # also stops the calls not made yet if the caller gave up early
+        pool.terminate()
+        pool.join()
 
 
 def pull_instance_id(arn):